@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import socket
+import logging
+import threading
+import traceback
+from StringIO import StringIO
+from path import path
+
+log = logging.getLogger(__name__)
+
+
+def agent_path(airship_home):
+    return path(airship_home) / 'var' / 'run' / 'agent.sock'
+
+
+class _ThreadStreams(object):
+    """ Stands in for `sys.stdout`, `sys.stderr` or `sys.stdin`, and sends
+    each thread to its own stream, so that concurrent requests don't mix
+    their output. Threads without a stream of their own use `default`. """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def redirect(self, stream):
+        self._local.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._local, 'stream', None) or self._default,
+                       name)
+
+
+class _Channel(object):
+    """ File-like object that sends what is written to the client, as
+    ``{"<name>": text}`` messages. If the client goes away, the command
+    carries on and its output is dropped. """
+
+    def __init__(self, conn, name, lock):
+        self.conn = conn
+        self.name = name
+        self.lock = lock
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        send_message(self.conn, {self.name: data}, self.lock)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        # subprocesses write to the agent's own output
+        return sys.__stderr__.fileno()
+
+
+def send_message(conn, message, lock):
+    with lock:
+        try:
+            conn.sendall(json.dumps(message) + '\n')
+        except socket.error:
+            pass  # the client went away
+
+
+class Agent(object):
+    """ Serves airship commands over a unix socket, keeping the `Airship`
+    object, the plugins and the supervisord connection from one request to
+    the next. Each request is one line of JSON, ``{"argv": [...], "stdin":
+    bool}``, optionally followed by the command's standard input. The
+    answer is a series of ``{"stdout": text}`` and ``{"stderr": text}``
+    lines, and ``{"exit": status}`` at the end. """
+
+    def __init__(self, airship, parser, socket_path):
+        self.airship = airship
+        self.parser = parser
+        self.socket_path = path(socket_path)
+        self.server = None
+        self._config_lock = threading.Lock()
+
+    def listen(self):
+        self.socket_path.parent.makedirs_p()
+        self.socket_path.unlink_p()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(16)
+
+    def run_command(self, argv):
+        """ Run a command, with its output already redirected. Return its
+        exit status. """
+        from .core import AGENT_COMMANDS
+        if not argv or argv[0] not in AGENT_COMMANDS:
+            print >> sys.stderr, "The agent doesn't serve %r" % argv[:1]
+            return 2
+        try:
+            args = self.parser.parse_args([self.airship.home_path] + argv)
+            with self._config_lock:
+                self.airship.refresh_config()
+            args.func(self.airship, args)
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print >> sys.stderr, e.code
+            return 1
+        except Exception:
+            log.exception("Command %r failed", argv)
+            traceback.print_exc(file=sys.stderr)
+            return 1
+        return 0
+
+    def handle(self, conn):
+        lock = threading.Lock()
+        rfile = conn.makefile('rb')
+        try:
+            request = json.loads(rfile.readline())
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+        except (ValueError, KeyError, TypeError, AttributeError,
+                socket.error):
+            send_message(conn, {'stderr': "bad request\n"}, lock)
+            send_message(conn, {'exit': 2}, lock)
+            conn.close()
+            return
+        streams = [sys.stdout, sys.stderr, sys.stdin]
+        targets = [_Channel(conn, 'stdout', lock),
+                   _Channel(conn, 'stderr', lock),
+                   rfile if request.get('stdin') else StringIO()]
+        for stream, target in zip(streams, targets):
+            stream.redirect(target)
+        try:
+            status = self.run_command(argv)
+        finally:
+            for stream in streams:
+                stream.redirect(None)
+        send_message(conn, {'exit': status}, lock)
+        rfile.close()
+        conn.close()
+
+    def serve_forever(self):
+        sys.stdout = _ThreadStreams(sys.stdout)
+        sys.stderr = _ThreadStreams(sys.stderr)
+        sys.stdin = _ThreadStreams(sys.stdin)
+        self.listen()
+        log.info("Agent listening on %s", self.socket_path)
+        while True:
+            conn, _ = self.server.accept()
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+
+def _absolute_paths(argv):
+    """ Resolve the paths given to `deploy` against our working directory,
+    because the agent has its own. """
+    if argv[0] != 'deploy':
+        return argv
+    resolve = lambda arg: arg if arg == '-' else os.path.abspath(arg)
+    resolved = argv[:1]
+    is_path = False
+    for arg in argv[1:]:
+        if arg.startswith('--manifest='):
+            arg = '--manifest=' + resolve(arg[len('--manifest='):])
+        elif is_path or not arg.startswith('-'):
+            arg = resolve(arg)
+        is_path = (arg == '--manifest')
+        resolved.append(arg)
+    return resolved
+
+
+def _send_stdin(conn):
+    try:
+        while True:
+            data = sys.stdin.read(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.shutdown(socket.SHUT_WR)
+    except socket.error:
+        pass  # the agent stopped reading; its answer says why
+
+
+def call_agent(socket_path, argv):
+    """ Run a command in the agent listening on `socket_path`, and copy its
+    output to ours. Return the command's exit status, or `None` if no agent
+    is listening, in which case the caller should run the command itself.
+    """
+    if os.environ.get('AIRSHIP_NO_AGENT'):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except socket.error:
+        conn.close()
+        return None
+    argv = _absolute_paths(argv)
+    send_stdin = (argv[0] == 'deploy' and '-' in argv[1:])
+    conn.sendall(json.dumps({'argv': argv, 'stdin': send_stdin}) + '\n')
+    if send_stdin:
+        sender = threading.Thread(target=_send_stdin, args=(conn,))
+        sender.daemon = True
+        sender.start()
+    else:
+        conn.shutdown(socket.SHUT_WR)
+    rfile = conn.makefile('rb')
+    try:
+        for line in iter(rfile.readline, ''):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            for name, out in [('stdout', sys.stdout), ('stderr', sys.stderr)]:
+                if name in message:
+                    out.write(message[name].encode('utf-8'))
+                    out.flush()
+    finally:
+        rfile.close()
+        conn.close()
+    print >> sys.stderr, "airship: the agent went away"
+    return 1
@@ -1,38 +1,347 @@
+import os
 import sys
+import re
+import logging
+import shutil
+import hashlib
+import zipfile
+import tempfile
 import subprocess
+import multiprocessing
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from path import path
+from airship.stats import timed_stage
 
+log = logging.getLogger(__name__)
 
-def set_up_virtualenv_and_requirements(airship, bucket, **extra):
+
+VENV_CACHE_SIZE = 5
+CACHE_MARKER = '.airship-venv-complete'
+COMPILED_MARKER = '.airship-venv-compiled'
+
+
+def _resolve_interpreter(python):
+    """ The real path of the `python` interpreter setting, which may be a
+    command looked up in ``PATH``. """
+    from distutils.spawn import find_executable
+    found = find_executable(python)
+    return os.path.realpath(found) if found else python
+
+
+def _venv_cache_key(requirements_file, python, index_dir):
+    digest = hashlib.sha256()
+    digest.update(requirements_file.bytes())
+    digest.update('\0%s\0' % python)
+    for item in sorted(path(index_dir).listdir()):
+        stat = item.stat()
+        digest.update('%s %d %d\n' % (item.name, stat.st_size, stat.st_mtime))
+    return digest.hexdigest()[:16]
+
+
+def _evict_venv_cache(airship, cache_dir, size):
+    in_use = set()
+    deploy_path = airship.home_path / 'var' / 'deploy'
+    for venv_link in deploy_path.glob('*/_virtualenv'):
+        if venv_link.islink():
+            in_use.add(venv_link.realpath())
+    entries = sorted((e for e in cache_dir.dirs()
+                      if (e / CACHE_MARKER).isfile()),
+                     key=lambda e: (e / CACHE_MARKER).mtime,
+                     reverse=True)
+    for entry in entries[size:]:
+        if entry.realpath() not in in_use:
+            entry.rmtree()
+
+
+def _normalize(name):
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def find_wheels(requirements_file, index_dir):
+    """ Map pinned requirements (``name==version``) to wheel files in the
+    index. Requirements without exactly one matching wheel are skipped;
+    pip will take care of them. """
+    wheels = {}
+    for item in path(index_dir).files('*.whl'):
+        dist, version = item.name.split('-')[:2]
+        wheels.setdefault((_normalize(dist), version), []).append(item)
+    found = {}
+    for line in requirements_file.lines():
+        line = line.split('#', 1)[0].strip()
+        match = re.match(r'^([A-Za-z0-9_.\-]+)\s*==\s*([^\s;]+)$', line)
+        if match is None:
+            continue
+        name, version = match.groups()
+        candidates = wheels.get((_normalize(name), version), [])
+        if len(candidates) == 1:
+            found[name] = candidates[0]
+    return found
+
+
+def _wheel_contents(wheel):
+    """ The top-level names (packages, modules, namespace directories) that
+    a wheel installs in site-packages, ``bin/<name>`` for the scripts it
+    installs, and the normalized names of the distributions it requires.
+    """
+    top_level = set()
+    requires = set()
+    try:
+        with closing(zipfile.ZipFile(wheel)) as archive:
+            for name in archive.namelist():
+                parts = name.split('/')
+                if parts[0].endswith('.dist-info'):
+                    if parts[1:] == ['METADATA']:
+                        metadata = archive.read(name)
+                        requires.update(_requirements(metadata))
+                    elif parts[1:] == ['entry_points.txt']:
+                        entry_points = archive.read(name)
+                        top_level.update('bin/' + script for script
+                                         in _scripts(entry_points))
+                elif parts[0].endswith('.data'):
+                    if len(parts) > 3 and parts[1] in ('purelib', 'platlib'):
+                        top_level.add(parts[2])
+                    elif len(parts) == 3 and parts[1] == 'scripts':
+                        top_level.add('bin/' + parts[2])
+                else:
+                    top_level.add(parts[0])
+    except (IOError, zipfile.BadZipfile):
+        pass  # pip will complain
+    return top_level, requires
+
+
+def _requirements(metadata):
+    for line in metadata.splitlines():
+        if line.startswith('Requires-Dist:') and 'extra ==' not in line:
+            match = re.match(r'\s*([A-Za-z0-9_.\-]+)',
+                             line[len('Requires-Dist:'):])
+            if match is not None:
+                yield _normalize(match.group(1))
+
+
+def _scripts(entry_points):
+    section = None
+    for line in entry_points.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            section = line.strip('[]').strip()
+        elif '=' in line and section in ('console_scripts', 'gui_scripts'):
+            yield line.split('=', 1)[0].strip()
+
+
+def group_wheels(wheels):
+    """ Split ``{name: wheel}`` into lists of names that one pip process
+    must install, one after the other. Wheels that share a top-level
+    directory (e.g. the ``zope`` namespace) or a script would race to
+    create it, so they go in the same group, each one after the wheels it
+    requires. """
+    groups = []
+    contents = {}
+    for name in sorted(wheels):
+        contents[name] = top_level, requires = _wheel_contents(wheels[name])
+        names = set([name])
+        for group in [g for g in groups if g[1] & top_level]:
+            groups.remove(group)
+            names |= group[0]
+            top_level |= group[1]
+        groups.append((names, top_level))
+
+    def ordered(names):
+        by_key = dict((_normalize(name), name) for name in names)
+        result = []
+        visiting = set()  # to break dependency cycles
+
+        def visit(name):
+            if name in result or name in visiting:
+                return
+            visiting.add(name)
+            for key in sorted(contents[name][1]):
+                if key in by_key:
+                    visit(by_key[key])
+            result.append(name)
+
+        for name in sorted(names):
+            visit(name)
+        return result
+
+    return sorted(ordered(names) for names, _ in groups)
+
+
+def _pip_install_wheels(args):
+    pip, names, wheels = args
+    # by default pip unpacks in `<venv>/build`, shared by every process
+    build_dir = tempfile.mkdtemp(prefix='airship-pip-build-')
+    try:
+        p = subprocess.Popen([pip, 'install', '--no-deps', '--no-index',
+                              '--build', build_dir] + wheels,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    return names, p.returncode, output
+
+
+def install_wheels(pip, wheels, jobs):
+    """ Install wheels concurrently, without their dependencies, so that
+    installing a wheel is just unpacking it. Wheels that unpack into the
+    same directory are installed by the same pip process (see
+    `group_wheels`). Returns the names of wheels that failed to install.
+    """
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(_pip_install_wheels,
+                           [(pip, names, [wheels[name] for name in names])
+                            for names in group_wheels(wheels)])
+    finally:
+        pool.close()
+    failed = []
+    for names, returncode, output in results:
+        if returncode != 0:
+            log.error("Failed to install %s:\n%s", ', '.join(names), output)
+            failed.extend(names)
+    return sorted(failed)
+
+
+def _create_virtualenv(airship, bucket, venv, requirements_file):
     from airship.deployer import DeployError
-    requirements_file = bucket.folder / 'requirements.txt'
-    if requirements_file.isfile():
-        config = airship.config.get('python', {})
-        index_dir = config['dist']
-        venv = bucket.folder / '_virtualenv'
-        pip = venv / 'bin' / 'pip'
-        virtualenv_py = airship.home_path / 'dist' / 'virtualenv.py'
-        python = config.get('interpreter', 'python')
+    config = airship.config.get('python', {})
+    index_dir = config['dist']
+    pip = venv / 'bin' / 'pip'
+    virtualenv_py = airship.home_path / 'dist' / 'virtualenv.py'
+    python = _resolve_interpreter(config.get('interpreter', 'python'))
 
-        try:
+    try:
+        with timed_stage(bucket, 'python.virtualenv'):
             subprocess.check_call([python, virtualenv_py, venv,
                                    '--distribute', '--never-download',
                                    '--extra-search-dir=' + index_dir])
-        except subprocess.CalledProcessError:
-            raise DeployError(bucket, "Failed to create a virtualenv.")
+    except subprocess.CalledProcessError:
+        raise DeployError(bucket, "Failed to create a virtualenv.")
 
-        try:
+    try:
+        with timed_stage(bucket, 'python.wheel'):
             subprocess.check_call([pip, 'install', 'wheel', '--no-index',
                                    '--find-links=file://' + index_dir])
-        except subprocess.CalledProcessError:
-            raise DeployError(bucket, "Failed to install wheel.")
+    except subprocess.CalledProcessError:
+        raise DeployError(bucket, "Failed to install wheel.")
+
+    # Wheels we have for pinned requirements are installed in parallel.
+    # Then pip installs the rest, in dependency order, and checks that
+    # everything is in place.
+    wheels = find_wheels(requirements_file, index_dir)
+    if wheels:
+        jobs = config.get('install_jobs') or multiprocessing.cpu_count()
+        with timed_stage(bucket, 'python.install_wheels'):
+            failed = install_wheels(pip, wheels, jobs)
+        if failed:
+            raise DeployError(bucket, "Failed to install requirements: %s."
+                                      % ', '.join(failed))
 
-        try:
+    try:
+        with timed_stage(bucket, 'python.requirements'):
             subprocess.check_call([pip, 'install', '-r', requirements_file,
                                    '--use-wheel', '--no-index',
                                    '--find-links=file://' + index_dir])
-        except subprocess.CalledProcessError:
-            raise DeployError(bucket, "Failed to install requirements.")
+    except subprocess.CalledProcessError:
+        raise DeployError(bucket, "Failed to install requirements.")
+
+
+def _python_files(folder, exclude=()):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        if dirpath == folder:
+            dirnames[:] = [d for d in dirnames if d not in exclude]
+        files += [os.path.join(dirpath, f) for f in filenames
+                  if f.endswith('.py')]
+    return files
+
+
+def _compile_files(args):
+    python, files = args
+    p = subprocess.Popen([python, '-m', 'compileall', '-q', '-i', '-'],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    output = p.communicate(''.join(f + '\n' for f in files))[0]
+    return p.returncode, output
+
+
+def compile_bytecode(python, files, jobs):
+    """ Compile Python files to bytecode with `jobs` processes of the
+    `python` interpreter. Files that don't compile (e.g. written for
+    another version of Python) are left alone. """
+    chunks = [files[n::jobs] for n in range(jobs) if files[n::jobs]]
+    if not chunks:
+        return
+    pool = ThreadPool(len(chunks))
+    try:
+        results = pool.map(_compile_files,
+                           [(python, chunk) for chunk in chunks])
+    finally:
+        pool.close()
+    for returncode, output in results:
+        if returncode != 0:
+            log.warning("Some files failed to compile:\n%s", output)
+
+
+def precompile_bucket(airship, bucket):
+    """ Write the bytecode of the application and of its virtualenv, so
+    that processes don't have to when they start. A cached virtualenv is
+    only compiled once. """
+    config = airship.config.get('python', {})
+    if not config.get('precompile', True):
+        return
+    jobs = config.get('compile_jobs') or multiprocessing.cpu_count()
+    venv = bucket.folder / '_virtualenv'
+    python = config.get('interpreter', 'python')
+    files = _python_files(bucket.folder, exclude=['_virtualenv'])
+    compiled_marker = None
+    if venv.isdir():
+        python = venv / 'bin' / 'python'
+        compiled_marker = venv.realpath() / COMPILED_MARKER
+        if not compiled_marker.isfile():
+            files += _python_files(venv.realpath())
+    with timed_stage(bucket, 'python.compile'):
+        compile_bytecode(python, files, jobs)
+    if compiled_marker is not None:
+        compiled_marker.touch()
+
+
+def set_up_virtualenv_and_requirements(airship, bucket, **extra):
+    _set_up_virtualenv(airship, bucket)
+    precompile_bucket(airship, bucket)
+
+
+def _set_up_virtualenv(airship, bucket):
+    requirements_file = bucket.folder / 'requirements.txt'
+    if requirements_file.isfile():
+        config = airship.config.get('python', {})
+        venv = bucket.folder / '_virtualenv'
+        cache_size = config.get('venv_cache_size', VENV_CACHE_SIZE)
+        if not cache_size:
+            _create_virtualenv(airship, bucket, venv, requirements_file)
+            return
+
+        cache_dir = airship.home_path / 'var' / 'venv-cache'
+        cache_dir.makedirs_p()
+        python = _resolve_interpreter(config.get('interpreter', 'python'))
+        key = _venv_cache_key(requirements_file, python, config['dist'])
+        cached_venv = cache_dir / key
+        marker = cached_venv / CACHE_MARKER
+        if marker.isfile():
+            log.info("Reusing cached virtualenv %s", key)
+        else:
+            if cached_venv.isdir():
+                cached_venv.rmtree()  # leftover of an interrupted build
+            try:
+                _create_virtualenv(airship, bucket, cached_venv,
+                                   requirements_file)
+            except:
+                if cached_venv.isdir():
+                    cached_venv.rmtree()
+                raise
+        marker.touch()
+        cached_venv.symlink(venv)
+        _evict_venv_cache(airship, cache_dir, cache_size)
 
 
 def activate_virtualenv(airship, bucket, environ, **extra):
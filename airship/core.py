@@ -4,19 +4,28 @@ import logging
 import json
 import random
 import string
+import time
+from datetime import datetime
 from pipes import quote as shellquote
+from importlib import import_module
 from path import path
-import yaml
-from kv import KV
-import pkg_resources
 import blinker
-from .daemons import Supervisor
-from . import deployer
 
 log = logging.getLogger(__name__)
 
 CFG_LINKS_FOLDER = 'active'
 YAML_EXT = '.yaml'
+PLUGIN_REGISTRY = 'plugins.json'
+REAPER_RATE = 2000  # files deleted per second
+LAUNCH_PLAN = '_launch_plan.json'
+
+# commands that run without loading plugins
+LIGHT_COMMANDS = ['init', 'list', 'destroy', 'reap', 'stats', 'logs',
+                  'compress-logs', 'sockets', 'delta-check', 'status', 'top',
+                  'metrics', 'events', 'event-listener']
+
+# commands that are sent to the agent, if it's running
+AGENT_COMMANDS = ['deploy', 'list', 'destroy', 'status']
 
 bucket_run = blinker.Signal()
 define_arguments = blinker.Signal()
@@ -26,6 +35,35 @@ def random_id(size=6, vocabulary=string.ascii_lowercase + string.digits):
     return ''.join(random.choice(vocabulary) for c in range(size))
 
 
+def parse_procfile(lines):
+    """ Parse the lines of a Procfile into a ``{procname: command}`` dict.
+    Blank lines, comments and lines without a colon are skipped. """
+    process_types = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#') or ':' not in line:
+            continue
+        (procname, cmd) = line.split(':', 1)
+        process_types[procname.strip()] = cmd.strip()
+    return process_types
+
+
+def read_procfile(folder):
+    procfile_path = folder / 'Procfile'
+    if not procfile_path.isfile():
+        return {}
+    with procfile_path.open('rb') as f:
+        return parse_procfile(f)
+
+
+def _disk_usage(folder):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for name in filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+    return total
+
+
 class Bucket(object):
 
     def __init__(self, id_, airship, config):
@@ -33,32 +71,60 @@ class Bucket(object):
         self.airship = airship
         self.config = config
         self.folder = self.airship._bucket_folder(id_)
-        self.process_types = {}
-        self._read_procfile()
+        self.timings = []
+        if 'process_types' in config:
+            self.process_types = dict(config['process_types'])
+        else:
+            self.process_types = {}
+            self._read_procfile()
 
     def _read_procfile(self):
-        procfile_path = self.folder / 'Procfile'
-        if procfile_path.isfile():
-            with procfile_path.open('rb') as f:
-                for line in f:
-                    (procname, cmd) = line.split(':', 1)
-                    self.process_types[procname.strip()] = cmd.strip()
+        self.process_types.update(read_procfile(self.folder))
+
+    def save_metadata(self):
+        """ Record what we know after unpacking, so that later we don't have
+        to look inside the bucket folder. """
+        self.save_config(process_types=self.process_types,
+                         size=_disk_usage(self.folder))
+
+    def save_config(self, **fields):
+        self.config.update(fields)
+        self.airship.buckets_db[self.id_] = self.config
 
     def start(self):
         log.info("Activating bucket %r", self.id_)
         self.airship.daemons.configure_bucket_running(self)
+        self.save_config(state='running')
 
     def stop(self):
         self.airship.daemons.configure_bucket_stopped(self)
+        self.save_config(state='stopped')
 
     def destroy(self):
         self.airship.daemons.remove_bucket(self.id_)
         if self.folder.isdir():
             self.folder.rmtree()
-        self.airship.buckets_db.pop(self.id_, None)
-
-    def run(self, command):
-        os.chdir(self.folder)
+        self.airship._remove_bucket_record(self.id_)
+
+    def port_for(self, procname):
+        """ The port for a process type: from `port_map`, or, for blue/green
+        deployments, the one in the bucket's slot. """
+        blue_green_ports = (self.airship.config.get('blue_green') or
+                            {}).get('ports', {})
+        if procname in blue_green_ports and 'slot' in self.config:
+            return blue_green_ports[procname][self.config['slot']]
+        return self.airship.config.get('port_map', {}).get(procname)
+
+    def instances(self, procname):
+        """ Number of processes to run for a process type. """
+        return (self.airship.config.get('instances') or {}).get(procname, 1)
+
+    def resources(self, procname):
+        """ CPU affinity, nice level, file limit etc. for a process type,
+        from the `resources` section of the configuration. """
+        return (self.airship.config.get('resources') or {}).get(procname) or {}
+
+    def _prepare_run(self, command, instance=None):
         environ = dict(os.environ)
         environ.update(self.airship.config.get('env') or {})
         bucket_run.send(self.airship, bucket=self, environ=environ)
@@ -66,13 +132,133 @@ class Bucket(object):
         if command:
             if command in self.process_types:
                 procname = command
-                port_map = self.airship.config.get('port_map', {})
-                if procname in port_map:
-                    environ['PORT'] = str(port_map[procname])
+                instance = instance or 0
+                environ['AIRSHIP_INSTANCE'] = str(instance)
+                port = self.port_for(procname)
+                if port is not None:
+                    environ['PORT'] = str(port + instance)
                 command = self.process_types[procname]
             shell_args += ['-c', command]
+        return shell_args, environ
+
+    def run(self, command, instance=None):
+        """ Run `command`, which may be a process type, in the bucket. Each
+        instance of a process type gets its own port: the one in
+        `port_map` plus `instance`. With `socket_activation`, the listening
+        socket is inherited from the socket holder. The process type's
+        `resources` settings are applied before `exec`. """
+        shell_args, environ = self._prepare_run(command, instance)
+        settings = self.resources(command)
+        if settings and command in self.process_types:
+            from .resources import apply_settings
+            apply_settings(settings)
+        if (self.airship.config.get('socket_activation') and
+                command in self.process_types and 'PORT' in environ):
+            from .sockets import holder_path, inherit_socket
+            inherit_socket(holder_path(self.airship.home_path),
+                           int(environ['PORT']), environ)
+        os.chdir(self.folder)
         os.execve(shell_args[0], shell_args, environ)
 
+    def write_launch_plan(self):
+        """ Resolve the command line and environment of each process type
+        and save them, so that `airship run` can skip straight to `exec`
+        (see `exec_launch_plan`). The variables from the `env` section are
+        saved as they are; for those changed by `bucket_run` handlers, the
+        change is saved, e.g. the folder they put in front of `PATH`, and
+        is applied to the environment that `airship run` gets. """
+        config_env = self.airship.config.get('env') or {}
+        base_environ = dict(os.environ)
+        base_environ.update(config_env)
+        processes = {}
+        for procname in self.process_types:
+            shell_args, environ = self._prepare_run(procname)
+            # PORT and AIRSHIP_INSTANCE depend on the instance number
+            del environ['AIRSHIP_INSTANCE']
+            environ.pop('PORT', None)
+            env = dict(config_env)
+            env_edits = {}
+            for name, value in environ.items():
+                old = base_environ.get(name)
+                if value == old:
+                    continue
+                if old and value.endswith(old):
+                    env_edits[name] = [value[:-len(old)], '']
+                elif old and value.startswith(old):
+                    env_edits[name] = ['', value[len(old):]]
+                else:
+                    env[name] = value
+            processes[procname] = {
+                'args': shell_args,
+                'env': env,
+                'env_edits': env_edits,
+                'cwd': self.folder,
+                'port': self.port_for(procname),
+                'resources': self.resources(procname),
+            }
+        plan = {
+            'config_mtime': _config_mtime(self.airship.home_path),
+            'socket_activation': bool(
+                self.airship.config.get('socket_activation')),
+            'processes': processes,
+        }
+        plan_path = self.folder / LAUNCH_PLAN
+        tmp_path = plan_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(plan, f)
+        path(tmp_path).rename(plan_path)
+
+
+def _config_mtime(airship_home):
+    try:
+        return (path(airship_home) / 'etc' / 'airship.yaml').mtime
+    except OSError:
+        return None
+
+
+def exec_launch_plan(argv):
+    """ Fast path for ``airship <home> run -d <bucket_id> [-i <instance>]
+    <procname>``, the command that supervisord runs. If the bucket has an
+    up-to-date launch plan, `exec` the process right away; otherwise
+    return, and the command is handled normally. """
+    if len(argv) not in [5, 7] or argv[1] != 'run' or argv[2] != '-d':
+        return
+    instance = 0
+    if len(argv) == 7:
+        if argv[4] != '-i' or not argv[5].isdigit():
+            return
+        instance = int(argv[5])
+    airship_home = path(argv[0]).abspath()
+    plan_path = airship_home / 'var' / 'deploy' / argv[3] / LAUNCH_PLAN
+    try:
+        with plan_path.open('rb') as f:
+            plan = json.load(f)
+    except (IOError, ValueError):
+        return
+    process = plan['processes'].get(argv[-1])
+    if process is None or plan['config_mtime'] != _config_mtime(airship_home):
+        return
+
+    encode = lambda value: value.encode('utf-8')
+    args = [encode(arg) for arg in process['args']]
+    environ = dict(os.environ)
+    environ.update((encode(k), encode(v)) for k, v in process['env'].items())
+    for name, (prefix, suffix) in process.get('env_edits', {}).items():
+        name = encode(name)
+        environ[name] = encode(prefix) + environ.get(name, '') + encode(suffix)
+    environ['AIRSHIP_INSTANCE'] = str(instance)
+    if process['port'] is not None:
+        environ['PORT'] = str(process['port'] + instance)
+        if plan.get('socket_activation'):
+            from .sockets import holder_path, inherit_socket
+            inherit_socket(holder_path(airship_home),
+                           process['port'] + instance, environ)
+    if process.get('resources'):
+        from .resources import apply_settings
+        apply_settings(process['resources'])
+    os.chdir(process['cwd'])
+    os.execve(args[0], args, environ)
+
 
 _newest = object()
 
@@ -82,7 +268,9 @@ class Airship(object):
     acts as container for deployments.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, read_only=False):
+        from .store import open_store
+        from .index import BucketIndex
         self.home_path = config['home']
         self.var_path = self.home_path / 'var'
         self.log_path = self.var_path / 'log'
@@ -90,16 +278,56 @@ class Airship(object):
         self.config = config
         etc = self.home_path / 'etc'
         etc.mkdir_p()
-        self.buckets_db = KV(etc / 'buckets.db', table='bucket')
-        self.meta_db = KV(etc / 'buckets.db', table='meta')
-        self.daemons = Supervisor(etc)
+        self.store = open_store(etc / 'buckets.db', read_only)
+        self.buckets_db = self.store.table('bucket')
+        self.meta_db = self.store.table('meta')
+        self.bucket_index = BucketIndex(self.store)
+        self._daemons = None
+        self._config_mtime = _config_mtime(self.home_path)
+
+    def refresh_config(self):
+        """ Reload `airship.yaml` if it changed since it was read, for
+        long-running commands. Plugins are not reloaded. """
+        mtime = _config_mtime(self.home_path)
+        if mtime != self._config_mtime:
+            log.info("Reloading configuration")
+            self.config = load_config(self.home_path)
+            self._config_mtime = mtime
+
+    @property
+    def daemons(self):
+        if self._daemons is None:
+            from .daemons import Supervisor
+            self._daemons = Supervisor(self.home_path / 'etc')
+        return self._daemons
+
+    @daemons.setter
+    def daemons(self, value):
+        self._daemons = value
 
     @property
-    def cfg_links_folder(self):
-        folder = self.home_path / CFG_LINKS_FOLDER
-        if not folder.isdir():
-            folder.makedirs()
-        return folder
+    def active_link(self):
+        return self.home_path / CFG_LINKS_FOLDER
+
+    def active_bucket_id(self):
+        return self.meta_db.get('active_bucket')
+
+    def set_active_bucket(self, bucket_id):
+        """ Point `active` to the bucket, both in the database and as a
+        symlink to its folder. """
+        self.meta_db['active_bucket'] = bucket_id
+        tmp_link = path(self.active_link + '.tmp')
+        tmp_link.unlink_p()
+        self._bucket_folder(bucket_id).symlink(tmp_link)
+        tmp_link.rename(self.active_link)
+
+    def _clear_active_bucket(self, bucket_id):
+        with self.meta_db.lock():
+            if self.meta_db.get('active_bucket') != bucket_id:
+                return
+            del self.meta_db['active_bucket']
+        if self.active_link.islink():
+            self.active_link.unlink()
 
     def initialize(self):
         self.var_path.mkdir_p()
@@ -109,7 +337,10 @@ class Airship(object):
         self.generate_supervisord_configuration()
 
     def generate_supervisord_configuration(self):
-        self.daemons.configure(self.home_path)
+        self.daemons.configure(
+            self.home_path,
+            sockets=bool(self.config.get('socket_activation')),
+            agent=bool(self.config.get('agent')))
 
     def _get_bucket_by_id(self, bucket_id):
         config = self.buckets_db[bucket_id]
@@ -117,37 +348,183 @@ class Airship(object):
 
     def get_bucket(self, name=_newest):
         if name is _newest:
-            name = max(self.buckets_db)
+            name = self.bucket_index.newest()
+            if name is None:
+                raise KeyError("There are no buckets")
         return self._get_bucket_by_id(name)
 
     def _bucket_folder(self, id_):
         return self.deploy_path / id_
 
     def _generate_bucket_id(self):
-        with self.meta_db.lock():
+        with self.store.transaction():
             next_id = self.meta_db.get('next_bucket_id', 1)
             self.meta_db['next_bucket_id'] = next_id + 1
+            self.bucket_index[next_id] = 'd%d' % (next_id,)
         id_ = 'd%d' % (next_id,)
         self._bucket_folder(id_).mkdir()
         return id_
 
     def new_bucket(self, config={}):
-        bucket_id = self._generate_bucket_id()
-        self.buckets_db[bucket_id] = {}
+        with self.store.transaction():
+            bucket_id = self._generate_bucket_id()
+            self.buckets_db[bucket_id] = {
+                'created': datetime.utcnow().isoformat(),
+                'state': 'new',
+            }
         bucket = self._get_bucket_by_id(bucket_id)
         return bucket
 
-    def list_buckets(self):
-        return {'buckets': [{'id': id_} for id_ in self.buckets_db]}
+    @property
+    def trash_path(self):
+        return self.var_path / 'trash'
+
+    def trash_buckets(self, buckets):
+        """ Remove buckets from supervisord in one go, then move their
+        folders to the trash, to be deleted later by `reap_trash`. If
+        supervisord fails to remove them, `SupervisorError` is raised and
+        the folders are left alone, since their processes may still run.
+        """
+        self.daemons.remove_buckets([bucket.id_ for bucket in buckets])
+        self.trash_path.makedirs_p()
+        for bucket in buckets:
+            if bucket.folder.isdir():
+                trashed = self.trash_path / (bucket.id_ + '-' + random_id())
+                bucket.folder.rename(trashed)
+        with self.store.transaction():
+            for bucket in buckets:
+                self._remove_bucket_record(bucket.id_)
+
+    def _remove_bucket_record(self, bucket_id):
+        with self.store.transaction():
+            self.buckets_db.pop(bucket_id, None)
+            self.bucket_index.pop(_bucket_seq(bucket_id), None)
+            self._clear_active_bucket(bucket_id)
+
+    def list_buckets(self, before=None, limit=None):
+        """ Buckets, newest first. `before` is a bucket ID; only older
+        buckets are returned. """
+        if before is not None:
+            before = _bucket_seq(before)
+        bucket_ids = self.bucket_index.history(before, limit)
+        return {
+            'buckets': [dict(self.buckets_db[id_], id=id_)
+                        for id_ in bucket_ids],
+            'active': self.active_bucket_id(),
+        }
+
+
+def _removals(entry):
+    """ Yield ``(function, path)`` pairs that delete `entry`, bottom-up. """
+    for dirpath, dirnames, filenames in os.walk(entry, topdown=False):
+        for name in filenames:
+            yield os.unlink, os.path.join(dirpath, name)
+        for name in dirnames:
+            dir_path = os.path.join(dirpath, name)
+            if os.path.islink(dir_path):
+                yield os.unlink, dir_path
+            else:
+                yield os.rmdir, dir_path
+    if os.path.isdir(entry) and not os.path.islink(entry):
+        yield os.rmdir, entry
+    else:
+        yield os.unlink, entry
+
+
+def reap_trash(trash_path, rate=REAPER_RATE):
+    """ Delete everything in `trash_path`, at most `rate` files per second,
+    so that we don't starve the running application of disk I/O. """
+    import fcntl
+    if not trash_path.isdir():
+        return
+    with open(trash_path / '.lock', 'wb') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return  # another reaper is at work
+
+        interval = 1.0 / rate
+        schedule = time.time()
+        while True:
+            entries = [e for e in trash_path.listdir() if e.name != '.lock']
+            if not entries:
+                break
+            for entry in entries:
+                for remove, item_path in _removals(entry):
+                    remove(item_path)
+                    now = time.time()
+                    schedule = max(schedule, now) + interval
+                    if schedule - now > 0.05:
+                        time.sleep(schedule - now)
+
+
+def _bucket_seq(bucket_id):
+    return int(bucket_id[1:])
+
+
+def _sys_path_signature():
+    # installing or removing a distribution changes the mtime of its folder
+    signature = []
+    for entry in sys.path:
+        try:
+            signature.append([entry, path(entry or '.').mtime])
+        except OSError:
+            pass
+    return signature
+
+
+def _plugin_entry_points(etc):
+    """ Return ``[name, module, attrs]`` for each `airship_plugins` entry
+    point. The list is cached in `etc` to avoid importing `pkg_resources`,
+    until the set of installed distributions changes. """
+    registry_path = etc / PLUGIN_REGISTRY
+    signature = _sys_path_signature()
+    try:
+        with registry_path.open('rb') as f:
+            registry = json.load(f)
+        if registry['signature'] == signature:
+            return registry['entry_points']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass  # missing, unreadable or invalid; rebuild it
+
+    import pkg_resources
+    entry_points = [[ep.name, ep.module_name, list(ep.attrs)] for ep in
+                    pkg_resources.iter_entry_points('airship_plugins')]
+    if etc.isdir():
+        import tempfile
+        # each process writes its own file, then renames it into place
+        fd, tmp_path = tempfile.mkstemp(dir=etc, prefix=PLUGIN_REGISTRY,
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                json.dump({'signature': signature,
+                           'entry_points': entry_points}, f)
+            path(tmp_path).rename(registry_path)
+        except:
+            path(tmp_path).unlink_p()
+            raise
+    return entry_points
+
 
+_plugin_callbacks = None
 
-# we load the entry points here so they can do import-time signal registrations
-_plugin_callbacks = [ep.load() for ep in
-                     pkg_resources.iter_entry_points('airship_plugins')]
+
+def get_plugin_callbacks(etc):
+    """ Import the plugins. They may do import-time signal registrations. """
+    global _plugin_callbacks
+    if _plugin_callbacks is None:
+        callbacks = []
+        for name, module_name, attrs in _plugin_entry_points(etc):
+            callback = import_module(module_name)
+            for attr in attrs:
+                callback = getattr(callback, attr)
+            callbacks.append(callback)
+        _plugin_callbacks = callbacks
+    return _plugin_callbacks
 
 
 def load_plugins(airship):
-    for callback in _plugin_callbacks:
+    for callback in get_plugin_callbacks(airship.home_path / 'etc'):
         callback(airship)
 
 
@@ -172,7 +549,7 @@ def init_cmd(airship, args):
     airship.initialize()
 
     airship_bin = airship.home_path / 'bin'
-    airship_bin.makedirs()
+    airship_bin.makedirs_p()
 
     kw = {'home': airship.home_path, 'prefix': sys.prefix}
 
@@ -190,23 +567,182 @@ def init_cmd(airship, args):
 
 
 def list_cmd(airship, args):
-    print json.dumps(airship.list_buckets(), indent=2)
+    print json.dumps(airship.list_buckets(args.before, args.limit), indent=2)
 
 
 def destroy_cmd(airship, args):
     airship.get_bucket(args.bucket_id or _newest).destroy()
 
 
+def status_cmd(airship, args):
+    bucket_id = airship.active_bucket_id()
+    status = {'active': bucket_id, 'processes': None}
+    if bucket_id is not None:
+        processes = airship.daemons.process_info()
+        if processes is not None:
+            status['processes'] = [
+                {'name': p['group'] if p['name'] == p['group']
+                 else '%s:%s' % (p['group'], p['name']),
+                 'state': p['statename'],
+                 'pid': p['pid'] or None,
+                 'uptime': (p['now'] - p['start']
+                            if p['statename'] == 'RUNNING' else None)}
+                for p in processes if p['group'].startswith(bucket_id + '-')]
+    print json.dumps(status, indent=2)
+
+
+def _sample_processes(airship, sampler):
+    from .metrics import bucket_roots
+    roots = bucket_roots(airship)
+    if roots is None:
+        print >> sys.stderr, "Can't get the list of processes from supervisord"
+        sys.exit(1)
+    return sampler.sample(roots)
+
+
+def top_cmd(airship, args):
+    from .metrics import Sampler, summarize, format_table
+    sampler = Sampler(pss=args.pss)
+    clear = '\x1b[H\x1b[2J' if sys.stdout.isatty() else ''
+    try:
+        _sample_processes(airship, sampler)
+        count = 0
+        while args.iterations is None or count < args.iterations:
+            time.sleep(args.interval)
+            summary = summarize(_sample_processes(airship, sampler))
+            print clear + format_table(summary)
+            sys.stdout.flush()
+            count += 1
+    except KeyboardInterrupt:
+        pass
+
+
+def metrics_cmd(airship, args):
+    from .metrics import Sampler, summarize, format_prometheus
+    sampler = Sampler(pss=args.pss)
+    _sample_processes(airship, sampler)
+    time.sleep(args.interval)
+    summary = summarize(_sample_processes(airship, sampler))
+    if args.prometheus:
+        sys.stdout.write(format_prometheus(summary))
+    else:
+        print json.dumps(summary, indent=2, sort_keys=True)
+
+
+def stats_cmd(airship, args):
+    from .stats import deploy_stats, format_table
+    history = airship.meta_db.get('deploy_history', [])[-args.limit:]
+    stats = deploy_stats(history)
+    if args.table:
+        print format_table(stats)
+    else:
+        print json.dumps(stats, indent=2)
+
+
+def logs_cmd(airship, args):
+    from .logs import bucket_log_files, show_logs
+    bucket_id = args.bucket_id or airship.active_bucket_id() or _newest
+    bucket = airship.get_bucket(bucket_id)
+    unknown = set(args.procname) - set(bucket.process_types)
+    if unknown:
+        print >> sys.stderr, "Unknown process types: %s" % ', '.join(unknown)
+        sys.exit(1)
+    try:
+        show_logs(bucket_log_files(bucket, args.procname),
+                  args.lines, args.follow)
+    except KeyboardInterrupt:
+        pass
+
+
+def compress_logs_cmd(airship, args):
+    from .daemons import LOG_BACKUPS
+    from .logs import compress_rotated_logs
+    os.nice(19)
+    backups = (airship.config.get('logs') or {}).get('backups', LOG_BACKUPS)
+    while True:
+        compress_rotated_logs(airship.log_path, backups)
+        if not args.every:
+            break
+        time.sleep(args.every)
+
+
+def sockets_cmd(airship, args):
+    from .sockets import (SocketHolder, activation_config, activation_ports,
+                          holder_path)
+    settings = activation_config(airship.config)
+    if settings is None:
+        print >> sys.stderr, "socket_activation is not enabled"
+        sys.exit(1)
+    holder = SocketHolder(holder_path(airship.home_path),
+                          settings['host'], settings['backlog'])
+    holder.serve_forever(activation_ports(airship.config))
+
+
+def agent_cmd(airship, args):
+    from .agent import Agent, agent_path
+    agent = Agent(airship, build_args_parser(), agent_path(airship.home_path))
+    agent.serve_forever()
+
+
+def events_cmd(airship, args):
+    from .events import EventLog, HISTORY_SIZE, format_events
+    event_log = EventLog(airship.store, airship.config.get('event_history',
+                                                           HISTORY_SIZE))
+    events = event_log.history(args.bucket_id, args.procname, args.limit)
+    if args.json:
+        print json.dumps(events, indent=2)
+    elif events:
+        print format_events(events)
+
+
+def event_listener_cmd(airship, args):
+    from .events import EventListener
+    EventListener(airship).serve_forever()
+
+
+def reap_cmd(airship, args):
+    os.nice(19)
+    reap_trash(airship.trash_path, airship.config.get('reaper_rate',
+                                                      REAPER_RATE))
+
+
 def run_cmd(airship, args):
     command = ' '.join(shellquote(a) for a in args.command)
-    airship.get_bucket(args.bucket_id or _newest).run(command)
+    bucket = airship.get_bucket(args.bucket_id or _newest)
+    bucket.run(command, instance=args.instance)
+
+
+def _read_manifest(manifest_path):
+    from .deployer import load_manifest
+    try:
+        if manifest_path == '-':
+            return load_manifest(sys.stdin)
+        with open(manifest_path, 'rb') as f:
+            return load_manifest(f)
+    except (IOError, ValueError), e:
+        print >> sys.stderr, "Can't read manifest: %s" % e
+        sys.exit(1)
+
+
+def delta_check_cmd(airship, args):
+    from .deployer import delta_source, missing_files
+    manifest = _read_manifest(args.manifest)
+    for name in missing_files(delta_source(airship), manifest):
+        print name
 
 
 def deploy_cmd(airship, args):
+    from . import deployer
+    manifest = None
+    if args.manifest is not None:
+        manifest = _read_manifest(args.manifest)
     try:
-        deployer.deploy(airship, args.tarfile)
+        if deployer.deploy(airship, args.artifact, manifest) is None:
+            print "Deployment skipped, a newer one is queued."
     except deployer.DeployError, e:
         print "Deployment failed:", e.message
+        for name in getattr(e, 'paths', []):
+            print "missing:", name
         try:
             e.bucket.destroy()
         except:
@@ -229,17 +765,78 @@ def build_args_parser():
 
     create_command('init', init_cmd)
 
-    create_command('list', list_cmd)
+    list_parser = create_command('list', list_cmd)
+    list_parser.add_argument('-n', '--limit', type=int)
+    list_parser.add_argument('--before', help="only buckets older than this")
 
     destroy_parser = create_command('destroy', destroy_cmd)
     destroy_parser.add_argument('-d', '--bucket_id')
 
+    create_command('status', status_cmd)
+
+    stats_parser = create_command('stats', stats_cmd)
+    stats_parser.add_argument('-n', '--limit', type=int, default=20,
+                              help="number of recent deployments")
+    stats_parser.add_argument('--table', action='store_true')
+
+    logs_parser = create_command('logs', logs_cmd)
+    logs_parser.add_argument('-d', '--bucket_id')
+    logs_parser.add_argument('-f', '--follow', action='store_true')
+    logs_parser.add_argument('-n', '--lines', type=int, default=10)
+    logs_parser.add_argument('procname', nargs='*')
+
+    top_parser = create_command('top', top_cmd)
+    top_parser.add_argument('-i', '--interval', type=float, default=1,
+                            help="seconds between samples")
+    top_parser.add_argument('-n', '--iterations', type=int,
+                            help="stop after this many samples")
+    top_parser.add_argument('--pss', action='store_true',
+                            help="also measure proportional memory")
+
+    metrics_parser = create_command('metrics', metrics_cmd)
+    metrics_parser.add_argument('-i', '--interval', type=float, default=1,
+                                help="seconds to measure rates over")
+    metrics_parser.add_argument('--pss', action='store_true',
+                                help="also measure proportional memory")
+    metrics_format = metrics_parser.add_mutually_exclusive_group()
+    metrics_format.add_argument('--json', action='store_false',
+                                dest='prometheus', default=False,
+                                help="JSON (the default)")
+    metrics_format.add_argument('--prometheus', action='store_true',
+                                help="Prometheus text format")
+
+    compress_logs_parser = create_command('compress-logs', compress_logs_cmd)
+    compress_logs_parser.add_argument('--every', type=int,
+                                      help="repeat every N seconds")
+
+    events_parser = create_command('events', events_cmd)
+    events_parser.add_argument('-d', '--bucket_id')
+    events_parser.add_argument('-n', '--limit', type=int, default=50)
+    events_parser.add_argument('--json', action='store_true')
+    events_parser.add_argument('procname', nargs='*')
+
+    create_command('event-listener', event_listener_cmd)
+
+    create_command('reap', reap_cmd)
+
+    create_command('sockets', sockets_cmd)
+
+    create_command('agent', agent_cmd)
+
     run_parser = create_command('run', run_cmd)
     run_parser.add_argument('-d', '--bucket_id')
+    run_parser.add_argument('-i', '--instance', type=int,
+                            help="instance number of the process type")
     run_parser.add_argument('command', nargs=argparse.REMAINDER)
 
     deploy_parser = create_command('deploy', deploy_cmd)
-    deploy_parser.add_argument('tarfile')
+    deploy_parser.add_argument('artifact', help="tarball, or '-' for stdin")
+    deploy_parser.add_argument('--manifest',
+                               help="delta deployment: JSON of path -> "
+                                    "sha256 of all the application's files")
+
+    delta_check_parser = create_command('delta-check', delta_check_cmd)
+    delta_check_parser.add_argument('manifest', help="file, or '-' for stdin")
 
     define_arguments.send(None, create_command=create_command)
 
@@ -256,20 +853,38 @@ def set_up_logging(airship_home):
     logging.getLogger().addHandler(handler)
 
 
-def main(raw_arguments=None):
-    parser = build_args_parser()
-    args = parser.parse_args(raw_arguments or sys.argv[1:])
-    airship_home = path(args.airship_home).abspath()
-    set_up_logging(airship_home)
+def load_config(airship_home):
     airship_yaml_path = airship_home / 'etc' / 'airship.yaml'
     if airship_yaml_path.isfile():
+        import yaml
         with airship_yaml_path.open('rb') as f:
-            config = yaml.load(f)
+            config = yaml.load(f) or {}
     else:
         config = {}
     config['home'] = airship_home
-    airship = Airship(config)
-    load_plugins(airship)
+    return config
+
+
+def main(raw_arguments=None):
+    argv = raw_arguments or sys.argv[1:]
+    exec_launch_plan(argv)
+    if len(argv) > 1 and argv[1] in AGENT_COMMANDS:
+        from .agent import agent_path, call_agent
+        status = call_agent(agent_path(path(argv[0]).abspath()), argv[1:])
+        if status is not None:
+            sys.exit(status)
+    use_plugins = not (len(argv) > 1 and argv[1] in LIGHT_COMMANDS)
+    if use_plugins and argv:
+        get_plugin_callbacks(path(argv[0]).abspath() / 'etc')
+    parser = build_args_parser()
+    args = parser.parse_args(argv)
+    airship_home = path(args.airship_home).abspath()
+    set_up_logging(airship_home)
+    # `run` only reads the database
+    airship = Airship(load_config(airship_home),
+                      read_only=args.func is run_cmd)
+    if use_plugins:
+        load_plugins(airship)
     args.func(airship, args)
 
 
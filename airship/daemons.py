@@ -1,5 +1,9 @@
 import os
 import sys
+import socket
+import httplib
+import xmlrpclib
+import threading
 import subprocess
 from path import path
 
@@ -8,6 +12,10 @@ class SupervisorError(Exception):
     """ Something went wrong while talking to supervisord. """
 
 
+# `supervisor.xmlrpc.Faults.SUCCESS`, the status of a process that stopped
+SUCCESS = 80
+
+
 SUPERVISORD_CFG_TEMPLATE = """\
 [unix_http_server]
 file = %(home_path)s/var/run/supervisor.sock
@@ -24,22 +32,170 @@ directory = %(home_path)s
 [supervisorctl]
 serverurl = unix://%(home_path)s/var/run/supervisor.sock
 
-[include]
+[program:airship-compress-logs]
+command = %(home_path)s/bin/airship compress-logs --every 300
+redirect_stderr = true
+stdout_logfile = %(home_path)s/var/log/compress-logs.log
+
+[eventlistener:airship-events]
+command = %(home_path)s/bin/airship event-listener
+events = PROCESS_STATE
+buffer_size = 100
+stderr_logfile = %(home_path)s/var/log/events.log
+
+%(extra_programs)s[include]
 files = %(include_files)s
 """
 
+SUPERVISORD_SOCKETS_PROGRAM = """\
+[program:airship-sockets]
+command = %(home_path)s/bin/airship sockets
+redirect_stderr = true
+stdout_logfile = %(home_path)s/var/log/sockets.log
+priority = 1
+
+"""
+
+SUPERVISORD_AGENT_PROGRAM = """\
+[program:airship-agent]
+command = %(home_path)s/bin/airship agent
+redirect_stderr = true
+stdout_logfile = %(home_path)s/var/log/agent.log
+
+"""
+
 
 SUPERVISORD_PROGRAM_TEMPLATE = """\
 [program:%(bucket)s-%(procname)s]
 redirect_stderr = true
-stdout_logfile = %(var)s/log/%(procname)s.log
+stdout_logfile = %(var)s/log/%(bucket)s-%(procname)s.log
+stdout_logfile_maxbytes = %(log_max_bytes)s
+stdout_logfile_backups = %(log_backups)d
 startsecs = %(startsecs)s
 startretries = 1
 autostart = %(autostart)s
+autorestart = %(autorestart)s
 command = bin/airship run -d %(bucket_id)s %(procname)s
 
 """
 
+# supervisord expands `%(process_num)s` for each of the `numprocs` processes
+SUPERVISORD_MULTI_PROGRAM_TEMPLATE = """\
+[program:%(bucket)s-%(procname)s]
+numprocs = %(numprocs)d
+process_name = %%(program_name)s_%%(process_num)02d
+redirect_stderr = true
+stdout_logfile = %(var)s/log/%(bucket)s-%(procname)s_%%(process_num)02d.log
+stdout_logfile_maxbytes = %(log_max_bytes)s
+stdout_logfile_backups = %(log_backups)d
+startsecs = %(startsecs)s
+startretries = 1
+autostart = %(autostart)s
+autorestart = %(autorestart)s
+command = bin/airship run -d %(bucket_id)s -i %%(process_num)s %(procname)s
+
+"""
+
+LOG_MAX_BYTES = '50MB'
+LOG_BACKUPS = 10
+
+
+class UnixSocketHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class UnixSocketTransport(xmlrpclib.Transport):
+    """ XML-RPC transport over a unix socket. The HTTP connection is kept
+    open and reused for subsequent calls. """
+
+    def __init__(self, socket_path):
+        xmlrpclib.Transport.__init__(self)
+        self.socket_path = socket_path
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        self._connection = (host, UnixSocketHTTPConnection(self.socket_path))
+        return self._connection[1]
+
+
+class SupervisorRPC(object):
+    """ Client for the supervisord XML-RPC interface. It may be shared by
+    threads; calls go over the connection one at a time. """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._proxy = None
+        self._lock = threading.RLock()
+
+    @property
+    def proxy(self):
+        if self._proxy is None:
+            transport = UnixSocketTransport(self.socket_path)
+            self._proxy = xmlrpclib.ServerProxy('http://localhost/RPC2',
+                                                transport=transport)
+        return self._proxy
+
+    def available(self):
+        return os.path.exists(self.socket_path)
+
+    def _call(self, method, *args):
+        try:
+            with self._lock:
+                return getattr(self.proxy.supervisor, method)(*args)
+        except xmlrpclib.Fault, e:
+            raise SupervisorError(e.faultString)
+
+    def reload_config(self):
+        [[added, changed, removed]] = self._call('reloadConfig')
+        return added, changed, removed
+
+    def add_process_group(self, name):
+        return self._call('addProcessGroup', name)
+
+    def remove_process_group(self, name):
+        return self._call('removeProcessGroup', name)
+
+    def get_all_process_info(self):
+        return self._call('getAllProcessInfo')
+
+    def get_process_info(self, name):
+        return self._call('getProcessInfo', name)
+
+    def start_process(self, name, wait=True):
+        return self._call('startProcess', name, wait)
+
+    def stop_process_group(self, name):
+        """ Stop the group's processes and wait until they are stopped. """
+        for result in self._call('stopProcessGroup', name, True):
+            if result['status'] != SUCCESS:
+                raise SupervisorError("Failed to stop %s: %s"
+                                      % (result['name'],
+                                         result['description']))
+
+    def update(self, groups=None):
+        """ Same as `supervisorctl update`: reload the configuration, stop
+        and remove the groups that were removed or changed, then add those
+        that were added or changed. Each call waits for the previous one,
+        since supervisord refuses to remove a group that is still stopping.
+        If `groups` is given, other groups are left alone. """
+        added, changed, removed = self.reload_config()
+        if groups is not None:
+            added, changed, removed = [[g for g in names if g in groups]
+                                       for names in (added, changed, removed)]
+        for group in removed + changed:
+            self.stop_process_group(group)
+            self.remove_process_group(group)
+        for group in changed + added:
+            self.add_process_group(group)
+
 
 class Supervisor(object):
     """ Wrapper for supervisor configuration and control """
@@ -49,6 +205,11 @@ class Supervisor(object):
     def __init__(self, etc):
         self.etc = etc
         self.config_dir.makedirs_p()
+        self.rpc = SupervisorRPC(self.socket_path)
+
+    @property
+    def socket_path(self):
+        return self.etc.parent / 'var' / 'run' / 'supervisor.sock'
 
     @property
     def config_path(self):
@@ -61,32 +222,85 @@ class Supervisor(object):
     def _bucket_cfg(self, bucket_id):
         return self.config_dir / bucket_id
 
-    def configure(self, home_path):
+    def configure(self, home_path, sockets=False, agent=False):
+        extra_programs = ''
+        if sockets:
+            extra_programs += SUPERVISORD_SOCKETS_PROGRAM % {
+                'home_path': home_path,
+            }
+        if agent:
+            extra_programs += SUPERVISORD_AGENT_PROGRAM % {
+                'home_path': home_path,
+            }
         with open(self.config_path, 'wb') as f:
             f.write(SUPERVISORD_CFG_TEMPLATE % {
                 'home_path': home_path,
+                'extra_programs': extra_programs,
                 'include_files': self.etc / 'supervisor.d' / '*',
             })
 
+    def _read_groups(self, bucket_id):
+        cfg_path = self._bucket_cfg(bucket_id)
+        if not cfg_path.isfile():
+            return []
+        return [line.strip()[len('[program:'):-1]
+                for line in cfg_path.lines()
+                if line.startswith('[program:')]
+
     def _configure_bucket(self, bucket, autostart):
-        with self._bucket_cfg(bucket.id_).open('wb') as f:
-            for procname in bucket.process_types:
-                f.write(SUPERVISORD_PROGRAM_TEMPLATE % {
-                    'var': bucket.airship.var_path,
-                    'bucket': bucket.id_,
-                    'directory': bucket.folder,
-                    'bucket_id': bucket.id_,
-                    'autostart': 'true' if autostart else 'false',
-                    'startsecs': 2 if autostart else 0,
-                    'procname': procname,
-                })
+        """ Write the bucket's program sections, if they changed. Return the
+        groups that supervisord must update, including those removed. """
+        cfg_path = self._bucket_cfg(bucket.id_)
+        logs_config = bucket.airship.config.get('logs') or {}
+        # process types with a readiness check are waited for by `deploy`
+        readiness = bucket.airship.config.get('readiness') or {}
+        restart_backoff = bucket.airship.config.get('restart_backoff')
+        sections = []
+        for procname in sorted(bucket.process_types):
+            numprocs = bucket.instances(procname)
+            template = (SUPERVISORD_PROGRAM_TEMPLATE if numprocs == 1
+                        else SUPERVISORD_MULTI_PROGRAM_TEMPLATE)
+            sections.append(template % {
+                'var': bucket.airship.var_path,
+                'bucket': bucket.id_,
+                'directory': bucket.folder,
+                'bucket_id': bucket.id_,
+                'autostart': 'true' if autostart else 'false',
+                # with restart_backoff, the event listener restarts them
+                'autorestart': ('false' if restart_backoff
+                                else 'unexpected'),
+                'startsecs': (2 if autostart and procname not in readiness
+                              else 0),
+                'procname': procname,
+                'numprocs': numprocs,
+                'log_max_bytes': logs_config.get('max_bytes', LOG_MAX_BYTES),
+                'log_backups': logs_config.get('backups', LOG_BACKUPS),
+            })
+        config = ''.join(sections)
+        groups = ['%s-%s' % (bucket.id_, procname)
+                  for procname in sorted(bucket.process_types)]
+        if cfg_path.isfile() and cfg_path.bytes() == config:
+            loaded = self.loaded_groups()
+            if loaded is None:
+                return []
+            return [g for g in groups if g not in loaded]
+        old_groups = self._read_groups(bucket.id_)
+        cfg_path.write_bytes(config)
+        return groups + [g for g in old_groups if g not in groups]
 
     def remove_bucket(self, bucket_id):
-        self._bucket_cfg(bucket_id).unlink_p()
-        try:
-            self.ctl(['update'])
-        except SupervisorError:
-            pass  # maybe supervisord is stopped
+        self.remove_buckets([bucket_id])
+
+    def remove_buckets(self, bucket_ids):
+        """ Remove the configuration of several buckets, then update
+        supervisord once for all their groups. Raises `SupervisorError` if
+        supervisord fails to remove them; updating again retries. """
+        groups = []
+        for bucket_id in bucket_ids:
+            groups += self._read_groups(bucket_id)
+            self._bucket_cfg(bucket_id).unlink_p()
+        if groups:
+            self.update(groups)
 
     def ctl(self, cmd_args):
         if os.environ.get('AIRSHIP_NO_SUPERVISORCTL'):
@@ -98,10 +312,43 @@ class Supervisor(object):
         except subprocess.CalledProcessError:
             raise SupervisorError
 
-    def configure_bucket_running(self, bucket):
-        self._configure_bucket(bucket, True)
+    def process_info(self):
+        """ supervisord's information about all processes, or `None` if we
+        can't find out. """
+        if os.environ.get('AIRSHIP_NO_SUPERVISORCTL'):
+            return None
+        if not self.rpc.available():
+            return None
+        try:
+            return self.rpc.get_all_process_info()
+        except (socket.error, xmlrpclib.ProtocolError):
+            return None
+
+    def loaded_groups(self):
+        """ Names of process groups currently loaded in supervisord, or
+        `None` if we can't find out. """
+        processes = self.process_info()
+        if processes is None:
+            return None
+        return set(p['group'] for p in processes)
+
+    def update(self, groups=None):
+        if os.environ.get('AIRSHIP_NO_SUPERVISORCTL'):
+            return
+        if self.rpc.available():
+            try:
+                return self.rpc.update(groups)
+            except (socket.error, xmlrpclib.ProtocolError):
+                pass  # stale socket; let supervisorctl report the problem
+        # supervisorctl 3.0a12 ignores the group names and updates them all
         self.ctl(['update'])
 
+    def configure_bucket_running(self, bucket):
+        groups = self._configure_bucket(bucket, True)
+        if groups:
+            self.update(groups)
+
     def configure_bucket_stopped(self, bucket):
-        self._configure_bucket(bucket, False)
-        self.ctl(['update'])
+        groups = self._configure_bucket(bucket, False)
+        if groups:
+            self.update(groups)
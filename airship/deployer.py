@@ -1,10 +1,46 @@
+import os
+import sys
 import subprocess
+import zlib
+import bz2
+import hashlib
+import logging
+import socket
+import time
+import json
+import shutil
+import tarfile
+from contextlib import closing
+from distutils.spawn import find_executable
 import blinker
 from .daemons import SupervisorError
+from .stats import monotonic, timed_stage, record_deploy
+from .deployqueue import DeployQueue
+from .readiness import (NotReady, DEFAULT_TIMEOUT, bucket_checks,
+                        wait_until_ready)
+from .resources import check_settings
+from .core import read_procfile
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+log = logging.getLogger(__name__)
+
+# corrupt or truncated input, or a file that can't be written
+EXTRACT_ERRORS = (tarfile.TarError, zlib.error, IOError, OSError, EOFError,
+                  ValueError) + ((lzma.LZMAError,) if lzma is not None
+                                 else ())
 
 bucket_setup = blinker.Signal()
 
+CHUNK_SIZE = 64 * 1024
+MANIFEST = '_manifest.json'
+
 
 class DeployError(Exception):
     """ Something went wrong during deployment. """
@@ -14,27 +50,626 @@ class DeployError(Exception):
         self.bucket = bucket
 
 
+class MissingFilesError(DeployError):
+    """ A delta deployment lacks files that are neither in the artifact nor
+    unchanged in the active bucket. """
+
+    def __init__(self, bucket, paths):
+        super(MissingFilesError, self).__init__(
+            bucket, "Files missing from the artifact: %d." % len(paths))
+        self.paths = paths
+
+
+class DeployCancelled(DeployError):
+    """ A newer deployment was queued while this one was being built. """
+
+
+class _NoDecompressor(object):
+
+    def decompress(self, data):
+        return data
+
+
+class _GzipDecompressor(object):
+    """ Decompress every member of a gzip file; tools such as `pigz` or
+    ``cat a.gz b.gz`` write several, one after the other. """
+
+    def __init__(self):
+        self._member = None
+
+    def decompress(self, data):
+        chunks = []
+        while data:
+            if self._member is None:
+                if not data.lstrip('\0'):
+                    break  # padding after the last member
+                self._member = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            chunks.append(self._member.decompress(data))
+            data = self._member.unused_data
+            if data:
+                self._member = None
+        return ''.join(chunks)
+
+
+def _decompressor(head):
+    if head.startswith('\x1f\x8b'):
+        return _GzipDecompressor()
+    if head.startswith('BZh'):
+        return bz2.BZ2Decompressor()
+    if head.startswith('\xfd7zXZ\x00'):
+        if lzma is None:
+            raise ValueError("xz artifacts require the lzma module")
+        return lzma.LZMADecompressor()
+    return _NoDecompressor()
+
+
+class ArtifactStream(object):
+    """ Read-only file object that decompresses an artifact, autodetecting
+    the compression format, and computes its SHA-256 as it's read. """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+        head = self._read_raw(6)
+        self._decompressor = _decompressor(head)
+        self._buffer = self._decompressor.decompress(head)
+
+    def _read_raw(self, size):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def read(self, size=-1):
+        # `_buffer` is consumed from `_offset`, rather than sliced on every
+        # read, so that reading a large decompressed chunk stays linear
+        available = len(self._buffer) - self._offset
+        chunks = []
+        while not self._eof and (size < 0 or available < size):
+            data = self._read_raw(CHUNK_SIZE)
+            if not data:
+                self._eof = True
+                break
+            data = self._decompressor.decompress(data)
+            chunks.append(data)
+            available += len(data)
+        if chunks:
+            self._buffer = ''.join([self._buffer[self._offset:]] + chunks)
+            self._offset = 0
+        if size < 0:
+            size = len(self._buffer) - self._offset
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def drain(self):
+        """ Consume the rest of the input, so that the digest covers it. """
+        while self._read_raw(CHUNK_SIZE):
+            pass
+        self._eof = True
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def _is_safe_path(name):
+    return not name.startswith('/') and '..' not in name.split('/')
+
+
+def _is_inside(folder, file_path):
+    """ Whether `file_path`, once symlinks are resolved, is in `folder`. """
+    real_path = os.path.realpath(file_path)
+    return real_path == folder or real_path.startswith(folder + os.sep)
+
+
+def _member_target(bucket, member):
+    """ Where to extract `member`, making sure that neither the member
+    itself nor what it links to ends up outside the bucket folder, even
+    through links extracted earlier. """
+    folder = os.path.realpath(bucket.folder)
+    if not _is_safe_path(member.name):
+        raise DeployError(bucket, "Unsafe path in artifact: %s"
+                                  % member.name)
+    target = bucket.folder / member.name
+    if not _is_inside(folder, target.parent):
+        raise DeployError(bucket, "Unsafe path in artifact: %s"
+                                  % member.name)
+    if member.issym():
+        link_target = os.path.join(target.parent, member.linkname)
+    elif member.islnk():
+        # hard link names are relative to the root of the archive
+        link_target = (bucket.folder / member.linkname
+                       if _is_safe_path(member.linkname) else None)
+    else:
+        return target
+    if link_target is None or not _is_inside(folder, link_target):
+        raise DeployError(bucket, "Unsafe link in artifact: %s -> %s"
+                                  % (member.name, member.linkname))
+    return target
+
+
+def _extract_file(tar, member, target, hashes):
+    """ Extract a regular file, computing its SHA-256 on the way. """
+    target.parent.makedirs_p()
+    if os.path.islink(target) or os.path.isfile(target):
+        # don't write through a link extracted earlier
+        os.unlink(target)
+    sha256 = hashlib.sha256()
+    src = tar.extractfile(member)
+    with open(target, 'wb') as dst:
+        while True:
+            data = src.read(CHUNK_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+            dst.write(data)
+    tar.chmod(member, target)
+    tar.utime(member, target)
+    hashes[os.path.normpath(member.name)] = sha256.hexdigest()
+
+
+def extract_artifact(bucket, fileobj, hashes=None):
+    """ Unpack a (possibly compressed) tarball into the bucket folder while
+    it's being read from `fileobj`. Returns the SHA-256 of the input; the
+    SHA-256 of each regular file goes in `hashes`, if given. """
+    if hashes is None:
+        hashes = {}
+    try:
+        stream = ArtifactStream(fileobj)
+        with closing(tarfile.open(fileobj=stream, mode='r|')) as tar:
+            for member in tar:
+                target = _member_target(bucket, member)
+                if member.isreg():
+                    _extract_file(tar, member, target, hashes)
+                else:
+                    tar.extract(member, bucket.folder)
+                    linkname = os.path.normpath(member.linkname or '.')
+                    if member.islnk() and linkname in hashes:
+                        hashes[os.path.normpath(member.name)] = \
+                            hashes[linkname]
+        stream.drain()
+    except EXTRACT_ERRORS:
+        log.exception("Error while extracting artifact")
+        raise DeployError(bucket, "Failed to extract artifact.")
+    return stream.hexdigest()
+
+
+def load_manifest(fileobj):
+    """ Read a delta manifest: a JSON object mapping the path of each file
+    of the application to its SHA-256. """
+    manifest = json.load(fileobj)
+    if not isinstance(manifest, dict):
+        raise ValueError("The manifest must be a JSON object.")
+    manifest = dict((os.path.normpath(name.encode('utf-8')), sha256)
+                    for name, sha256 in manifest.items())
+    for name in manifest:
+        if not _is_safe_path(name):
+            raise ValueError("Unsafe path in manifest: %s" % name)
+    return manifest
+
+
+def read_bucket_manifest(bucket):
+    """ The files of a bucket's artifact, as recorded at deploy time:
+    ``{path: [sha256, size, mtime]}``. """
+    try:
+        with open(bucket.folder / MANIFEST, 'rb') as f:
+            return dict((name.encode('utf-8'), info)
+                        for name, info in json.load(f).items())
+    except (IOError, ValueError):
+        return {}
+
+
+def save_bucket_manifest(bucket, hashes):
+    files = {}
+    for name, sha256 in hashes.items():
+        stat = os.lstat(bucket.folder / name)
+        files[name] = [sha256, stat.st_size, stat.st_mtime]
+    with open(bucket.folder / MANIFEST, 'wb') as f:
+        json.dump(files, f)
+
+
+def delta_source(airship, exclude=None):
+    """ The bucket that delta deployments take unchanged files from: the
+    active one, or else the newest. """
+    bucket_id = airship.active_bucket_id()
+    if bucket_id is None or bucket_id == exclude:
+        bucket_ids = [info['id'] for info in
+                      airship.list_buckets()['buckets']
+                      if info['id'] != exclude]
+        bucket_id = bucket_ids[0] if bucket_ids else None
+    return None if bucket_id is None else airship.get_bucket(bucket_id)
+
+
+def _reusable(source, source_files, name, sha256):
+    """ Whether the source bucket has the file `name`, unchanged since it
+    was deployed, with the given hash. """
+    info = source_files.get(name)
+    if info is None or info[0] != sha256:
+        return False
+    try:
+        stat = os.lstat(source.folder / name)
+    except OSError:
+        return False
+    return [stat.st_size, stat.st_mtime] == info[1:]
+
+
+def missing_files(source, manifest, present=()):
+    """ Paths of the manifest that are neither in `present` nor available,
+    unchanged, in the source bucket. """
+    source_files = {} if source is None else read_bucket_manifest(source)
+    return sorted(name for name, sha256 in manifest.items()
+                  if name not in present and
+                  not _reusable(source, source_files, name, sha256))
+
+
+def link_unchanged_files(bucket, source, manifest, hashes):
+    """ Complete a delta deployment: hardlink (or copy, across filesystems)
+    the files of the manifest that weren't in the artifact from the source
+    bucket. Raise `MissingFilesError` if some are not available. """
+    for name in sorted(hashes):
+        if name in manifest and manifest[name] != hashes[name]:
+            raise DeployError(bucket, "Checksum mismatch for %s." % name)
+    missing = missing_files(source, manifest, hashes)
+    if missing:
+        raise MissingFilesError(bucket, missing)
+    for name, sha256 in manifest.items():
+        if name in hashes:
+            continue
+        target = bucket.folder / name
+        target.parent.makedirs_p()
+        try:
+            os.link(source.folder / name, target)
+        except OSError:
+            shutil.copy2(source.folder / name, target)
+        hashes[name] = sha256
+
+
 def get_procs(bucket):
-    with (bucket.folder / 'Procfile').open('rb') as f:
-        return dict((k.strip(), v.strip()) for k, v in
-                    (l.split(':', 1) for l in f))
+    return read_procfile(bucket.folder)
+
+
+def stop_old_buckets(bucket):
+    """ Stop the other running buckets, so that the new one can take their
+    ports. Return them, to be restarted if the new bucket fails. """
+    airship = bucket.airship
+    running = [airship.get_bucket(bucket_info['id'])
+               for bucket_info in airship.list_buckets()['buckets']
+               if bucket_info['id'] != bucket.id_ and
+               bucket_info.get('state', 'running') == 'running']
+    try:
+        for old_bucket in running:
+            old_bucket.stop()
+    except SupervisorError:
+        log.exception("Error while stopping old buckets")
+        raise DeployError(bucket, "Failed to stop old buckets.")
+    return running
+
+
+def roll_back(bucket, old_buckets):
+    """ Stop the new bucket and start the old ones again. """
+    try:
+        bucket.stop()
+        for old_bucket in old_buckets:
+            old_bucket.start()
+    except SupervisorError:
+        log.exception("Error while restarting old buckets")
 
 
 def remove_old_buckets(bucket):
     airship = bucket.airship
-    for bucket_info in airship.list_buckets()['buckets']:
-        if bucket_info['id'] == bucket.id_:
+    old_buckets = [airship.get_bucket(bucket_info['id'])
+                   for bucket_info in airship.list_buckets()['buckets']
+                   if bucket_info['id'] != bucket.id_]
+    try:
+        airship.trash_buckets(old_buckets)
+    except SupervisorError:
+        log.exception("Error while removing old buckets")
+        raise DeployError(bucket, "Failed to remove old buckets from "
+                                  "supervisord.")
+
+
+def start_reaper(airship):
+    """ Delete trashed buckets in the background, with low CPU and I/O
+    priority. """
+    args = [sys.executable, '-m', 'airship.core', airship.home_path, 'reap']
+    if find_executable('ionice'):
+        args = ['ionice', '-c', '3'] + args
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(args, stdin=devnull, stdout=devnull,
+                         stderr=devnull, close_fds=True,
+                         preexec_fn=os.setsid)
+
+
+def wait_for_port(port, timeout, host='127.0.0.1'):
+    """ Return `True` as soon as something accepts connections on `port`,
+    or `False` if nothing did before `timeout`. """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except socket.error:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+
+
+def readiness_checks(bucket):
+    """ The readiness checks of the bucket's process types, from the
+    `readiness` section of the configuration, as ``(procname, timeout,
+    checks)``. """
+    config = bucket.airship.config.get('readiness') or {}
+    result = []
+    for procname in sorted(config):
+        if procname not in bucket.process_types:
             continue
-        airship.get_bucket(bucket_info['id']).destroy()
+        timeout = config[procname].get('timeout', DEFAULT_TIMEOUT)
+        try:
+            checks = bucket_checks(bucket, procname, config[procname])
+        except ValueError, e:
+            raise DeployError(bucket, str(e))
+        result.append((procname, timeout, checks))
+    return result
 
 
-def deploy(airship, tarfile):
-    bucket = airship.new_bucket()
-    subprocess.check_call(['tar', 'xf', tarfile, '-C', bucket.folder])
+def check_resources(bucket):
+    """ Make sure that the `resources` settings of the bucket's process
+    types can be applied when they start. """
+    config = bucket.airship.config.get('resources') or {}
+    for procname in sorted(config):
+        if procname not in bucket.process_types:
+            continue
+        try:
+            check_settings(config[procname] or {})
+        except ValueError, e:
+            raise DeployError(bucket, "Invalid resources for process %r: %s"
+                                      % (procname, e))
+
+
+def check_instances(bucket):
+    """ Make sure that the `instances` settings of the bucket's process
+    types are positive integers. """
+    config = bucket.airship.config.get('instances') or {}
+    for procname in sorted(config):
+        if procname not in bucket.process_types:
+            continue
+        value = config[procname]
+        if (not isinstance(value, (int, long)) or isinstance(value, bool) or
+                value < 1):
+            raise DeployError(bucket, "Invalid instances for process %r: "
+                                      "must be a positive integer, not %r"
+                                      % (procname, value))
+
+
+def check_blue_green_ports(bucket):
+    """ Make sure that `blue_green: ports` gives process types two ports
+    each, and that no port is used twice once `instances` are counted. """
+    config = bucket.airship.config['blue_green']
+    ports = config.get('ports') if isinstance(config, dict) else None
+    if not isinstance(ports, dict) or not ports:
+        raise DeployError(bucket, "blue_green needs ports: two ports for "
+                                  "each web-facing process type.")
+    used = {}
+    for procname in sorted(ports):
+        slots = ports[procname]
+        if (not isinstance(slots, list) or len(slots) != 2 or
+                not all(isinstance(port, (int, long)) and
+                        not isinstance(port, bool) for port in slots)):
+            raise DeployError(bucket, "Invalid blue_green ports for process "
+                                      "%r: must be two port numbers, not %r"
+                                      % (procname, slots))
+        if procname not in bucket.process_types:
+            continue
+        for slot, first_port in enumerate(slots):
+            for port in range(first_port,
+                              first_port + bucket.instances(procname)):
+                if port in used:
+                    raise DeployError(bucket, "Port %d is used by both %r "
+                                              "slot %d and %r slot %d."
+                                      % ((port,) + used[port] +
+                                         (procname, slot)))
+                used[port] = (procname, slot)
+
+
+def check_blue_green(bucket, readiness):
+    """ With socket activation, the blue/green ports are always open, so
+    waiting for them proves nothing: the process types must have a
+    readiness check instead. """
+    if not bucket.airship.config.get('socket_activation'):
+        return
+    checked = set(procname for procname, _, _ in readiness)
+    for procname in sorted(bucket.airship.config['blue_green']['ports']):
+        if procname in bucket.process_types and procname not in checked:
+            raise DeployError(bucket, "Process %r needs an http or command "
+                                      "readiness check: with "
+                                      "socket_activation its port is always "
+                                      "open." % procname)
+
+
+def wait_for_readiness(bucket, readiness):
+    """ Wait until the readiness checks pass; each process type has its
+    own timeout, counted from now. """
+    t0 = time.time()
+    for procname, timeout, checks in readiness:
+        try:
+            wait_until_ready(checks, t0 + timeout)
+        except NotReady, e:
+            raise DeployError(bucket, "Process %r is not ready after %ds: %s"
+                                      % (procname, timeout, e))
+
+
+def choose_slot(bucket):
+    """ Pick the blue/green slot not used by another running bucket. """
+    used = set(info.get('slot')
+               for info in bucket.airship.list_buckets()['buckets']
+               if info['id'] != bucket.id_ and info.get('state') == 'running')
+    return 1 if 0 in used else 0
+
+
+def switch_upstream(bucket):
+    """ Point the front (e.g. a reverse proxy) at the bucket's ports, by
+    rewriting the upstream file and running the switch command. """
+    airship = bucket.airship
+    config = airship.config['blue_green']
+    ports = dict((procname, bucket.port_for(procname))
+                 for procname in config['ports'])
+    template = config.get('upstream_template')
+    if template is None:
+        content = json.dumps(ports)
+    else:
+        content = template.format(**ports)
+    upstream_file = airship.home_path / config.get('upstream_file',
+                                                   'var/run/upstream')
+    upstream_file.parent.makedirs_p()
+    tmp_file = upstream_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(content)
+    os.rename(tmp_file, upstream_file)
+    if config.get('switch_command'):
+        try:
+            subprocess.check_call(config['switch_command'], shell=True)
+        except subprocess.CalledProcessError:
+            raise DeployError(bucket, "Failed to switch the upstream.")
+
+
+def _deploy(airship, bucket, artifact, manifest=None, checkpoint=None):
+    if checkpoint is None:
+        checkpoint = lambda bucket: None
+    hashes = {}
+    with timed_stage(bucket, 'extract'):
+        if artifact == '-':
+            sha256 = extract_artifact(bucket, sys.stdin, hashes)
+        else:
+            with open(artifact, 'rb') as f:
+                sha256 = extract_artifact(bucket, f, hashes)
+    log.info("Extracted artifact %s into bucket %r", sha256, bucket.id_)
+    if manifest is not None:
+        with timed_stage(bucket, 'link'):
+            source = delta_source(airship, exclude=bucket.id_)
+            link_unchanged_files(bucket, source, manifest, hashes)
+    save_bucket_manifest(bucket, hashes)
+    bucket.save_config(artifact_sha256=sha256)
     bucket._read_procfile()
-    bucket_setup.send(airship, bucket=bucket)
-    remove_old_buckets(bucket)
+    checkpoint(bucket)
+    with timed_stage(bucket, 'bucket_setup'):
+        bucket_setup.send(airship, bucket=bucket)
+    bucket.save_metadata()
+    checkpoint(bucket)
+
+    blue_green = airship.config.get('blue_green')
+    if blue_green:
+        bucket.save_config(slot=choose_slot(bucket))
+    check_instances(bucket)
+    if blue_green:
+        check_blue_green_ports(bucket)
+    check_resources(bucket)
+    bucket.write_launch_plan()
+    readiness = readiness_checks(bucket)
+    if blue_green:
+        check_blue_green(bucket, readiness)
+
+    if not blue_green:
+        with timed_stage(bucket, 'stop_old_buckets'):
+            old_buckets = stop_old_buckets(bucket)
     try:
-        bucket.start()
-    except SupervisorError:
-        raise DeployError(bucket, "Failed to start bucket.")
+        with timed_stage(bucket, 'start'):
+            try:
+                bucket.start()
+            except SupervisorError:
+                raise DeployError(bucket, "Failed to start bucket.")
+        if readiness:
+            with timed_stage(bucket, 'ready'):
+                wait_for_readiness(bucket, readiness)
+    except DeployError:
+        if not blue_green:
+            exc_info = sys.exc_info()
+            roll_back(bucket, old_buckets)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        raise
+    if not blue_green:
+        with timed_stage(bucket, 'remove_old_buckets'):
+            remove_old_buckets(bucket)
+
+    if blue_green:
+        timeout = blue_green.get('timeout', 30)
+        with timed_stage(bucket, 'verify'):
+            checked = set(procname for procname, _, _ in readiness)
+            for procname in blue_green['ports']:
+                if procname not in bucket.process_types or \
+                        procname in checked:
+                    continue
+                port = bucket.port_for(procname)
+                if not wait_for_port(port, timeout):
+                    raise DeployError(bucket, "Process %r is not listening "
+                                              "on port %d." % (procname, port))
+        with timed_stage(bucket, 'switch'):
+            switch_upstream(bucket)
+        with timed_stage(bucket, 'drain'):
+            time.sleep(blue_green.get('drain', 0))
+        with timed_stage(bucket, 'remove_old_buckets'):
+            remove_old_buckets(bucket)
+
+    airship.set_active_bucket(bucket.id_)
+    start_reaper(airship)
+
+
+def _cancel_if_superseded(ticket):
+    def checkpoint(bucket):
+        if ticket.superseded():
+            raise DeployCancelled(bucket, "Cancelled, a newer deployment "
+                                          "is queued.")
+    return checkpoint
+
+
+def _cancel_running(config):
+    # `deploy_queue: cancel_running` is short for `cancel_running: true`
+    setting = config.get('deploy_queue') or {}
+    if setting == 'cancel_running':
+        return True
+    return isinstance(setting, dict) and bool(setting.get('cancel_running'))
+
+
+def _build_and_start(airship, artifact, manifest, checkpoint):
+    bucket = airship.new_bucket()
+    t0 = monotonic()
+    ok = False
+    try:
+        _deploy(airship, bucket, artifact, manifest, checkpoint)
+        ok = True
+    finally:
+        duration = monotonic() - t0
+        if ok:
+            bucket.save_config(timings=bucket.timings, deploy_time=duration)
+        record_deploy(airship, bucket, duration, ok)
+    return bucket
+
+
+def deploy(airship, artifact, manifest=None):
+    """ Deploy the tarball at path `artifact`, or read it from stdin if
+    `artifact` is ``-``. With a `manifest` (see `load_manifest`), this is a
+    delta deployment: the tarball only holds changed files, the others are
+    taken from the active bucket. The duration of each stage is recorded.
+
+    Deployments run one at a time. One that waits for its turn is skipped
+    if a newer one is queued meanwhile; it then returns `None` instead of
+    the new bucket. With `deploy_queue: cancel_running`, a deployment that
+    is still being built is cancelled by a newer one. """
+    queue = DeployQueue(airship.var_path / 'deploy-queue')
+    ticket = queue.enter()
+    try:
+        if not ticket.try_lock():
+            if artifact == '-':
+                artifact = ticket.spool(sys.stdin)
+            log.info("Waiting for the running deployment to finish")
+            ticket.lock()
+        if not ticket.start():
+            log.info("Skipping deployment, a newer one is queued")
+            return None
+        checkpoint = None
+        if _cancel_running(airship.config):
+            checkpoint = _cancel_if_superseded(ticket)
+        return _build_and_start(airship, artifact, manifest, checkpoint)
+    finally:
+        ticket.close()
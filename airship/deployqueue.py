@@ -0,0 +1,115 @@
+import os
+import errno
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class DeployQueue(object):
+    """ Deployments waiting for their turn, as numbered ticket files in
+    `folder`. Only one deployment runs at a time, and a waiting one that
+    is superseded by a newer ticket, or by a newer deployment that already
+    started, is skipped. """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.started_path = folder / 'started'
+
+    @contextmanager
+    def _locked(self):
+        with open(self.folder / '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def ticket_path(self, seq):
+        return self.folder / ('%d.ticket' % seq)
+
+    def enter(self):
+        self.folder.makedirs_p()
+        with self._locked():
+            counter = self.folder / 'last'
+            seq = int(counter.text() or 0) + 1 if counter.isfile() else 1
+            counter.write_text(str(seq))
+            self.ticket_path(seq).write_text(str(os.getpid()))
+        return Ticket(self, seq)
+
+    def last_started(self):
+        """ Sequence number of the newest deployment that started. """
+        try:
+            return int(self.started_path.text() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def tickets(self):
+        """ Sequence numbers of the tickets of live processes. Tickets left
+        behind by dead processes are removed. """
+        live = []
+        for ticket_file in self.folder.files('*.ticket'):
+            try:
+                seq = int(ticket_file.namebase)
+                pid = int(ticket_file.text())
+            except (IOError, ValueError):
+                continue
+            if _alive(pid):
+                live.append(seq)
+            else:
+                ticket_file.unlink_p()
+        return sorted(live)
+
+
+class Ticket(object):
+
+    def __init__(self, queue, seq):
+        self.queue = queue
+        self.seq = seq
+        self.spool_path = queue.folder / ('%d.artifact' % seq)
+        self._lock_file = open(queue.folder / 'deploy.lock', 'a')
+
+    def try_lock(self):
+        """ Take the deploy lock if it's free; return whether we got it. """
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def lock(self):
+        """ Wait for the deploy lock. """
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def superseded(self):
+        # waiters don't get the deploy lock in order, so a newer deployment
+        # may have started, and finished, before us
+        return (self.queue.last_started() > self.seq or
+                any(seq > self.seq for seq in self.queue.tickets()))
+
+    def start(self):
+        """ Record that our deployment starts, unless it's superseded.
+        Return whether it may go on. """
+        with self.queue._locked():
+            if self.superseded():
+                return False
+            self.queue.started_path.write_text(str(self.seq))
+        return True
+
+    def spool(self, fileobj):
+        """ Save the artifact coming from `fileobj` while we wait, so that
+        the sender isn't kept waiting. """
+        with open(self.spool_path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f)
+        return self.spool_path
+
+    def close(self):
+        self._lock_file.close()
+        self.spool_path.unlink_p()
+        self.queue.ticket_path(self.seq).unlink_p()
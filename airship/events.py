@@ -0,0 +1,203 @@
+import re
+import sys
+import time
+import socket
+import select
+import xmlrpclib
+import traceback
+from datetime import datetime
+from .daemons import SupervisorError
+
+HISTORY_SIZE = 10000
+BACKOFF_DEFAULTS = {'initial': 1, 'max': 300, 'reset': 60}
+STATE_PREFIX = 'PROCESS_STATE_'
+BUCKET_GROUP = re.compile(r'^(d\d+)-(.+)$')
+
+
+def backoff_config(config):
+    """ The ``restart_backoff`` settings from `airship.yaml`, or `None` if
+    supervisord restarts processes itself. It may be `true` or a mapping
+    with `initial` and `max` delays and `reset`, the uptime in seconds
+    after which a crash counts as the first one again. """
+    value = config.get('restart_backoff')
+    if not value:
+        return None
+    settings = dict(BACKOFF_DEFAULTS)
+    if isinstance(value, dict):
+        settings.update(value)
+    return settings
+
+
+class EventLog(object):
+    """ The last `size` process state changes, in a ring buffer: event
+    number `n` is stored in slot ``n % size`` of the `events` table. """
+
+    def __init__(self, store, size=HISTORY_SIZE):
+        self.store = store
+        self.events = store.table('events')
+        self.meta = store.table('meta')
+        self.size = size
+
+    def append(self, event):
+        with self.store.transaction():
+            seq = self.meta.get('events_seq', 0) + 1
+            self.meta['events_seq'] = seq
+            self.events[seq % self.size] = dict(event, seq=seq)
+
+    def history(self, bucket_id=None, procnames=None, limit=None):
+        """ Events, oldest first, optionally only those of a bucket and
+        some of its process types. """
+        first = self.meta.get('events_seq', 0) - self.size
+        events = sorted((e for e in self.events.values() if e['seq'] > first),
+                        key=lambda e: e['seq'])
+        if bucket_id is not None:
+            events = [e for e in events if e['bucket'] == bucket_id]
+        if procnames:
+            events = [e for e in events if e['procname'] in procnames]
+        return events[-limit:] if limit else events
+
+
+def _parse_tokens(line):
+    return dict(token.split(':', 1) for token in line.split())
+
+
+class EventListener(object):
+    """ A supervisord event listener for ``PROCESS_STATE`` events. It
+    records each state change with the exit status, uptime and startup
+    time from supervisord. With ``restart_backoff``, bucket processes
+    aren't restarted by supervisord (``autorestart = false``); instead,
+    after a crash, the listener starts them again after a delay that
+    doubles with each consecutive crash. """
+
+    def __init__(self, airship, stdin=sys.stdin, stdout=sys.stdout,
+                 clock=time.time):
+        self.airship = airship
+        self.rpc = airship.daemons.rpc
+        self.stdin = stdin
+        self.stdout = stdout
+        self.clock = clock
+        self.log = EventLog(airship.store, airship.config.get(
+            'event_history', HISTORY_SIZE))
+        self.crashes = {}
+        self.pending = {}
+
+    def _process_info(self, name):
+        try:
+            return self.rpc.get_process_info(name)
+        except (SupervisorError, socket.error, xmlrpclib.ProtocolError), e:
+            print >> sys.stderr, "Can't get info on %s: %s" % (name, e)
+            return None
+
+    def _schedule_restart(self, name, uptime):
+        settings = backoff_config(self.airship.config)
+        crashes = self.crashes.get(name, 0)
+        if uptime is not None and uptime >= settings['reset']:
+            crashes = 0
+        delay = min(settings['initial'] * 2 ** crashes, settings['max'])
+        self.crashes[name] = crashes + 1
+        self.pending[name] = self.clock() + delay
+        return delay
+
+    def handle(self, eventname, payload):
+        """ Record a ``PROCESS_STATE_*`` event, and schedule a restart if
+        it's a crash. """
+        if not eventname.startswith(STATE_PREFIX):
+            return
+        state = eventname[len(STATE_PREFIX):]
+        group = payload['groupname']
+        name = '%s:%s' % (group, payload['processname'])
+        match = BUCKET_GROUP.match(group)
+        event = {
+            'time': self.clock(),
+            'bucket': match.group(1) if match else None,
+            'procname': match.group(2) if match else group,
+            'process': payload['processname'],
+            'from_state': payload.get('from_state'),
+            'state': state,
+            'pid': int(payload['pid']) if 'pid' in payload else None,
+        }
+
+        if state in ('STARTING', 'STOPPING', 'STOPPED'):
+            # started or stopped by someone else
+            self.pending.pop(name, None)
+        if state == 'RUNNING':
+            info = self._process_info(name)
+            if info is not None:
+                event['startup'] = event['time'] - info['start']
+        if state == 'EXITED':
+            event['expected'] = (payload.get('expected') == '1')
+            info = self._process_info(name)
+            if info is not None:
+                event['exit_status'] = info['exitstatus']
+                event['uptime'] = info['stop'] - info['start']
+
+        crashed = (state == 'FATAL' or
+                   (state == 'EXITED' and not event['expected']))
+        if (crashed and match and
+                backoff_config(self.airship.config) is not None):
+            event['restart_in'] = self._schedule_restart(
+                name, event.get('uptime'))
+        self.log.append(event)
+
+    def restart_due(self):
+        now = self.clock()
+        for name, when in sorted(self.pending.items()):
+            if when > now:
+                continue
+            del self.pending[name]
+            try:
+                self.rpc.start_process(name, False)
+            except (SupervisorError, socket.error,
+                    xmlrpclib.ProtocolError), e:
+                # e.g. the bucket was removed meanwhile
+                print >> sys.stderr, "Can't restart %s: %s" % (name, e)
+
+    def _wait_for_event(self):
+        """ Wait until an event arrives, restarting processes when their
+        time comes. """
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(min(self.pending.values()) - self.clock(), 0)
+            if select.select([self.stdin], [], [], timeout)[0]:
+                return
+            self.restart_due()
+
+    def serve_forever(self):
+        while True:
+            self.stdout.write('READY\n')
+            self.stdout.flush()
+            self._wait_for_event()
+            header_line = self.stdin.readline()
+            if not header_line:
+                return  # supervisord is gone
+            headers = _parse_tokens(header_line)
+            payload = self.stdin.read(int(headers['len']))
+            try:
+                self.airship.refresh_config()
+                self.handle(headers['eventname'], _parse_tokens(payload))
+            except Exception:
+                traceback.print_exc()
+            self.stdout.write('RESULT 2\nOK')
+            self.stdout.flush()
+
+
+def format_events(events):
+    lines = []
+    for event in events:
+        details = []
+        if 'exit_status' in event:
+            details.append('exit status %d' % event['exit_status'])
+        if 'uptime' in event:
+            details.append('up %.1fs' % event['uptime'])
+        if 'startup' in event:
+            details.append('started in %.1fs' % event['startup'])
+        if 'restart_in' in event:
+            details.append('restart in %ds' % event['restart_in'])
+        lines.append('%s %-6s %-24s %s -> %s%s' % (
+            datetime.fromtimestamp(event['time']).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            event['bucket'] or '-', event['process'],
+            event['from_state'], event['state'],
+            '  (%s)' % ', '.join(details) if details else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,29 @@
+import json
+from .store import Table
+
+
+class BucketIndex(Table):
+    """ Maps bucket sequence numbers to bucket IDs. The sequence number is
+    the table's primary key, so lookups at either end and range queries
+    use the index instead of scanning every bucket. """
+
+    def __init__(self, store, table='bucket_index'):
+        super(BucketIndex, self).__init__(store, table)
+
+    def newest(self):
+        [bucket_id] = self.history(limit=1) or [None]
+        return bucket_id
+
+    def history(self, before=None, limit=None):
+        """ Bucket IDs, newest first, optionally only those with sequence
+        numbers lower than `before`. """
+        query = 'SELECT value FROM %s' % self._table
+        args = []
+        if before is not None:
+            query += ' WHERE key < ?'
+            args.append(before)
+        query += ' ORDER BY key DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+        return [json.loads(value) for [value] in self._execute(query, args)]
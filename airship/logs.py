@@ -0,0 +1,230 @@
+import os
+import re
+import sys
+import time
+import gzip
+import shutil
+import select
+import struct
+from path import path
+
+TIMESTAMP = re.compile(r'^\[?(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:[.,]\d+)?)')
+BLOCK_SIZE = 8192
+POLL_INTERVAL = 1
+COMPRESSING = '.compressing'
+
+
+def bucket_log_files(bucket, procnames=None):
+    """ Log files of the bucket's processes, as ``(name, path)`` pairs. """
+    log_dir = bucket.airship.log_path
+    files = []
+    for procname in sorted(procnames or bucket.process_types):
+        name = '%s-%s' % (bucket.id_, procname)
+        if bucket.instances(procname) == 1:
+            files.append((procname, log_dir / (name + '.log')))
+        else:
+            for n in range(bucket.instances(procname)):
+                files.append(('%s_%02d' % (procname, n),
+                              log_dir / ('%s_%02d.log' % (name, n))))
+    return files
+
+
+def tail_lines(file_path, count):
+    """ Return the last `count` lines of a file, reading blocks backwards
+    from the end, and the file size. """
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = pos = f.tell()
+        data = ''
+        while pos > 0 and data.count('\n') <= count:
+            step = min(BLOCK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines(True)
+    return lines[-count:] if count else [], end
+
+
+def merge_by_timestamp(sources):
+    """ Merge lists of lines from several sources, ordered by the timestamp
+    at the start of each line. Lines without a timestamp stay after the
+    line before them. Yields ``(source_name, line)``. """
+    keyed = []
+    for source_index, (name, lines) in enumerate(sources):
+        timestamp = ''
+        for line_index, line in enumerate(lines):
+            match = TIMESTAMP.match(line)
+            if match is not None:
+                timestamp = match.group(1).replace('T', ' ').replace(',', '.')
+            keyed.append((timestamp, source_index, line_index, name, line))
+    keyed.sort()
+    return [(name, line) for _, _, _, name, line in keyed]
+
+
+class _Inotify(object):
+    """ Minimal inotify binding: wakes up when one of `names` in a folder
+    changes. """
+
+    IN_MODIFY = 0x002
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, folder, names):
+        self.names = set(names)
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError("inotify_init failed")
+        mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, str(folder), mask) < 0:
+            os.close(self.fd)
+            raise OSError("inotify_add_watch failed")
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while select.select([self.fd], [], [], timeout)[0]:
+            if self.names & set(self._read_names()):
+                return
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return
+
+    def _read_names(self):
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            _, _, _, size = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            yield data[offset:offset + size].rstrip('\0')
+            offset += size
+
+
+class _Sleeper(object):
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+
+class _FollowedFile(object):
+
+    def __init__(self, name, file_path, offset):
+        self.name = name
+        self.path = file_path
+        self.file = None
+        self.partial = ''
+        if file_path.isfile():
+            self.file = open(file_path, 'rb')
+            self.file.seek(offset)
+
+    def read_lines(self):
+        lines = []
+        if self.file is not None:
+            lines += self._read()
+            try:
+                rotated = os.fstat(self.file.fileno()).st_ino != \
+                    os.stat(self.path).st_ino
+            except OSError:
+                rotated = False
+            if not rotated:
+                return lines
+            self.file.close()
+            self.file = None
+        if self.path.isfile():
+            self.file = open(self.path, 'rb')
+            lines += self._read()
+        return lines
+
+    def _read(self):
+        # seeking in place clears the EOF flag of python 2 file objects
+        self.file.seek(0, os.SEEK_CUR)
+        data = self.partial + self.file.read()
+        lines = data.splitlines(True)
+        if lines and not lines[-1].endswith('\n'):
+            self.partial = lines.pop()
+        else:
+            self.partial = ''
+        return lines
+
+
+def show_logs(files, count=10, follow=False, out=None):
+    """ Print the last `count` lines of the log files, merged, then, if
+    `follow` is set, new lines as they are written. """
+    if out is None:
+        out = sys.stdout
+    show_names = len(files) > 1
+    width = max(len(name) for name, _ in files) if files else 0
+
+    def write(name, line):
+        if show_names:
+            out.write('%-*s | ' % (width, name))
+        out.write(line)
+
+    sources = []
+    followed = []
+    for name, file_path in files:
+        lines, end = tail_lines(file_path, count) if file_path.isfile() \
+            else ([], 0)
+        sources.append((name, lines))
+        followed.append(_FollowedFile(name, file_path, end))
+    for name, line in merge_by_timestamp(sources)[-count:] if count else []:
+        write(name, line)
+    out.flush()
+    if not follow or not files:
+        return
+
+    try:
+        waiter = _Inotify(files[0][1].parent,
+                          [file_path.name for _, file_path in files])
+    except (OSError, AttributeError):
+        waiter = _Sleeper()
+    while True:
+        waiter.wait(POLL_INTERVAL)
+        for followed_file in followed:
+            for line in followed_file.read_lines():
+                write(followed_file.name, line)
+        out.flush()
+
+
+def compress_rotated_logs(log_dir, backups):
+    """ Compress log files rotated by supervisord (``name.log.N``) into
+    ``name.log.<timestamp>.gz`` and keep the newest `backups` of them.
+    With `backups` set to 0, supervisord doesn't rotate, so the files are
+    someone else's (e.g. `logrotate`'s) and are left alone. """
+    if not backups:
+        return
+    # move each file out of supervisord's way first: if it rotates while
+    # we compress, `name.log.N` is another file by the time we're done
+    for log_file in log_dir.files('*.log.*'):
+        if log_file.name.rsplit('.', 1)[-1].isdigit():
+            log_file.rename(log_file + COMPRESSING)
+    bases = set()
+    # oldest first (``.N`` with the highest N), so that a file rotated in
+    # the same second as an earlier one gets a later name: ``_01``, ...
+    pending = []
+    for log_file in log_dir.files('*.log.*' + COMPRESSING):
+        base, number = log_file[:-len(COMPRESSING)].rsplit('.', 1)
+        order = -int(number) if number.isdigit() else 0
+        pending.append((log_file.mtime, order, base, log_file))
+    for mtime, _, base, log_file in sorted(pending):
+        bases.add(base)
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(mtime))
+        target = path('%s.%s.gz' % (base, stamp))
+        counter = 0
+        while target.exists():
+            counter += 1
+            target = path('%s.%s_%02d.gz' % (base, stamp, counter))
+        tmp_target = target + '.tmp'
+        with open(log_file, 'rb') as src:
+            with gzip.open(tmp_target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        os.utime(tmp_target, (mtime, mtime))
+        os.rename(tmp_target, target)
+        log_file.unlink()
+    for base in bases:
+        archives = sorted(path(base).parent.files(path(base).name + '.*.gz'))
+        for old in archives[:-backups]:
+            old.unlink()
@@ -0,0 +1,230 @@
+import os
+from .stats import monotonic
+
+PROC = '/proc'
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+FIELDS = ['cpu', 'rss', 'pss', 'fds', 'read_rate', 'write_rate']
+
+PROMETHEUS_METRICS = [
+    ('processes', 'airship_processes', "Number of processes."),
+    ('cpu', 'airship_cpu_percent', "CPU usage, in percent of one CPU."),
+    ('rss', 'airship_resident_memory_bytes', "Resident memory."),
+    ('pss', 'airship_proportional_memory_bytes',
+     "Resident memory, with shared pages divided among their users."),
+    ('fds', 'airship_open_fds', "Open file descriptors."),
+    ('read_rate', 'airship_read_bytes_per_second', "Reads from storage."),
+    ('write_rate', 'airship_write_bytes_per_second', "Writes to storage."),
+]
+
+
+def _read(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def read_stat(pid, proc=PROC):
+    """ ``(ppid, cpu ticks, start time, rss in bytes)`` from
+    ``/proc/<pid>/stat``, or `None` if the process is gone. """
+    data = _read('%s/%d/stat' % (proc, pid))
+    if not data:
+        return None
+    # the command name, in parentheses, may contain anything
+    fields = data[data.rindex(')') + 2:].split()
+    return (int(fields[1]), int(fields[11]) + int(fields[12]),
+            int(fields[19]), int(fields[21]) * PAGE_SIZE)
+
+
+def process_table(proc=PROC):
+    """ ``{pid: stat}`` for every process, see `read_stat`. """
+    table = {}
+    for name in os.listdir(proc):
+        if name.isdigit():
+            stat = read_stat(int(name), proc)
+            if stat is not None:
+                table[int(name)] = stat
+    return table
+
+
+def with_descendants(table, roots):
+    """ Extend ``{pid: label}`` to the descendants of each pid, which get
+    the label of their ancestor. """
+    children = {}
+    for pid, stat in table.items():
+        children.setdefault(stat[0], []).append(pid)
+    result = {}
+    pending = [(pid, label) for pid, label in roots.items() if pid in table]
+    while pending:
+        pid, label = pending.pop()
+        if pid not in result:
+            result[pid] = label
+            pending.extend((child, label) for child in children.get(pid, []))
+    return result
+
+
+def _io(pid, proc):
+    """ Bytes read from and written to storage, or `None`s if we may not
+    know. """
+    counters = {}
+    for line in (_read('%s/%d/io' % (proc, pid)) or '').splitlines():
+        name, _, value = line.partition(':')
+        counters[name] = value
+    try:
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (KeyError, ValueError):
+        return None, None
+
+
+def _fd_count(pid, proc):
+    try:
+        return len(os.listdir('%s/%d/fd' % (proc, pid)))
+    except OSError:
+        return None
+
+
+def _pss(pid, proc):
+    for line in (_read('%s/%d/smaps_rollup' % (proc, pid)) or '').splitlines():
+        if line.startswith('Pss:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+class Sampler(object):
+    """ Samples the resource usage of processes and their descendants. CPU
+    and I/O rates are measured since the previous sample of the same
+    process, so they are `None` in the first one. PSS is costly for the
+    kernel to compute, so it's only read if `pss` is set. """
+
+    def __init__(self, pss=False, proc=PROC, clock=monotonic):
+        self.pss = pss
+        self.proc = proc
+        self.clock = clock
+        self._previous = {}
+
+    def sample(self, roots):
+        """ Sample the processes in `roots`, ``{pid: (bucket_id,
+        procname)}``, and their descendants. """
+        now = self.clock()
+        table = process_table(self.proc)
+        current = {}
+        processes = []
+        for pid, (bucket_id, procname) in sorted(
+                with_descendants(table, roots).items()):
+            ticks, start, rss = table[pid][1:]
+            read_bytes, write_bytes = _io(pid, self.proc)
+            # (pid, start time) tells apart processes that reuse a pid
+            current[pid, start] = (now, ticks, read_bytes, write_bytes)
+            info = {
+                'pid': pid,
+                'bucket': bucket_id,
+                'procname': procname,
+                'rss': rss,
+                'pss': _pss(pid, self.proc) if self.pss else None,
+                'fds': _fd_count(pid, self.proc),
+                'cpu': None,
+                'read_rate': None,
+                'write_rate': None,
+            }
+            previous = self._previous.get((pid, start))
+            if previous is not None and now > previous[0]:
+                elapsed = now - previous[0]
+                info['cpu'] = (100.0 * (ticks - previous[1]) / CLK_TCK /
+                               elapsed)
+                if read_bytes is not None and previous[2] is not None:
+                    info['read_rate'] = (read_bytes - previous[2]) / elapsed
+                    info['write_rate'] = (write_bytes - previous[3]) / elapsed
+            processes.append(info)
+        self._previous = current
+        return processes
+
+
+def bucket_roots(airship):
+    """ ``{pid: (bucket_id, procname)}`` of the buckets' processes that
+    supervisord is running, or `None` if supervisord can't tell. """
+    processes = airship.daemons.process_info()
+    if processes is None:
+        return None
+    bucket_ids = set(airship.buckets_db)
+    roots = {}
+    for info in processes:
+        bucket_id, _, procname = info['group'].partition('-')
+        if info['pid'] and bucket_id in bucket_ids:
+            roots[info['pid']] = (bucket_id, procname)
+    return roots
+
+
+def summarize(processes):
+    """ Totals per process type and per bucket: ``{bucket_id: {'total':
+    totals, 'types': {procname: totals}}}``. A total is `None` if no
+    process has a value for it. """
+    def add(totals, info):
+        totals['processes'] += 1
+        for field in FIELDS:
+            if info[field] is not None:
+                totals[field] = (totals[field] or 0) + info[field]
+
+    new_totals = lambda: dict(dict.fromkeys(FIELDS), processes=0)
+    summary = {}
+    for info in processes:
+        bucket = summary.setdefault(info['bucket'], {'total': new_totals(),
+                                                     'types': {}})
+        add(bucket['total'], info)
+        add(bucket['types'].setdefault(info['procname'], new_totals()), info)
+    return summary
+
+
+def _size(value):
+    if value is None:
+        return '-'
+    for unit in ['', 'K', 'M', 'G']:
+        if value < 1024:
+            break
+        value /= 1024.0
+    else:
+        unit = 'T'
+    return ('%d%s' if unit == '' else '%.1f%s') % (value, unit)
+
+
+def format_table(summary):
+    header = ('bucket', 'type', 'procs', 'cpu%', 'rss', 'pss', 'fds',
+              'read/s', 'write/s')
+    lines = ['%-8s %-20s %5s %7s %8s %8s %6s %8s %8s' % header]
+    for bucket_id in sorted(summary, key=lambda b: -int(b[1:])):
+        rows = sorted(summary[bucket_id]['types'].items())
+        rows.append(('(total)', summary[bucket_id]['total']))
+        for procname, totals in rows:
+            cpu = totals['cpu']
+            lines.append('%-8s %-20s %5d %7s %8s %8s %6s %8s %8s' % (
+                bucket_id, procname, totals['processes'],
+                '-' if cpu is None else '%.1f' % cpu,
+                _size(totals['rss']), _size(totals['pss']),
+                '-' if totals['fds'] is None else totals['fds'],
+                _size(totals['read_rate']), _size(totals['write_rate'])))
+    return '\n'.join(lines)
+
+
+def _prometheus_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_prometheus(summary):
+    """ Per process type totals in the Prometheus text format. """
+    lines = []
+    for field, name, help_text in PROMETHEUS_METRICS:
+        samples = [(bucket_id, procname, totals[field])
+                   for bucket_id in sorted(summary)
+                   for procname, totals in
+                   sorted(summary[bucket_id]['types'].items())
+                   if totals[field] is not None]
+        if not samples:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s gauge' % name)
+        for bucket_id, procname, value in samples:
+            lines.append('%s{bucket="%s",process_type="%s"} %s'
+                         % (name, bucket_id, procname,
+                            _prometheus_value(value)))
+    return ''.join(line + '\n' for line in lines)
@@ -0,0 +1,118 @@
+import os
+import time
+import signal
+import socket
+import httplib
+import tempfile
+import subprocess
+
+DEFAULT_TIMEOUT = 30
+FIRST_DELAY = 0.05
+MAX_DELAY = 1
+# the last attempt starts at the deadline; let a command run that long
+MIN_COMMAND_TIME = 1
+
+
+class NotReady(Exception):
+    """ A readiness check failed; the message says why. """
+
+
+def check_tcp(port, host='127.0.0.1'):
+    try:
+        socket.create_connection((host, port), 1).close()
+    except socket.error, e:
+        raise NotReady("can't connect to port %d: %s" % (port, e))
+
+
+def check_http(port, url_path, host='127.0.0.1'):
+    conn = httplib.HTTPConnection(host, port, timeout=5)
+    try:
+        conn.request('GET', url_path)
+        status = conn.getresponse().status
+    except (socket.error, httplib.HTTPException), e:
+        raise NotReady("GET %s on port %d failed: %s" % (url_path, port, e))
+    finally:
+        conn.close()
+    if status >= 400:
+        raise NotReady("GET %s on port %d returned %d"
+                       % (url_path, port, status))
+
+
+def check_command(command, cwd, environ, deadline=None):
+    """ Run `command`; if it still runs at `deadline` (or after
+    `MIN_COMMAND_TIME`, if later), kill it along with its children. """
+    if deadline is not None:
+        deadline = max(deadline, time.time() + MIN_COMMAND_TIME)
+    with tempfile.TemporaryFile() as output_file:
+        p = subprocess.Popen(['/bin/bash', '-c', command], cwd=cwd,
+                             env=environ, stdout=output_file,
+                             stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        while p.poll() is None:
+            if deadline is not None and time.time() >= deadline:
+                os.killpg(p.pid, signal.SIGKILL)
+                p.wait()
+                raise NotReady("%r was still running at the timeout"
+                               % command)
+            time.sleep(FIRST_DELAY)
+        output_file.seek(0)
+        output = output_file.read()
+    if p.returncode != 0:
+        raise NotReady("%r exited with %d: %s"
+                       % (command, p.returncode, output.strip()))
+
+
+def bucket_checks(bucket, procname, config):
+    """ The checks for each instance of a process type, as functions that
+    take the deadline and raise `NotReady`. `config` has one of `tcp`
+    (connect to ``PORT``), `http` (a path to GET on ``PORT``) or `command`
+    (a shell command run with the process' environment). With socket
+    activation, the socket holder accepts connections on ``PORT`` whether
+    or not the process is up, so `tcp` checks are refused. """
+    checks = []
+    port = bucket.port_for(procname)
+    for instance in range(bucket.instances(procname)):
+        if 'command' in config:
+            environ = bucket._prepare_run(procname, instance)[1]
+            checks.append(lambda deadline, environ=environ: check_command(
+                config['command'], bucket.folder, environ, deadline))
+            continue
+        if port is None:
+            raise ValueError("Process type %r has no port to check"
+                             % procname)
+        if 'http' in config:
+            checks.append(lambda deadline, port=port + instance: check_http(
+                port, config['http']))
+        elif config.get('tcp'):
+            if bucket.airship.config.get('socket_activation'):
+                raise ValueError("A tcp check always passes with "
+                                 "socket_activation; use http or command "
+                                 "for %r" % procname)
+            checks.append(lambda deadline, port=port + instance:
+                          check_tcp(port))
+        else:
+            raise ValueError("Unknown readiness check for %r" % procname)
+    return checks
+
+
+def wait_until_ready(checks, deadline, sleep=time.sleep, clock=time.time):
+    """ Run the checks until they all pass, waiting longer and longer
+    between attempts. Raise `NotReady`, with the last failure, if they
+    don't pass before `deadline`. """
+    delay = FIRST_DELAY
+    pending = list(checks)
+    while True:
+        failure = None
+        for check in list(pending):
+            try:
+                check(deadline)
+            except NotReady, e:
+                failure = e
+            else:
+                pending.remove(check)
+        if not pending:
+            return
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise failure
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, MAX_DELAY)
@@ -0,0 +1,126 @@
+import os
+import resource
+import subprocess
+from distutils.spawn import find_executable
+
+SETTINGS = ['cpu_affinity', 'nice', 'ionice', 'nofile', 'oom_score_adj']
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+CPU_SETSIZE = 1024
+
+
+def _is_int(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def _cpu_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _parse_ionice(value):
+    """ ``<class>`` or ``<class> <level>``, e.g. ``idle`` or ``best-effort
+    7``. Return ``(class number, level or None)``. """
+    parts = str(value).split()
+    if not parts or len(parts) > 2 or parts[0] not in IONICE_CLASSES:
+        raise ValueError("ionice must be one of %s, optionally followed by "
+                         "a level, not %r"
+                         % (', '.join(sorted(IONICE_CLASSES)), value))
+    level = None
+    if len(parts) == 2:
+        if not parts[1].isdigit() or int(parts[1]) > 7:
+            raise ValueError("ionice level must be 0 to 7, not %r"
+                             % parts[1])
+        level = int(parts[1])
+    return IONICE_CLASSES[parts[0]], level
+
+
+def check_settings(settings):
+    """ Raise `ValueError` if `settings` are invalid, or can't be applied
+    with our privileges; processes run as the same user as deployments. """
+    if not isinstance(settings, dict):
+        raise ValueError("expected a mapping of settings, not %r"
+                         % (settings,))
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise ValueError("unknown settings: %s" % ', '.join(sorted(unknown)))
+    privileged = (os.geteuid() == 0)
+
+    if 'cpu_affinity' in settings:
+        cpus = _cpu_list(settings['cpu_affinity'])
+        cpu_count = os.sysconf('SC_NPROCESSORS_CONF')
+        if not cpus or not all(_is_int(cpu) and 0 <= cpu < cpu_count
+                               for cpu in cpus):
+            raise ValueError("cpu_affinity must be CPU numbers from 0 to %d, "
+                             "not %r" % (cpu_count - 1,
+                                         settings['cpu_affinity']))
+
+    if 'nice' in settings:
+        nice = settings['nice']
+        if not _is_int(nice) or not -20 <= nice <= 19:
+            raise ValueError("nice must be -20 to 19, not %r" % (nice,))
+        if nice < os.nice(0) and not privileged:
+            raise ValueError("nice %d is below our own (%d); only root can "
+                             "do that" % (nice, os.nice(0)))
+
+    if 'ionice' in settings:
+        ionice_class, _ = _parse_ionice(settings['ionice'])
+        if ionice_class == IONICE_CLASSES['realtime'] and not privileged:
+            raise ValueError("only root can use the realtime ionice class")
+        if not find_executable('ionice'):
+            raise ValueError("ionice needs the ionice command, which is not "
+                             "in PATH")
+
+    if 'nofile' in settings:
+        nofile = settings['nofile']
+        if not _is_int(nofile) or nofile <= 0:
+            raise ValueError("nofile must be a positive number, not %r"
+                             % (nofile,))
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if (hard != resource.RLIM_INFINITY and nofile > hard and
+                not privileged):
+            raise ValueError("nofile %d is above the hard limit (%d)"
+                             % (nofile, hard))
+
+    if 'oom_score_adj' in settings:
+        score = settings['oom_score_adj']
+        if not _is_int(score) or not -1000 <= score <= 1000:
+            raise ValueError("oom_score_adj must be -1000 to 1000, not %r"
+                             % (score,))
+        if score < 0 and not privileged:
+            raise ValueError("only root can set a negative oom_score_adj")
+
+
+def _set_cpu_affinity(cpus):
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    word_bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE / word_bits))()
+    for cpu in cpus:
+        mask[cpu // word_bits] |= 1 << (cpu % word_bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, "can't set CPU affinity: %s"
+                             % os.strerror(errno))
+
+
+def apply_settings(settings):
+    """ Apply `settings` to the current process. They are kept across
+    `exec`, so this is done just before exec-ing the process. """
+    if 'nofile' in settings:
+        nofile = settings['nofile']
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if hard != resource.RLIM_INFINITY and hard < nofile:
+            hard = nofile
+        resource.setrlimit(resource.RLIMIT_NOFILE, (nofile, hard))
+    if 'nice' in settings:
+        os.nice(settings['nice'] - os.nice(0))
+    if 'cpu_affinity' in settings:
+        _set_cpu_affinity(_cpu_list(settings['cpu_affinity']))
+    if 'ionice' in settings:
+        ionice_class, level = _parse_ionice(settings['ionice'])
+        args = ['ionice', '-c', str(ionice_class)]
+        if level is not None:
+            args += ['-n', str(level)]
+        subprocess.check_call(args + ['-p', str(os.getpid())])
+    if 'oom_score_adj' in settings:
+        with open('/proc/self/oom_score_adj', 'wb') as f:
+            f.write(str(settings['oom_score_adj']))
@@ -0,0 +1,175 @@
+import os
+import sys
+import time
+import select
+import socket
+from path import path
+
+LISTEN_FDS_START = 3
+HOLDER_WAIT = 5  # seconds to wait for the holder to come up
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_BACKLOG = 1024
+
+
+def activation_config(config):
+    """ The ``socket_activation`` settings from `airship.yaml`, or `None` if
+    socket activation is disabled. It may be `true` or a mapping with
+    `host` and `backlog`. """
+    value = config.get('socket_activation')
+    if not value:
+        return None
+    settings = {'host': DEFAULT_HOST, 'backlog': DEFAULT_BACKLOG}
+    if isinstance(value, dict):
+        settings.update(value)
+    return settings
+
+
+def holder_path(airship_home):
+    return path(airship_home) / 'var' / 'run' / 'sockets.sock'
+
+
+# `_multiprocessing` calls sendmsg/recvmsg on the raw file descriptor,
+# ignoring socket timeouts
+def _sendfd(conn, fd):
+    import _multiprocessing
+    conn.setblocking(1)
+    _multiprocessing.sendfd(conn.fileno(), fd)
+
+
+def _recvfd(conn, timeout):
+    import _multiprocessing
+    if not select.select([conn], [], [], timeout)[0]:
+        raise socket.error("timed out waiting for the socket")
+    return _multiprocessing.recvfd(conn.fileno())
+
+
+def _read_line(conn):
+    # byte by byte, so that we don't read past the line
+    line = ''
+    while not line.endswith('\n'):
+        char = conn.recv(1)
+        if not char:
+            break
+        line += char
+    return line.strip()
+
+
+class SocketHolder(object):
+    """ Binds listening sockets, once per port, and passes them to the
+    processes of every bucket, so that restarts and deployments never close
+    a port. A client sends a port number over the unix socket and gets
+    ``ok`` followed by the file descriptor, or an error message. """
+
+    def __init__(self, socket_path, host=DEFAULT_HOST,
+                 backlog=DEFAULT_BACKLOG):
+        self.socket_path = path(socket_path)
+        self.host = host
+        self.backlog = backlog
+        self.sockets = {}
+        self.server = None
+
+    def bind(self, port):
+        if port not in self.sockets:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((self.host, port))
+                sock.listen(self.backlog)
+            except socket.error:
+                sock.close()
+                raise
+            self.sockets[port] = sock
+        return self.sockets[port]
+
+    def listen(self):
+        self.socket_path.parent.makedirs_p()
+        self.socket_path.unlink_p()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(16)
+
+    def handle_request(self):
+        conn, _ = self.server.accept()
+        try:
+            conn.settimeout(5)
+            request = _read_line(conn)
+            try:
+                sock = self.bind(int(request))
+            except ValueError:
+                conn.sendall('error: bad request %r\n' % request)
+            except socket.error, e:
+                conn.sendall('error: port %s: %s\n' % (request, e))
+            else:
+                conn.sendall('ok\n')
+                _sendfd(conn, sock.fileno())
+        except socket.error:
+            pass  # the client went away
+        finally:
+            conn.close()
+
+    def serve_forever(self, ports=()):
+        for port in ports:
+            try:
+                self.bind(port)
+            except socket.error, e:
+                print >> sys.stderr, "Can't bind port %d: %s" % (port, e)
+        self.listen()
+        while True:
+            self.handle_request()
+
+
+def receive_socket(socket_path, port, wait=HOLDER_WAIT):
+    """ Get the listening socket for `port` from the holder, as a file
+    descriptor. Raise `socket.error` if the holder can't provide it. """
+    deadline = time.time() + wait
+    while True:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(socket_path)
+            break
+        except socket.error:
+            conn.close()
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.1)
+    try:
+        conn.settimeout(wait)
+        conn.sendall('%d\n' % port)
+        status = _read_line(conn)
+        if status != 'ok':
+            raise socket.error(status or "no answer from socket holder")
+        return _recvfd(conn, wait)
+    finally:
+        conn.close()
+
+
+def inherit_socket(socket_path, port, environ):
+    """ Make the socket for `port` file descriptor 3 of this process and
+    announce it in `environ`, for a process about to `exec`. If the holder
+    is unavailable, the process is left to bind `PORT` itself. """
+    try:
+        fd = receive_socket(socket_path, port)
+    except socket.error, e:
+        print >> sys.stderr, ("airship: no socket for port %d (%s), "
+                              "the process will bind it" % (port, e))
+        return
+    if fd != LISTEN_FDS_START:
+        os.dup2(fd, LISTEN_FDS_START)
+        os.close(fd)
+    environ['LISTEN_FDS'] = '1'
+    environ['LISTEN_PID'] = str(os.getpid())
+
+
+def activation_ports(config):
+    """ Ports to bind when the holder starts: those of `port_map` and of
+    blue/green slots, one per instance. """
+    ports = set()
+    instances = config.get('instances') or {}
+    port_lists = [(procname, [port]) for procname, port
+                  in (config.get('port_map') or {}).items()]
+    port_lists += ((config.get('blue_green') or {}).get('ports') or {}).items()
+    for procname, base_ports in port_lists:
+        for base_port in base_ports:
+            for n in range(instances.get(procname, 1)):
+                ports.add(base_port + n)
+    return sorted(ports)
@@ -0,0 +1,101 @@
+import time
+from contextlib import contextmanager
+
+DEPLOY_HISTORY_SIZE = 100
+
+
+def _get_monotonic():
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6')
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            t = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError):
+        return time.time
+
+
+monotonic = _get_monotonic()
+
+
+@contextmanager
+def timed_stage(bucket, name):
+    """ Time a stage of deploying `bucket`. Plugins can time their own
+    sub-stages from `bucket_setup` handlers::
+
+        with timed_stage(bucket, 'myplugin.assets'):
+            build_assets(bucket)
+    """
+    t0 = monotonic()
+    try:
+        yield
+    finally:
+        bucket.timings.append([name, monotonic() - t0])
+
+
+def record_deploy(airship, bucket, duration, ok):
+    """ Add a deployment to the bounded history in `meta_db`. """
+    entry = {
+        'bucket': bucket.id_,
+        'ok': ok,
+        'total': duration,
+        'timings': bucket.timings,
+    }
+    with airship.meta_db.lock():
+        history = airship.meta_db.get('deploy_history', [])
+        history.append(entry)
+        airship.meta_db['deploy_history'] = history[-DEPLOY_HISTORY_SIZE:]
+
+
+def percentile(sorted_values, p):
+    index = max(int(round(p / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+
+def deploy_stats(history):
+    """ Percentiles of the duration of each stage, over a list of deploy
+    history entries. """
+    durations = {}
+    for entry in history:
+        durations.setdefault('total', []).append(entry['total'])
+        for name, seconds in entry['timings']:
+            durations.setdefault(name, []).append(seconds)
+    stats = {}
+    for name, values in durations.items():
+        values.sort()
+        stats[name] = {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': values[-1],
+        }
+    return stats
+
+
+def format_table(stats):
+    lines = ['%-30s %6s %9s %9s %9s %9s'
+             % ('stage', 'count', 'p50', 'p90', 'p99', 'max')]
+    for name in sorted(stats, key=lambda n: -stats[n]['p50']):
+        row = stats[name]
+        lines.append('%-30s %6d %9.3f %9.3f %9.3f %9.3f'
+                     % (name, row['count'], row['p50'], row['p90'],
+                        row['p99'], row['max']))
+    return '\n'.join(lines)
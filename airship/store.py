@@ -0,0 +1,160 @@
+import json
+import sqlite3
+import threading
+from collections import MutableMapping
+from contextlib import contextmanager
+from path import path
+
+# 1: WAL; 2: events; 3: buckets from before the index are indexed
+SCHEMA_VERSION = 3
+BUSY_TIMEOUT = 30  # seconds
+TABLES = ['bucket', 'meta', 'bucket_index', 'events']
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class Store(object):
+    """ A sqlite database in WAL mode, so that readers never wait for a
+    writer. One connection is shared by everything in the process; see
+    `open_store`. Writes made inside `transaction` are committed together.
+    """
+
+    def __init__(self, db_path, read_only=False):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT,
+                                   check_same_thread=False)
+        self._db.isolation_level = None
+        self._lock = threading.RLock()
+        self._depth = 0
+        [[version]] = self._db.execute('PRAGMA user_version')
+        if version < SCHEMA_VERSION:
+            self._create_schema()
+        self.read_only = False
+        self.set_read_only(read_only)
+
+    def _create_schema(self):
+        # the layout of `kv.KV` tables, so existing databases keep working
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self.transaction():
+            for table in TABLES:
+                self._db.execute('CREATE TABLE IF NOT EXISTS %s '
+                                 '(key PRIMARY KEY, value)' % table)
+            self._index_buckets()
+            self._db.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+    def _index_buckets(self):
+        # buckets created before `bucket_index` existed, or by a version
+        # that only indexed them on demand
+        rows = self._db.execute('SELECT key FROM bucket').fetchall()
+        for [bucket_id] in rows:
+            self._db.execute('INSERT OR IGNORE INTO bucket_index '
+                             'VALUES (?, ?)',
+                             (int(bucket_id[1:]), json.dumps(bucket_id)))
+
+    def set_read_only(self, read_only):
+        """ A read-only store refuses writes and never takes write
+        locks. """
+        if read_only != self.read_only:
+            self._db.execute('PRAGMA query_only=%d' % read_only)
+            self.read_only = read_only
+        if not read_only:
+            # safe with WAL: a crash may lose the last commits, not corrupt
+            self._db.execute('PRAGMA synchronous=NORMAL')
+
+    def execute(self, *args):
+        with self._lock:
+            return self._db.execute(*args).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """ Group writes in one transaction. Transactions nest: only the
+        outermost one commits. """
+        with self._lock:
+            if not self._depth:
+                self._db.execute('BEGIN IMMEDIATE TRANSACTION')
+            self._depth += 1
+            try:
+                yield
+            except:
+                self._depth -= 1
+                if not self._depth:
+                    self._db.execute('ROLLBACK')
+                raise
+            else:
+                self._depth -= 1
+                if not self._depth:
+                    self._db.execute('COMMIT')
+
+    def table(self, name):
+        return Table(self, name)
+
+    def close(self):
+        self._db.close()
+
+
+def open_store(db_path, read_only=False):
+    """ The process-wide `Store` for `db_path`. A store opened read-only is
+    made writable if it's opened again for writing. """
+    key = path(db_path).abspath()
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = Store(key, read_only)
+        elif store.read_only and not read_only:
+            store.set_read_only(False)
+        return store
+
+
+def close_stores():
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
+
+class Table(MutableMapping):
+    """ A table of a `Store` as a mapping of JSON values, compatible with
+    `kv.KV`. """
+
+    def __init__(self, store, name):
+        self.store = store
+        self._table = name
+
+    def _execute(self, *args):
+        return self.store.execute(*args)
+
+    def lock(self):
+        return self.store.transaction()
+
+    def __len__(self):
+        [[n]] = self._execute('SELECT COUNT(*) FROM %s' % self._table)
+        return n
+
+    def __getitem__(self, key):
+        rows = self._execute('SELECT value FROM %s WHERE key=?'
+                             % self._table, (key,))
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def __iter__(self):
+        return iter([key for [key] in
+                     self._execute('SELECT key FROM %s' % self._table)])
+
+    def __contains__(self, key):
+        return bool(self._execute('SELECT 1 FROM %s WHERE key=?'
+                                  % self._table, (key,)))
+
+    def __setitem__(self, key, value):
+        self._execute('INSERT OR REPLACE INTO %s VALUES (?, ?)'
+                      % self._table, (key, json.dumps(value)))
+
+    def __delitem__(self, key):
+        with self.lock():
+            if key not in self:
+                raise KeyError(key)
+            self._execute('DELETE FROM %s WHERE key=?' % self._table, (key,))
+
+    def clear(self):
+        self._execute('DELETE FROM %s' % self._table)
@@ -0,0 +1,245 @@
+""" Micro-benchmarks for core bucket operations.
+
+Runs offline: supervisorctl is never invoked. Prints the results as JSON
+and, given a baseline, exits with status 1 if a benchmark got slower by
+more than the tolerance::
+
+    $ python benchmarks/run.py --baseline benchmarks/baseline.json
+
+Use ``--save`` to write the results as the new baseline.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+from path import path
+
+os.environ['AIRSHIP_NO_SUPERVISORCTL'] = '1'
+sys.path.insert(0, str(path(__file__).abspath().parent.parent))
+
+from airship.core import Airship, parse_procfile
+from airship.stats import monotonic
+
+MANY_BUCKETS = 1000
+MANY_PROCESS_TYPES = 200
+CONCURRENT_READS = 500
+MANY_PROCESSES = 300
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def measure(func, repeat):
+    """ Run `func` `repeat` times, return the median duration. """
+    durations = []
+    for c in range(repeat):
+        t0 = monotonic()
+        func()
+        durations.append(monotonic() - t0)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+
+class Home(object):
+
+    def __init__(self):
+        self.path = path(tempfile.mkdtemp())
+        (self.path / 'etc').mkdir()
+        (self.path / 'var' / 'deploy').makedirs()
+        self.airship = Airship({'home': self.path})
+
+    def cleanup(self):
+        shutil.rmtree(self.path)
+
+    def add_buckets(self, count):
+        for c in range(count):
+            self.airship.new_bucket()
+
+
+def procfile(count):
+    return ''.join('proc%d: ./run --worker %d $PORT\n' % (n, n)
+                   for n in range(count))
+
+
+@benchmark
+def new_bucket(home):
+    return measure(home.airship.new_bucket, 50)
+
+
+@benchmark
+def generate_bucket_id(home):
+    return measure(home.airship._generate_bucket_id, 50)
+
+
+@benchmark
+def get_bucket_newest_of_many(home):
+    home.add_buckets(MANY_BUCKETS)
+    return measure(home.airship.get_bucket, 100)
+
+
+@benchmark
+def get_bucket_by_id_of_many(home):
+    home.add_buckets(MANY_BUCKETS)
+    return measure(lambda: home.airship.get_bucket('d500'), 100)
+
+
+@benchmark
+def list_buckets_page_of_many(home):
+    home.add_buckets(MANY_BUCKETS)
+    return measure(lambda: home.airship.list_buckets(limit=20), 20)
+
+
+@benchmark
+def list_buckets_all_of_many(home):
+    home.add_buckets(MANY_BUCKETS)
+    return measure(home.airship.list_buckets, 5)
+
+
+@benchmark
+def parse_procfile_many_types(home):
+    lines = procfile(MANY_PROCESS_TYPES).splitlines(True)
+    return measure(lambda: parse_procfile(lines), 100)
+
+
+@benchmark
+def configure_bucket_many_types(home):
+    bucket = home.airship.new_bucket()
+    bucket.process_types = parse_procfile(
+        procfile(MANY_PROCESS_TYPES).splitlines())
+    daemons = home.airship.daemons
+
+    def configure():
+        daemons._bucket_cfg(bucket.id_).unlink_p()
+        daemons._configure_bucket(bucket, True)
+
+    return measure(configure, 20)
+
+
+@benchmark
+def cli_list(home):
+    args = [sys.executable, '-m', 'airship.core', home.path, 'list']
+    env = dict(os.environ, PYTHONPATH=path(__file__).abspath().parent.parent)
+    with open(os.devnull, 'wb') as devnull:
+        return measure(lambda: subprocess.check_call(args, env=env,
+                                                     stdout=devnull), 5)
+
+
+# waits for a line on stdin, then does `CONCURRENT_READS` lookups of the
+# newest bucket, like `airship run` does
+READER_SCRIPT = """
+import sys
+from path import path
+from airship.core import Airship
+airship = Airship({'home': path(sys.argv[1])}, read_only=True)
+print 'ready'
+sys.stdout.flush()
+sys.stdin.readline()
+for c in range(int(sys.argv[2])):
+    airship.get_bucket()
+"""
+
+
+def concurrent_reads(home, readers):
+    """ Time per lookup, over all lookups, with `readers` processes reading
+    while this one creates buckets. With less CPUs than readers, each
+    reader waits for the others, but the total throughput shouldn't drop.
+    """
+    home.add_buckets(MANY_BUCKETS)
+    env = dict(os.environ, PYTHONPATH=path(__file__).abspath().parent.parent)
+    args = [sys.executable, '-c', READER_SCRIPT, home.path,
+            str(CONCURRENT_READS)]
+    procs = [subprocess.Popen(args, env=env, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+             for c in range(readers)]
+    for proc in procs:
+        proc.stdout.readline()
+    t0 = monotonic()
+    for proc in procs:
+        proc.stdin.write('go\n')
+        proc.stdin.flush()
+    while any(proc.poll() is None for proc in procs):
+        home.airship.new_bucket()
+    return (monotonic() - t0) / (CONCURRENT_READS * readers)
+
+
+@benchmark
+def concurrent_reads_1(home):
+    return concurrent_reads(home, 1)
+
+
+@benchmark
+def concurrent_reads_16(home):
+    return concurrent_reads(home, 16)
+
+
+@benchmark
+def sample_many_processes(home):
+    """ One `airship top` sample of `MANY_PROCESSES` processes, each the
+    only process of its type. """
+    from airship.metrics import Sampler
+    procs = [subprocess.Popen(['sleep', '60'])
+             for c in range(MANY_PROCESSES)]
+    try:
+        roots = dict((proc.pid, ('d1', 'type%d' % c))
+                     for c, proc in enumerate(procs))
+        sampler = Sampler()
+        return measure(lambda: sampler.sample(roots), 10)
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+
+def run_benchmarks(names=None):
+    results = {}
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        home = Home()
+        try:
+            results[func.__name__] = func(home)
+        finally:
+            home.cleanup()
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    return sorted(name for name in results
+                  if name in baseline and
+                  results[name] > baseline[name] * tolerance)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help="benchmarks to run")
+    parser.add_argument('--baseline', help="compare with this JSON file")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="allowed slowdown relative to the baseline")
+    parser.add_argument('--save', help="save the results to this file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names)
+    print json.dumps(results, indent=2, sort_keys=True)
+    if args.save:
+        with open(args.save, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.tolerance)
+        for name in slower:
+            print >> sys.stderr, "REGRESSION %s: %.6fs (baseline %.6fs)" % (
+                name, results[name], baseline[name])
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import threading
+from StringIO import StringIO
+from mock import patch
+from common import AirshipTestCase
+from deploy_test import make_tarball
+
+
+class AgentTest(AirshipTestCase):
+
+    def setUp(self):
+        from airship.core import build_args_parser
+        from airship.agent import Agent, _ThreadStreams
+        self.patch('airship.daemons.Supervisor.ctl')
+        self.patch('airship.deployer.start_reaper')
+        self.stdout = StringIO()
+        self.stderr = StringIO()
+        self.stdin = StringIO()
+        for name in ['stdout', 'stderr', 'stdin']:
+            p = patch.object(sys, name, _ThreadStreams(getattr(self, name)))
+            p.start()
+            self.addCleanup(p.stop)
+        self.airship = self.create_airship()
+        self.agent = Agent(self.airship, build_args_parser(),
+                           self.tmp / 'var' / 'run' / 'agent.sock')
+        self.agent.listen()
+        self.addCleanup(self.agent.server.close)
+
+    def call(self, *argv):
+        from airship.agent import call_agent
+        thread = threading.Thread(target=lambda: self.agent.handle(
+            self.agent.server.accept()[0]))
+        thread.start()
+        try:
+            return call_agent(self.agent.socket_path, list(argv))
+        finally:
+            thread.join()
+
+    def test_list_is_served_by_agent(self):
+        bucket = self.airship.new_bucket()
+        self.assertEqual(self.call('list'), 0)
+        listing = json.loads(self.stdout.getvalue())
+        self.assertEqual([b['id'] for b in listing['buckets']], [bucket.id_])
+
+    def test_deploy_reads_artifact_from_client_stdin(self):
+        self.stdin.write(make_tarball({'Procfile': 'web: run\n'}))
+        self.stdin.seek(0)
+        self.assertEqual(self.call('deploy', '-'), 0)
+        bucket = self.airship.get_bucket()
+        self.assertEqual(bucket.process_types, {'web': 'run'})
+        self.assertEqual(self.airship.active_bucket_id(), bucket.id_)
+
+    def test_bad_arguments_are_reported_to_client(self):
+        self.assertEqual(self.call('destroy', '--bogus'), 2)
+        self.assertIn('unrecognized arguments: --bogus',
+                      self.stderr.getvalue())
+
+    def test_failing_command_reports_exit_status(self):
+        self.assertEqual(self.call('destroy'), 1)
+        self.assertIn('There are no buckets', self.stderr.getvalue())
+
+    def test_only_agent_commands_are_served(self):
+        self.assertEqual(self.call('init'), 2)
+        self.assertFalse((self.tmp / 'bin').isdir())
+
+    def test_configuration_is_reloaded_when_changed(self):
+        cfg_path = self.tmp / 'etc' / 'airship.yaml'
+        cfg_path.write_text('port_map: {web: 8000}\n')
+        os.utime(cfg_path, (1, 1))
+        self.call('list')
+        self.assertEqual(self.airship.config['port_map'], {'web': 8000})
+
+    def test_client_returns_none_without_agent(self):
+        from airship.agent import call_agent
+        self.assertIsNone(call_agent(self.tmp / 'nothing.sock', ['list']))
+
+
+class ClientTest(AirshipTestCase):
+
+    def test_deploy_paths_are_made_absolute(self):
+        from airship.agent import _absolute_paths
+        cwd = os.getcwd()
+        self.assertEqual(
+            _absolute_paths(['deploy', 'app.tar', '--manifest', 'm.json']),
+            ['deploy', cwd + '/app.tar', '--manifest', cwd + '/m.json'])
+        self.assertEqual(_absolute_paths(['deploy', '-', '--manifest=m']),
+                         ['deploy', '-', '--manifest=' + cwd + '/m'])
+        self.assertEqual(_absolute_paths(['destroy', '-d', 'd1']),
+                         ['destroy', '-d', 'd1'])
+
+
+class StatusTest(AirshipTestCase):
+
+    def status(self, airship):
+        from airship.core import status_cmd
+        with patch('sys.stdout', StringIO()) as stdout:
+            status_cmd(airship, None)
+        return json.loads(stdout.getvalue())
+
+    def test_status_lists_processes_of_active_bucket(self):
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        airship.set_active_bucket(bucket.id_)
+        info = self.patch('airship.daemons.Supervisor.process_info')
+        info.return_value = [
+            {'group': bucket.id_ + '-web', 'name': bucket.id_ + '-web',
+             'statename': 'RUNNING', 'pid': 123, 'start': 10, 'now': 25},
+            {'group': bucket.id_ + '-worker', 'name': 'worker_00',
+             'statename': 'BACKOFF', 'pid': 0, 'start': 10, 'now': 25},
+            {'group': 'd99-web', 'name': 'd99-web',
+             'statename': 'RUNNING', 'pid': 124, 'start': 10, 'now': 25},
+        ]
+        self.assertEqual(self.status(airship), {
+            'active': bucket.id_,
+            'processes': [
+                {'name': bucket.id_ + '-web', 'state': 'RUNNING',
+                 'pid': 123, 'uptime': 15},
+                {'name': bucket.id_ + '-worker:worker_00',
+                 'state': 'BACKOFF', 'pid': None, 'uptime': None},
+            ],
+        })
+
+    def test_status_without_active_bucket(self):
+        self.assertEqual(self.status(self.create_airship()),
+                         {'active': None, 'processes': None})
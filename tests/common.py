@@ -44,5 +44,6 @@ class AirshipTestCase(HandyTestCase):
     def _pre_setup(self):
         super(AirshipTestCase, self)._pre_setup()
         (self.tmp / 'etc').mkdir()
+        self.addCleanup(imp('airship.store').close_stores)
         (self.tmp / 'var' / 'deploy').makedirs_p()
         self.mock_subprocess = self.patch('airship.daemons.subprocess')
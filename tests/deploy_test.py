@@ -1,3 +1,4 @@
+from mock import patch, call
 from common import AirshipTestCase
 
 
@@ -11,5 +12,426 @@ class DaemonErrorTest(AirshipTestCase):
         subprocess.check_call.side_effect = CalledProcessError(3, '')
         airship = self.create_airship()
         bucket = airship.new_bucket()
+        bucket.process_types = {'web': './runweb $PORT'}
         with self.assertRaises(SupervisorError):
             bucket.start()
+
+
+def make_tarball(files, mode='w'):
+    import tarfile
+    from StringIO import StringIO
+    output = StringIO()
+    tar = tarfile.open(fileobj=output, mode=mode)
+    for name, content in sorted(files.items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, StringIO(content))
+    tar.close()
+    return output.getvalue()
+
+
+class ExtractArtifactTest(AirshipTestCase):
+
+    def extract(self, data):
+        import hashlib
+        from StringIO import StringIO
+        from airship.deployer import extract_artifact
+        bucket = self.create_airship().new_bucket()
+        sha256 = extract_artifact(bucket, StringIO(data))
+        self.assertEqual(sha256, hashlib.sha256(data).hexdigest())
+        return bucket
+
+    def test_extract_uncompressed_tarball(self):
+        bucket = self.extract(make_tarball({'Procfile': 'web: run\n'}))
+        self.assertEqual((bucket.folder / 'Procfile').text(), 'web: run\n')
+
+    def test_extract_gzip_tarball(self):
+        bucket = self.extract(make_tarball({'a/b.txt': 'hi'}, 'w:gz'))
+        self.assertEqual((bucket.folder / 'a' / 'b.txt').text(), 'hi')
+
+    def test_extract_bz2_tarball(self):
+        bucket = self.extract(make_tarball({'a/b.txt': 'hi'}, 'w:bz2'))
+        self.assertEqual((bucket.folder / 'a' / 'b.txt').text(), 'hi')
+
+    def test_extract_multi_member_gzip_tarball(self):
+        import gzip
+        from StringIO import StringIO
+        tarball = make_tarball({'a/b.txt': 'hi', 'c.txt': 'x' * 100000})
+        output = StringIO()
+        for part in [tarball[:5000], tarball[5000:]]:
+            member = gzip.GzipFile(fileobj=output, mode='wb')
+            member.write(part)
+            member.close()
+        bucket = self.extract(output.getvalue() + '\0' * 512)
+        self.assertEqual((bucket.folder / 'a' / 'b.txt').text(), 'hi')
+        self.assertEqual((bucket.folder / 'c.txt').text(), 'x' * 100000)
+
+    def test_artifact_stream_reads_in_small_pieces(self):
+        from StringIO import StringIO
+        from airship.deployer import ArtifactStream
+        data = make_tarball({'a.txt': 'x' * 300000}, 'w:gz')
+        stream = ArtifactStream(StringIO(data))
+        pieces = iter(lambda: stream.read(1000), '')
+        self.assertEqual(''.join(pieces),
+                         make_tarball({'a.txt': 'x' * 300000}))
+
+    def test_write_errors_raise_deploy_error(self):
+        import tarfile
+        from StringIO import StringIO
+        from airship.deployer import extract_artifact, DeployError
+        bucket = self.create_airship().new_bucket()
+        output = StringIO()
+        tar = tarfile.open(fileobj=output, mode='w')
+        tar.addfile(tarfile.TarInfo('a'), StringIO(''))
+        directory = tarfile.TarInfo('a/b')
+        directory.type = tarfile.DIRTYPE
+        tar.addfile(directory)
+        tar.close()
+        with self.assertRaises(DeployError):
+            extract_artifact(bucket, StringIO(output.getvalue()))
+
+    def test_unsafe_paths_raise_deploy_error(self):
+        from StringIO import StringIO
+        from airship.deployer import extract_artifact, DeployError
+        bucket = self.create_airship().new_bucket()
+        data = make_tarball({'../evil': 'boo'})
+        with self.assertRaises(DeployError):
+            extract_artifact(bucket, StringIO(data))
+        self.assertFalse((bucket.folder.parent / 'evil').exists())
+
+    def test_links_outside_bucket_raise_deploy_error(self):
+        import tarfile
+        from StringIO import StringIO
+        from airship.deployer import extract_artifact, DeployError
+        outside = self.tmp / 'outside'
+        outside.mkdir()
+        (outside / 'target').write_text('keep')
+        for link_type, linkname in [(tarfile.SYMTYPE, str(outside)),
+                                    (tarfile.SYMTYPE, '../../outside'),
+                                    (tarfile.LNKTYPE, outside / 'target')]:
+            output = StringIO()
+            tar = tarfile.open(fileobj=output, mode='w')
+            link = tarfile.TarInfo('evil')
+            link.type = link_type
+            link.linkname = linkname
+            tar.addfile(link)
+            for name in ['evil/x', 'evil']:
+                info = tarfile.TarInfo(name)
+                info.size = 3
+                tar.addfile(info, StringIO('boo'))
+            tar.close()
+            bucket = self.create_airship().new_bucket()
+            with self.assertRaises(DeployError):
+                extract_artifact(bucket, StringIO(output.getvalue()))
+            self.assertEqual(outside.listdir(), [outside / 'target'])
+            self.assertEqual((outside / 'target').text(), 'keep')
+
+    def test_links_inside_bucket_are_extracted(self):
+        import tarfile
+        from StringIO import StringIO
+        output = StringIO()
+        tar = tarfile.open(fileobj=output, mode='w')
+        info = tarfile.TarInfo('lib/a.txt')
+        info.size = 2
+        tar.addfile(info, StringIO('hi'))
+        link = tarfile.TarInfo('a.txt')
+        link.type = tarfile.SYMTYPE
+        link.linkname = 'lib/a.txt'
+        tar.addfile(link)
+        tar.close()
+        bucket = self.extract(output.getvalue())
+        self.assertEqual((bucket.folder / 'a.txt').text(), 'hi')
+
+    def test_deploy_reads_artifact_from_stdin(self):
+        from StringIO import StringIO
+        from airship.deployer import deploy
+        self.patch('airship.deployer.remove_old_buckets')
+        self.patch('airship.deployer.start_reaper')
+        airship = self.create_airship()
+        data = make_tarball({'Procfile': 'web: run\n'}, 'w:gz')
+        with patch('sys.stdin', StringIO(data)):
+            deploy(airship, '-')
+        bucket = airship.get_bucket()
+        self.assertEqual(bucket.process_types, {'web': 'run'})
+
+
+def sha256(content):
+    import hashlib
+    return hashlib.sha256(content).hexdigest()
+
+
+class DeltaDeployTest(AirshipTestCase):
+
+    FILES = {
+        'Procfile': 'web: run\n',
+        'app.py': 'v1',
+        'static/big.js': 'x' * 1000,
+    }
+
+    def setUp(self):
+        self.patch('airship.daemons.Supervisor.ctl')
+        self.patch('airship.deployer.start_reaper')
+        self.airship = self.create_airship()
+        self.deploy(self.FILES)
+        self.old_bucket = self.airship.get_bucket()
+
+    def deploy(self, files, manifest=None):
+        from airship.deployer import deploy
+        artifact = self.tmp / 'artifact.tar'
+        artifact.write_bytes(make_tarball(files))
+        deploy(self.airship, artifact, manifest)
+
+    def manifest(self, files):
+        return dict((name, sha256(content))
+                    for name, content in files.items())
+
+    def test_unchanged_files_are_linked_from_active_bucket(self):
+        self.patch('airship.deployer.remove_old_buckets')
+        files = dict(self.FILES, **{'app.py': 'v2'})
+        self.deploy({'app.py': 'v2'}, self.manifest(files))
+        bucket = self.airship.get_bucket()
+        self.assertNotEqual(bucket.id_, self.old_bucket.id_)
+        self.assertEqual((bucket.folder / 'app.py').bytes(), 'v2')
+        big_js = bucket.folder / 'static' / 'big.js'
+        self.assertEqual(big_js.bytes(), 'x' * 1000)
+        self.assertEqual(big_js.stat().st_ino,
+                         (self.old_bucket.folder / 'static' /
+                          'big.js').stat().st_ino)
+        self.assertEqual(bucket.process_types, {'web': 'run'})
+
+    def test_missing_files_are_reported(self):
+        from airship.deployer import (MissingFilesError, delta_source,
+                                      missing_files)
+        files = dict(self.FILES, **{'new.css': 'css', 'app.py': 'v2'})
+        manifest = self.manifest(files)
+        self.assertEqual(missing_files(delta_source(self.airship), manifest),
+                         ['app.py', 'new.css'])
+        with self.assertRaises(MissingFilesError) as ctx:
+            self.deploy({'app.py': 'v2'}, manifest)
+        self.assertEqual(ctx.exception.paths, ['new.css'])
+
+    def test_files_modified_in_active_bucket_are_not_reused(self):
+        from airship.deployer import delta_source, missing_files
+        (self.old_bucket.folder / 'app.py').write_text('v1 patched')
+        manifest = self.manifest(self.FILES)
+        self.assertEqual(missing_files(delta_source(self.airship), manifest),
+                         ['app.py'])
+
+    def test_checksum_mismatch_fails_deployment(self):
+        from airship.deployer import DeployError
+        manifest = self.manifest(dict(self.FILES, **{'app.py': 'v2'}))
+        with self.assertRaises(DeployError):
+            self.deploy({'app.py': 'v3'}, manifest)
+
+
+class DeployQueueTest(AirshipTestCase):
+
+    def setUp(self):
+        self.patch('airship.daemons.Supervisor.ctl')
+        self.patch('airship.deployer.start_reaper')
+        self.artifact = self.tmp / 'artifact.tar'
+        self.artifact.write_bytes(make_tarball({'Procfile': 'web: run\n'}))
+        self.queue_path = self.tmp / 'var' / 'deploy-queue'
+
+    def add_ticket(self, seq, pid):
+        self.queue_path.makedirs_p()
+        (self.queue_path / ('%d.ticket' % seq)).write_text(str(pid))
+
+    def dead_pid(self):
+        import subprocess
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        return proc.pid
+
+    def test_deploy_is_skipped_when_newer_one_is_queued(self):
+        import os
+        from airship.deployer import deploy
+        airship = self.create_airship()
+        self.add_ticket(100, os.getpid())
+        self.assertIsNone(deploy(airship, self.artifact))
+        self.assertEqual(airship.list_buckets()['buckets'], [])
+        self.assertEqual([f.name for f in self.queue_path.files('*.ticket')],
+                         ['100.ticket'])
+
+    def test_tickets_of_dead_processes_are_ignored(self):
+        from airship.deployer import deploy
+        airship = self.create_airship()
+        self.add_ticket(100, self.dead_pid())
+        bucket = deploy(airship, self.artifact)
+        self.assertEqual(airship.get_bucket().id_, bucket.id_)
+        self.assertEqual(self.queue_path.files('*.ticket'), [])
+
+    def test_waiting_deploy_spools_stdin(self):
+        from StringIO import StringIO
+        from airship.deployer import deploy
+        airship = self.create_airship()
+        self.patch('airship.deployqueue.Ticket.lock')
+        try_lock = self.patch('airship.deployqueue.Ticket.try_lock')
+        try_lock.return_value = False
+        with patch('sys.stdin', StringIO(self.artifact.bytes())):
+            bucket = deploy(airship, '-')
+        self.assertEqual(bucket.process_types, {'web': 'run'})
+        self.assertEqual(self.queue_path.files('*.artifact'), [])
+
+    def test_deploy_is_skipped_after_newer_one_ran(self):
+        from airship.deployer import deploy
+        from airship.deployqueue import DeployQueue
+        airship = self.create_airship()
+        queue = DeployQueue(self.queue_path)
+        older, newer = queue.enter(), queue.enter()
+        self.assertTrue(newer.start())
+        newer.close()
+        self.assertTrue(older.superseded())
+        self.assertFalse(older.start())
+        older.close()
+        self.assertIsNotNone(deploy(airship, self.artifact))
+
+    def test_running_deploy_is_cancelled_by_newer_one(self):
+        import os
+        from airship.deployer import deploy, bucket_setup, DeployCancelled
+        newer = lambda sender, bucket: self.add_ticket(100, os.getpid())
+        bucket_setup.connect(newer)
+        self.addCleanup(bucket_setup.disconnect, newer)
+        for setting in [{'cancel_running': True}, 'cancel_running']:
+            airship = self.create_airship({'deploy_queue': setting})
+            with self.assertRaises(DeployCancelled):
+                deploy(airship, self.artifact)
+            (self.queue_path / '100.ticket').unlink()
+
+
+class RemoveOldBucketsTest(AirshipTestCase):
+
+    def setUp(self):
+        self.mock_update = self.patch('airship.daemons.Supervisor.update')
+        self.airship = self.create_airship()
+        self.old_buckets = []
+        for c in range(3):
+            bucket = self.airship.new_bucket()
+            (bucket.folder / 'Procfile').write_text('web: ./run\n')
+            bucket._read_procfile()
+            bucket.start()
+            self.old_buckets.append(bucket)
+        self.new_bucket = self.airship.new_bucket()
+
+    def test_old_buckets_are_removed_with_one_supervisor_update(self):
+        from airship.deployer import remove_old_buckets
+        self.mock_update.reset_mock()
+        remove_old_buckets(self.new_bucket)
+        groups = [b.id_ + '-web' for b in reversed(self.old_buckets)]
+        self.assertEqual(self.mock_update.mock_calls, [call(groups)])
+
+    def test_old_buckets_are_moved_to_trash(self):
+        from airship.deployer import remove_old_buckets
+        remove_old_buckets(self.new_bucket)
+        for bucket in self.old_buckets:
+            self.assertFalse(bucket.folder.exists())
+        self.assertEqual(len(self.airship.trash_path.dirs()), 3)
+        self.assertEqual([b['id'] for b in
+                          self.airship.list_buckets()['buckets']],
+                         [self.new_bucket.id_])
+
+    def test_old_buckets_are_kept_if_supervisord_fails(self):
+        from airship.daemons import SupervisorError
+        from airship.deployer import remove_old_buckets, DeployError
+        self.mock_update.side_effect = SupervisorError('no')
+        with self.assertRaises(DeployError):
+            remove_old_buckets(self.new_bucket)
+        for bucket in self.old_buckets:
+            self.assertTrue(bucket.folder.isdir())
+        self.assertEqual(len(self.airship.list_buckets()['buckets']), 4)
+
+    def test_reaper_empties_trash(self):
+        from airship.core import reap_trash
+        from airship.deployer import remove_old_buckets
+        (self.old_buckets[0].folder / 'a' / 'b').makedirs()
+        (self.old_buckets[0].folder / 'a' / 'b' / 'c').write_text('c')
+        self.tmp.symlink(self.old_buckets[0].folder / 'link')
+        remove_old_buckets(self.new_bucket)
+        reap_trash(self.airship.trash_path)
+        self.assertEqual(self.airship.trash_path.listdir(),
+                         [self.airship.trash_path / '.lock'])
+        self.assertTrue(self.tmp.isdir())
+
+
+class BlueGreenDeployTest(AirshipTestCase):
+
+    def setUp(self):
+        self.patch('airship.daemons.Supervisor.ctl')
+        self.patch('airship.deployer.start_reaper')
+        self.wait_for_port = self.patch('airship.deployer.wait_for_port')
+        self.wait_for_port.return_value = True
+        self.subprocess = self.patch('airship.deployer.subprocess')
+        self.airship = self.create_airship({'blue_green': {
+            'ports': {'web': [8001, 8002]},
+            'upstream_template': 'server 127.0.0.1:{web};',
+            'switch_command': 'reload-proxy',
+        }})
+        self.artifact = self.tmp / 'app.tar'
+        self.artifact.write_bytes(make_tarball({'Procfile': 'web: run\n'}))
+
+    def deploy(self):
+        from airship.deployer import deploy
+        deploy(self.airship, self.artifact)
+        return self.airship.get_bucket()
+
+    def test_new_bucket_starts_on_idle_port_while_old_one_runs(self):
+        bucket_1 = self.deploy()
+        bucket_2 = self.deploy()
+        self.assertEqual(bucket_1.port_for('web'), 8001)
+        self.assertEqual(bucket_2.port_for('web'), 8002)
+        self.assertEqual(self.wait_for_port.mock_calls[-1], call(8002, 30))
+        self.assertFalse(bucket_1.folder.exists())
+        self.assertEqual(self.airship.active_bucket_id(), bucket_2.id_)
+
+    def test_upstream_is_switched_after_verification(self):
+        self.deploy()
+        upstream = (self.tmp / 'var' / 'run' / 'upstream').text()
+        self.assertEqual(upstream, 'server 127.0.0.1:8001;')
+
+    def test_missing_ports_raise_deploy_error(self):
+        from airship.deployer import DeployError
+        self.airship.config['blue_green'] = {'switch_command': 'reload'}
+        with self.assertRaises(DeployError) as ctx:
+            self.deploy()
+        self.assertIn('blue_green needs ports', ctx.exception.message)
+        self.airship.config['blue_green'] = {'ports': {'web': 8001}}
+        with self.assertRaises(DeployError) as ctx:
+            self.deploy()
+        self.assertEqual(ctx.exception.message,
+                         "Invalid blue_green ports for process 'web': must "
+                         "be two port numbers, not 8001")
+
+    def test_overlapping_instance_ports_raise_deploy_error(self):
+        from airship.deployer import DeployError
+        self.airship.config['instances'] = {'web': 2}
+        with self.assertRaises(DeployError) as ctx:
+            self.deploy()
+        self.assertEqual(ctx.exception.message,
+                         "Port 8002 is used by both 'web' slot 0 and "
+                         "'web' slot 1.")
+        self.airship.config['blue_green']['ports'] = {'web': [8001, 8003]}
+        self.assertEqual(self.deploy().port_for('web'), 8001)
+
+    def test_socket_activation_requires_readiness_check(self):
+        from airship.deployer import DeployError
+        self.airship.config['socket_activation'] = True
+        with self.assertRaises(DeployError) as ctx:
+            self.deploy()
+        self.assertIn('readiness check', ctx.exception.message)
+        self.assertIsNone(self.airship.active_bucket_id())
+        self.airship.config['readiness'] = {'web': {'command': 'true'}}
+        self.deploy()
+        self.assertFalse(self.wait_for_port.called)
+        self.assertEqual(self.subprocess.check_call.mock_calls,
+                         [call('reload-proxy', shell=True)])
+
+    def test_failed_verification_keeps_old_bucket_serving(self):
+        from airship.deployer import DeployError
+        bucket_1 = self.deploy()
+        self.wait_for_port.return_value = False
+        with self.assertRaises(DeployError):
+            self.deploy()
+        self.assertTrue(bucket_1.folder.isdir())
+        self.assertEqual(self.airship.active_bucket_id(), bucket_1.id_)
+        upstream = (self.tmp / 'var' / 'run' / 'upstream').text()
+        self.assertEqual(upstream, 'server 127.0.0.1:8001;')
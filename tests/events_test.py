@@ -0,0 +1,157 @@
+import os
+import json
+import threading
+from StringIO import StringIO
+from mock import Mock, patch, call
+from common import AirshipTestCase
+
+
+def event(n, bucket='d1', procname='web'):
+    return {'time': n, 'bucket': bucket, 'procname': procname,
+            'process': bucket + '-' + procname, 'from_state': 'RUNNING',
+            'state': 'EXITED', 'pid': n}
+
+
+class EventLogTest(AirshipTestCase):
+
+    def event_log(self, size):
+        from airship.events import EventLog
+        return EventLog(self.create_airship().store, size)
+
+    def test_only_last_events_are_kept(self):
+        event_log = self.event_log(3)
+        for n in range(5):
+            event_log.append(event(n))
+        self.assertEqual([e['time'] for e in event_log.history()], [2, 3, 4])
+        self.assertEqual(len(event_log.events), 3)
+
+    def test_history_is_filtered(self):
+        event_log = self.event_log(10)
+        event_log.append(event(1, 'd1', 'web'))
+        event_log.append(event(2, 'd2', 'web'))
+        event_log.append(event(3, 'd2', 'worker'))
+        event_log.append(event(4, 'd2', 'web'))
+        self.assertEqual([e['time'] for e in event_log.history('d2')],
+                         [2, 3, 4])
+        self.assertEqual([e['time'] for e in
+                          event_log.history('d2', ['web'], limit=1)], [4])
+
+
+class EventListenerTest(AirshipTestCase):
+
+    def setUp(self):
+        from airship.events import EventListener
+        self.airship = self.create_airship({'restart_backoff': {
+            'initial': 1, 'max': 8, 'reset': 60}})
+        self.now = 1000
+        self.listener = EventListener(self.airship, clock=lambda: self.now)
+        self.listener.rpc = Mock()
+        self.listener.rpc.get_process_info.return_value = {
+            'start': 990, 'stop': 995, 'exitstatus': 3}
+
+    def handle(self, state, group='d1-web', **payload):
+        payload.setdefault('from_state', 'RUNNING')
+        payload.update(groupname=group, processname=group, pid='42')
+        self.listener.handle('PROCESS_STATE_' + state, payload)
+        return self.listener.log.history()[-1]
+
+    def test_exit_is_recorded_with_status_and_uptime(self):
+        recorded = self.handle('EXITED', expected='0')
+        self.listener.rpc.get_process_info.assert_called_once_with(
+            'd1-web:d1-web')
+        self.assertEqual(recorded['bucket'], 'd1')
+        self.assertEqual(recorded['procname'], 'web')
+        self.assertEqual(recorded['exit_status'], 3)
+        self.assertEqual(recorded['uptime'], 5)
+        self.assertFalse(recorded['expected'])
+
+    def test_running_records_startup_time(self):
+        recorded = self.handle('RUNNING', from_state='STARTING')
+        self.assertEqual(recorded['startup'], 10)
+
+    def test_restart_delay_doubles_with_each_crash(self):
+        delays = [self.handle('EXITED', expected='0')['restart_in']
+                  for c in range(5)]
+        self.assertEqual(delays, [1, 2, 4, 8, 8])
+        self.assertEqual(self.listener.pending, {'d1-web:d1-web': 1008})
+
+    def test_long_uptime_resets_delay(self):
+        self.handle('EXITED', expected='0')
+        self.handle('FATAL', from_state='BACKOFF')
+        self.listener.rpc.get_process_info.return_value = {
+            'start': 100, 'stop': 995, 'exitstatus': 1}
+        self.assertEqual(self.handle('EXITED', expected='0')['restart_in'],
+                         1)
+
+    def test_expected_exits_and_other_programs_are_not_restarted(self):
+        self.assertNotIn('restart_in', self.handle('EXITED', expected='1'))
+        recorded = self.handle('FATAL', group='airship-agent')
+        self.assertEqual(recorded['bucket'], None)
+        self.assertNotIn('restart_in', recorded)
+        self.assertEqual(self.listener.pending, {})
+
+    def test_without_backoff_supervisord_restarts(self):
+        del self.airship.config['restart_backoff']
+        self.assertNotIn('restart_in', self.handle('EXITED', expected='0'))
+
+    def test_restarts_when_delay_has_passed(self):
+        self.handle('EXITED', expected='0')
+        self.handle('EXITED', group='d1-worker', expected='0')
+        self.handle('EXITED', group='d1-worker', expected='0')
+        self.now += 1
+        self.listener.restart_due()
+        self.assertEqual(self.listener.rpc.start_process.mock_calls,
+                         [call('d1-web:d1-web', False)])
+        self.assertEqual(self.listener.pending.keys(),
+                         ['d1-worker:d1-worker'])
+
+    def test_stopping_cancels_restart(self):
+        self.handle('EXITED', expected='0')
+        self.handle('STOPPED', from_state='BACKOFF')
+        self.assertEqual(self.listener.pending, {})
+
+    def test_listener_protocol(self):
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        self.listener.stdin = os.fdopen(stdin_r, 'rb')
+        self.listener.stdout = os.fdopen(stdout_w, 'wb')
+        supervisord_out = os.fdopen(stdin_w, 'wb')
+        supervisord_in = os.fdopen(stdout_r, 'rb')
+        thread = threading.Thread(target=self.listener.serve_forever)
+        thread.start()
+        self.assertEqual(supervisord_in.readline(), 'READY\n')
+        payload = ('processname:d1-web groupname:d1-web from_state:RUNNING '
+                   'expected:0 pid:42')
+        supervisord_out.write('ver:3.0 server:supervisor serial:1 '
+                              'pool:airship-events poolserial:1 '
+                              'eventname:PROCESS_STATE_EXITED len:%d\n%s'
+                              % (len(payload), payload))
+        supervisord_out.flush()
+        self.assertEqual(supervisord_in.readline(), 'RESULT 2\n')
+        self.assertEqual(supervisord_in.read(2), 'OK')
+        self.assertEqual(supervisord_in.readline(), 'READY\n')
+        supervisord_out.close()
+        thread.join()
+        for f in [self.listener.stdin, self.listener.stdout, supervisord_in]:
+            f.close()
+        self.assertEqual(self.listener.log.history()[-1]['state'], 'EXITED')
+
+
+class EventsCommandTest(AirshipTestCase):
+
+    def test_events_command_prints_history(self):
+        from airship.core import main
+        from airship.events import EventLog
+        event_log = EventLog(self.create_airship().store)
+        event_log.append(dict(event(0), exit_status=1, uptime=2.5,
+                              restart_in=4))
+        event_log.append(event(1, procname='worker'))
+        with patch('sys.stdout', StringIO()) as stdout:
+            main([str(self.tmp), 'events', 'web'])
+        [line] = stdout.getvalue().splitlines()
+        self.assertIn('d1     d1-web                   RUNNING -> EXITED  '
+                      '(exit status 1, up 2.5s, restart in 4s)', line)
+        with patch('sys.stdout', StringIO()) as stdout:
+            main([str(self.tmp), 'events', '--json', '-n', '1'])
+        self.assertEqual([e['procname'] for e in
+                          json.loads(stdout.getvalue())], ['worker'])
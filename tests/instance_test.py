@@ -88,3 +88,92 @@ class BucketListingTest(AirshipTestCase):
         report = airship.list_buckets()
         self.assertItemsEqual([i['id'] for i in report['buckets']],
                               [bucket_1.id_, bucket_2.id_])
+
+
+class BucketMetadataTest(AirshipTestCase):
+
+    def test_procfile_parser_skips_comments_and_blank_lines(self):
+        from airship.core import parse_procfile
+        procfile = ['# process types\n', '\n', 'web: ./run $PORT\n',
+                    'garbage\n', '  worker : ./work  \n']
+        self.assertEqual(parse_procfile(procfile), {
+            'web': './run $PORT',
+            'worker': './work',
+        })
+
+    def test_saved_metadata_is_used_instead_of_procfile(self):
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        (bucket.folder / 'Procfile').write_text('web: ./run\n')
+        bucket._read_procfile()
+        bucket.save_metadata()
+        (bucket.folder / 'Procfile').unlink()
+        self.assertEqual(airship.get_bucket(bucket.id_).process_types,
+                         {'web': './run'})
+
+    def test_listing_contains_bucket_metadata(self):
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        (bucket.folder / 'Procfile').write_text('web: ./run\n')
+        bucket._read_procfile()
+        bucket.save_metadata()
+        bucket.start()
+        [info] = airship.list_buckets()['buckets']
+        self.assertEqual(info['id'], bucket.id_)
+        self.assertEqual(info['state'], 'running')
+        self.assertEqual(info['process_types'], {'web': './run'})
+        self.assertGreater(info['size'], 0)
+        self.assertIn('created', info)
+
+
+class BucketIndexTest(AirshipTestCase):
+
+    def test_newest_bucket_is_found_by_numeric_order(self):
+        airship = self.create_airship()
+        for c in range(10):
+            bucket = airship.new_bucket()
+        self.assertEqual(bucket.id_, 'd10')
+        self.assertEqual(airship.get_bucket().id_, 'd10')
+
+    def test_get_bucket_with_no_buckets_raises_keyerror(self):
+        with self.assertRaises(KeyError):
+            self.create_airship().get_bucket()
+
+    def test_listing_is_newest_first_and_paginated(self):
+        airship = self.create_airship()
+        for c in range(12):
+            airship.new_bucket()
+        report = airship.list_buckets(before='d11', limit=3)
+        self.assertEqual([i['id'] for i in report['buckets']],
+                         ['d10', 'd9', 'd8'])
+
+    def test_old_buckets_are_indexed_on_upgrade(self):
+        import sqlite3
+        db = sqlite3.connect(self.tmp / 'etc' / 'buckets.db')
+        db.execute('CREATE TABLE bucket (key PRIMARY KEY, value)')
+        db.execute('CREATE TABLE meta (key PRIMARY KEY, value)')
+        for bucket_id in ['d1', 'd2']:
+            db.execute('INSERT INTO bucket VALUES (?, ?)',
+                       (bucket_id, json.dumps({'state': 'running'})))
+        db.execute('INSERT INTO meta VALUES (?, ?)', ('next_bucket_id', '3'))
+        db.commit()
+        db.close()
+        airship = self.create_airship()
+        airship.new_bucket()
+        self.assertEqual([b['id'] for b in airship.list_buckets()['buckets']],
+                         ['d3', 'd2', 'd1'])
+
+    def test_active_bucket_is_linked(self):
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        airship.set_active_bucket(bucket.id_)
+        self.assertEqual(airship.list_buckets()['active'], bucket.id_)
+        self.assertEqual((self.tmp / 'active').readlink(), bucket.folder)
+
+    def test_destroying_active_bucket_clears_pointer(self):
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        airship.set_active_bucket(bucket.id_)
+        bucket.destroy()
+        self.assertIsNone(airship.active_bucket_id())
+        self.assertFalse((self.tmp / 'active').islink())
@@ -0,0 +1,125 @@
+import gzip
+from StringIO import StringIO
+from mock import patch
+from common import AirshipTestCase
+
+
+class TailTest(AirshipTestCase):
+
+    def test_tail_reads_last_lines(self):
+        from airship.logs import tail_lines
+        log_file = self.tmp / 'big.log'
+        log_file.write_text(''.join('line %d\n' % n for n in range(10000)))
+        with patch('airship.logs.BLOCK_SIZE', 100):
+            lines, end = tail_lines(log_file, 3)
+        self.assertEqual(lines, ['line 9997\n', 'line 9998\n', 'line 9999\n'])
+        self.assertEqual(end, log_file.size)
+
+    def test_tail_of_short_file(self):
+        from airship.logs import tail_lines
+        log_file = self.tmp / 'short.log'
+        log_file.write_text('one\ntwo')
+        self.assertEqual(tail_lines(log_file, 5)[0], ['one\n', 'two'])
+
+    def test_merge_orders_lines_by_timestamp(self):
+        from airship.logs import merge_by_timestamp
+        merged = merge_by_timestamp([
+            ('web', ['2013-01-01 10:00:00 a\n', 'traceback\n',
+                     '2013-01-01 10:00:02 c\n']),
+            ('worker', ['[2013-01-01 10:00:01,5] b\n']),
+        ])
+        self.assertEqual(merged, [
+            ('web', '2013-01-01 10:00:00 a\n'),
+            ('web', 'traceback\n'),
+            ('worker', '[2013-01-01 10:00:01,5] b\n'),
+            ('web', '2013-01-01 10:00:02 c\n'),
+        ])
+
+    def test_followed_file_survives_rotation(self):
+        from airship.logs import _FollowedFile
+        log_file = self.tmp / 'web.log'
+        log_file.write_text('a\n')
+        followed = _FollowedFile('web', log_file, log_file.size)
+        self.assertEqual(followed.read_lines(), [])
+        with open(log_file, 'ab') as f:
+            f.write('b\n')
+        self.assertEqual(followed.read_lines(), ['b\n'])
+        log_file.rename(self.tmp / 'web.log.1')
+        log_file.write_text('')
+        self.assertEqual(followed.read_lines(), [])
+        with open(log_file, 'ab') as f:
+            f.write('c\n')
+        self.assertEqual(followed.read_lines(), ['c\n'])
+
+
+class LogsCommandTest(AirshipTestCase):
+
+    def test_logs_command_shows_bucket_logs(self):
+        from airship.core import main
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        bucket.save_config(process_types={'web': 'w', 'worker': 'k'})
+        airship.log_path.makedirs_p()
+        (airship.log_path / (bucket.id_ + '-web.log')).write_text(
+            '2013-01-01 10:00:00 web started\n')
+        (airship.log_path / (bucket.id_ + '-worker.log')).write_text(
+            '2013-01-01 09:00:00 worker started\n')
+        with patch('sys.stdout', StringIO()) as stdout:
+            main([str(self.tmp), 'logs'])
+        self.assertEqual(stdout.getvalue(),
+                         'worker | 2013-01-01 09:00:00 worker started\n'
+                         'web    | 2013-01-01 10:00:00 web started\n')
+
+
+class CompressLogsTest(AirshipTestCase):
+
+    def test_rotated_logs_are_compressed_and_pruned(self):
+        from airship.logs import compress_rotated_logs
+        log_dir = self.tmp / 'var' / 'log'
+        log_dir.makedirs_p()
+        (log_dir / 'd1-web.log').write_text('current')
+        for n in range(1, 4):
+            rotated = log_dir / ('d1-web.log.%d' % n)
+            rotated.write_text('backup %d' % n)
+            rotated.utime((1000000000 - n * 100,) * 2)
+        compress_rotated_logs(log_dir, 2)
+        archives = sorted(log_dir.files('d1-web.log.*.gz'))
+        self.assertEqual(len(archives), 2)
+        self.assertEqual(gzip.open(archives[-1]).read(), 'backup 1')
+        self.assertEqual(gzip.open(archives[0]).read(), 'backup 2')
+        self.assertEqual((log_dir / 'd1-web.log').text(), 'current')
+        self.assertEqual(log_dir.files('d1-web.log.[0-9]'), [])
+
+    def test_logs_rotated_in_the_same_second_are_kept(self):
+        from airship.logs import compress_rotated_logs
+        log_dir = self.tmp / 'var' / 'log'
+        log_dir.makedirs_p()
+        for n in range(1, 4):
+            rotated = log_dir / ('d1-web.log.%d' % n)
+            rotated.write_text('backup %d' % n)
+            rotated.utime((1000000000,) * 2)
+        compress_rotated_logs(log_dir, 5)
+        (log_dir / 'd1-web.log.1').write_text('backup 0')
+        (log_dir / 'd1-web.log.1').utime((1000000000,) * 2)
+        compress_rotated_logs(log_dir, 5)
+        archives = sorted(log_dir.files('d1-web.log.*.gz'))
+        self.assertEqual([gzip.open(a).read() for a in archives],
+                         ['backup 3', 'backup 2', 'backup 1', 'backup 0'])
+
+    def test_interrupted_compression_is_resumed(self):
+        from airship.logs import compress_rotated_logs
+        log_dir = self.tmp / 'var' / 'log'
+        log_dir.makedirs_p()
+        (log_dir / 'd1-web.log.1.compressing').write_text('backup 1')
+        compress_rotated_logs(log_dir, 2)
+        [archive] = log_dir.files('d1-web.log.*.gz')
+        self.assertEqual(gzip.open(archive).read(), 'backup 1')
+        self.assertEqual(log_dir.files('*.compressing'), [])
+
+    def test_logs_are_left_alone_without_backups(self):
+        from airship.logs import compress_rotated_logs
+        log_dir = self.tmp / 'var' / 'log'
+        log_dir.makedirs_p()
+        (log_dir / 'd1-web.log.1').write_text('rotated by logrotate')
+        compress_rotated_logs(log_dir, 0)
+        self.assertEqual(log_dir.files(), [log_dir / 'd1-web.log.1'])
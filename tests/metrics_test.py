@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import signal
+import subprocess
+from StringIO import StringIO
+from mock import patch
+from common import AirshipTestCase
+
+# fields after the command name: state, ppid, ..., utime (12th), stime,
+# ..., starttime (20th), vsize, rss (22nd)
+STAT = ('%(pid)d (%(name)s) S %(ppid)d' + ' 0' * 9 + ' %(utime)d %(stime)d' +
+        ' 0' * 6 + ' %(start)d 0 %(rss)d 0 0\n')
+
+
+class FakeProc(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def add(self, pid, ppid, utime=0, stime=0, start=100, rss=10,
+            name='bash', read_bytes=0, write_bytes=0, fds=3):
+        proc_dir = self.folder / str(pid)
+        (proc_dir / 'fd').makedirs_p()
+        (proc_dir / 'stat').write_text(STAT % dict(
+            pid=pid, name=name, ppid=ppid, utime=utime, stime=stime,
+            start=start, rss=rss))
+        (proc_dir / 'io').write_text('rchar: 1\nread_bytes: %d\n'
+                                     'write_bytes: %d\n'
+                                     % (read_bytes, write_bytes))
+        (proc_dir / 'smaps_rollup').write_text('Rss: 40 kB\nPss: 20 kB\n')
+        for fd in range(fds):
+            (proc_dir / 'fd' / str(fd)).write_text('')
+
+
+class SamplerTest(AirshipTestCase):
+
+    def setUp(self):
+        from airship.metrics import Sampler
+        self.proc = FakeProc(self.tmp / 'proc')
+        self.proc.add(1, 0)
+        self.now = 0
+        self.sampler = Sampler(pss=True, proc=self.tmp / 'proc',
+                               clock=lambda: self.now)
+
+    def sample(self):
+        return dict((p['pid'], p) for p in
+                    self.sampler.sample({10: ('d1', 'web')}))
+
+    def test_descendants_are_sampled_with_their_ancestor(self):
+        self.proc.add(10, 1)
+        self.proc.add(11, 10, name='python (worker) 1')
+        self.proc.add(12, 11)
+        self.proc.add(13, 1)
+        processes = self.sample()
+        self.assertEqual(sorted(processes), [10, 11, 12])
+        self.assertEqual(processes[12]['procname'], 'web')
+        self.assertEqual(processes[12]['bucket'], 'd1')
+        self.assertEqual(processes[12]['fds'], 3)
+        self.assertEqual(processes[12]['pss'], 20 * 1024)
+
+    def test_rates_are_measured_between_samples(self):
+        from airship.metrics import CLK_TCK, PAGE_SIZE
+        self.proc.add(10, 1, utime=100, read_bytes=1000, write_bytes=0)
+        first = self.sample()[10]
+        self.assertEqual(first['cpu'], None)
+        self.assertEqual(first['rss'], 10 * PAGE_SIZE)
+        self.now = 2
+        self.proc.add(10, 1, utime=100 + CLK_TCK, stime=CLK_TCK / 2,
+                      read_bytes=5000, write_bytes=300)
+        second = self.sample()[10]
+        self.assertEqual(second['cpu'], 75)
+        self.assertEqual(second['read_rate'], 2000)
+        self.assertEqual(second['write_rate'], 150)
+
+    def test_reused_pid_is_a_new_process(self):
+        self.proc.add(10, 1, utime=100)
+        self.sample()
+        self.now = 1
+        self.proc.add(10, 1, utime=5, start=200)
+        self.assertEqual(self.sample()[10]['cpu'], None)
+
+    def test_real_processes(self):
+        from airship.metrics import Sampler
+        p = subprocess.Popen(['bash', '-c', 'sleep 10 & wait'],
+                             preexec_fn=os.setsid)
+        self.addCleanup(os.killpg, p.pid, signal.SIGKILL)
+        sampler = Sampler()
+        for c in range(20):
+            processes = sampler.sample({p.pid: ('d1', 'web')})
+            if len(processes) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(processes), 2)
+        self.assertTrue(all(info['rss'] > 0 for info in processes))
+
+
+class SummaryTest(AirshipTestCase):
+
+    processes = [
+        {'pid': 1, 'bucket': 'd2', 'procname': 'web', 'cpu': 10.0,
+         'rss': 100, 'pss': None, 'fds': 5, 'read_rate': None,
+         'write_rate': None},
+        {'pid': 2, 'bucket': 'd2', 'procname': 'web', 'cpu': 2.5,
+         'rss': 50, 'pss': None, 'fds': 4, 'read_rate': 1.0,
+         'write_rate': 0.0},
+        {'pid': 3, 'bucket': 'd2', 'procname': 'worker', 'cpu': None,
+         'rss': 30, 'pss': None, 'fds': None, 'read_rate': None,
+         'write_rate': None},
+    ]
+
+    def test_totals_per_type_and_bucket(self):
+        from airship.metrics import summarize
+        summary = summarize(self.processes)
+        self.assertEqual(summary['d2']['types']['web'], {
+            'processes': 2, 'cpu': 12.5, 'rss': 150, 'pss': None, 'fds': 9,
+            'read_rate': 1.0, 'write_rate': 0.0})
+        self.assertEqual(summary['d2']['total']['rss'], 180)
+        self.assertEqual(summary['d2']['types']['worker']['cpu'], None)
+
+    def test_prometheus_format(self):
+        from airship.metrics import summarize, format_prometheus
+        text = format_prometheus(summarize(self.processes))
+        self.assertIn('# TYPE airship_cpu_percent gauge\n'
+                      'airship_cpu_percent{bucket="d2",process_type="web"} '
+                      '12.5\n', text)
+        self.assertIn('airship_processes{bucket="d2",process_type="worker"} '
+                      '1\n', text)
+        self.assertNotIn('airship_proportional_memory_bytes', text)
+        self.assertNotIn('process_type="worker"} None', text)
+
+    def test_table_has_row_per_type_and_total(self):
+        from airship.metrics import summarize, format_table
+        lines = format_table(summarize(self.processes)).splitlines()
+        self.assertEqual([line.split()[:3] for line in lines[1:]],
+                         [['d2', 'web', '2'], ['d2', 'worker', '1'],
+                          ['d2', '(total)', '3']])
+
+
+class MetricsCommandTest(AirshipTestCase):
+
+    def test_metrics_covers_running_bucket_processes(self):
+        from airship.core import main
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        p = subprocess.Popen(['sleep', '10'])
+        self.addCleanup(p.kill)
+        info = self.patch('airship.daemons.Supervisor.process_info')
+        info.return_value = [
+            {'group': bucket.id_ + '-web', 'pid': p.pid},
+            {'group': bucket.id_ + '-worker', 'pid': 0},
+            {'group': 'airship-agent', 'pid': 1},
+        ]
+        with patch('sys.stdout', StringIO()) as stdout:
+            main([str(self.tmp), 'metrics', '-i', '0.01'])
+        summary = json.loads(stdout.getvalue())
+        self.assertEqual(summary.keys(), [bucket.id_])
+        self.assertEqual(summary[bucket.id_]['types'].keys(), ['web'])
+        self.assertEqual(summary[bucket.id_]['total']['processes'], 1)
+
+    def test_metrics_fails_without_supervisord(self):
+        from airship.core import main
+        self.patch('airship.daemons.Supervisor.process_info').return_value = \
+            None
+        with patch('sys.stderr', StringIO()):
+            with self.assertRaises(SystemExit):
+                main([str(self.tmp), 'metrics', '-i', '0', '--prometheus'])
@@ -1,4 +1,5 @@
 import os
+from path import path
 from mock import Mock, patch, call, ANY
 from common import AirshipTestCase
 
@@ -7,22 +8,67 @@ class PluginTest(AirshipTestCase):
 
     def test_plugin_function_called(self):
         from airship.core import load_plugins
-        airship = Mock()
+        airship = Mock(home_path=self.tmp)
         entry_point = Mock()
         with patch('airship.core._plugin_callbacks', [entry_point]):
             load_plugins(airship)
         self.assertEqual(entry_point.mock_calls, [call(airship)])
 
-    @patch('airship.deployer.subprocess')
+    def test_plugin_entry_points_are_cached(self):
+        from airship.core import _plugin_entry_points
+        entry_points = _plugin_entry_points(self.tmp / 'etc')
+        with patch.dict('sys.modules', {'pkg_resources': None}):
+            cached = _plugin_entry_points(self.tmp / 'etc')
+        self.assertEqual(cached, entry_points)
+
+    def test_plugin_registry_is_invalidated_when_sys_path_changes(self):
+        from airship.core import _plugin_entry_points
+        _plugin_entry_points(self.tmp / 'etc')
+        with patch('sys.path', [str(self.tmp)]):
+            with patch.dict('sys.modules', {'pkg_resources': None}):
+                with self.assertRaises(ImportError):
+                    _plugin_entry_points(self.tmp / 'etc')
+
+    def test_invalid_plugin_registry_is_rebuilt(self):
+        from airship.core import _plugin_entry_points
+        entry_points = _plugin_entry_points(self.tmp / 'etc')
+        for content in ['{"signature": [', '[]', '{}']:
+            (self.tmp / 'etc' / 'plugins.json').write_text(content)
+            self.assertEqual(_plugin_entry_points(self.tmp / 'etc'),
+                             entry_points)
+        with patch.dict('sys.modules', {'pkg_resources': None}):
+            cached = _plugin_entry_points(self.tmp / 'etc')
+        self.assertEqual(cached, entry_points)
+        self.assertEqual([f.name for f in (self.tmp / 'etc').files()],
+                         ['plugins.json'])
+
+    def test_import_does_not_load_heavy_modules(self):
+        import sys
+        import subprocess
+        import airship
+        heavy = ['pkg_resources', 'yaml', 'sqlite3',
+                 'airship.daemons', 'airship.deployer']
+        code = ("import sys, airship.core; "
+                "print [m for m in %r if m in sys.modules]" % heavy)
+        env = dict(os.environ, PYTHONPATH=path(airship.__file__).parent.parent)
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output.strip(), '[]')
+
+    @patch('airship.deployer.start_reaper', Mock())
+    @patch('airship.deployer.record_deploy', Mock())
+    @patch('airship.deployer.stop_old_buckets', Mock(return_value=[]))
+    @patch('airship.deployer.extract_artifact')
     @patch('airship.deployer.bucket_setup')
     @patch('airship.deployer.remove_old_buckets')
-    def test_deploy_sends_bucket_setup_signal(self, subprocess,
+    def test_deploy_sends_bucket_setup_signal(self, remove_old_buckets,
                                                     bucket_setup,
-                                                    remove_old_buckets):
+                                                    extract_artifact):
         from airship.deployer import deploy
-        airship = Mock()
+        airship = Mock(config={}, var_path=self.tmp)
         bucket = airship.new_bucket.return_value
-        deploy(airship, Mock())
+        bucket.folder = self.tmp
+        bucket.airship = airship
+        deploy(airship, '-')
         self.assertEqual(bucket_setup.send.mock_calls,
                          [call(airship, bucket=bucket)])
 
@@ -1,3 +1,5 @@
+import sys
+from path import path
 from mock import Mock
 from common import AirshipTestCase
 
@@ -49,6 +51,232 @@ class DeployErrorTest(AirshipTestCase):
         self.assertIs(err.bucket, self.bucket)
 
 
+class VirtualenvCacheTest(AirshipTestCase):
+
+    def setUp(self):
+        from subprocess import CalledProcessError
+        self.subprocess = self.patch('airship.contrib.python.subprocess')
+        self.subprocess.CalledProcessError = CalledProcessError
+        self.subprocess.check_call.side_effect = self.fake_check_call
+        (self.tmp / 'dist').mkdir()
+        self.airship = self.create_airship({'python': {
+            'dist': self.tmp / 'dist',
+            'venv_cache_size': 1,
+        }})
+
+    def fake_check_call(self, args):
+        if args[1].endswith('virtualenv.py'):
+            path(args[2]).makedirs()
+
+    def deploy_bucket(self, requirements):
+        from airship.contrib.python import set_up_virtualenv_and_requirements
+        bucket = self.airship.new_bucket()
+        (bucket.folder / 'requirements.txt').write_text(requirements)
+        set_up_virtualenv_and_requirements(self.airship, bucket)
+        return bucket
+
+    def test_same_requirements_reuse_cached_virtualenv(self):
+        bucket_1 = self.deploy_bucket("Flask==0.9\n")
+        self.subprocess.check_call.reset_mock()
+        bucket_2 = self.deploy_bucket("Flask==0.9\n")
+        self.assertEqual(self.subprocess.check_call.mock_calls, [])
+        self.assertEqual((bucket_1.folder / '_virtualenv').realpath(),
+                         (bucket_2.folder / '_virtualenv').realpath())
+
+    def test_changed_requirements_build_new_virtualenv(self):
+        bucket_1 = self.deploy_bucket("Flask==0.9\n")
+        bucket_2 = self.deploy_bucket("Flask==0.10\n")
+        self.assertNotEqual((bucket_1.folder / '_virtualenv').realpath(),
+                            (bucket_2.folder / '_virtualenv').realpath())
+
+    def test_interpreter_is_resolved_in_path(self):
+        import os
+        from mock import patch
+        venvs = []
+        for name in ['a', 'b']:
+            bin_dir = self.tmp / name
+            bin_dir.mkdir()
+            (bin_dir / 'python').write_text('')
+            (bin_dir / 'python').chmod(0755)
+            with patch.dict(os.environ, {'PATH': bin_dir}):
+                bucket = self.deploy_bucket("Flask==0.9\n")
+            venvs.append((bucket.folder / '_virtualenv').realpath())
+        self.assertNotEqual(venvs[0], venvs[1])
+        self.assertEqual(self.subprocess.check_call.mock_calls[0][1][0][0],
+                         self.tmp / 'a' / 'python')
+
+    def test_unused_virtualenvs_are_evicted(self):
+        bucket_1 = self.deploy_bucket("Flask==0.9\n")
+        old_venv = (bucket_1.folder / '_virtualenv').realpath()
+        bucket_1.destroy()
+        self.deploy_bucket("Flask==0.10\n")
+        self.assertFalse(old_venv.isdir())
+
+
+def make_wheel(wheel_path, files, requires=(), entry_points=None):
+    import zipfile
+    dist, version = wheel_path.name.split('-')[:2]
+    metadata = ''.join('Requires-Dist: %s\n' % r for r in requires)
+    with zipfile.ZipFile(wheel_path, 'w') as archive:
+        for name in files:
+            archive.writestr(name, '')
+        if entry_points is not None:
+            archive.writestr('%s-%s.dist-info/entry_points.txt'
+                             % (dist, version), entry_points)
+        archive.writestr('%s-%s.dist-info/METADATA' % (dist, version),
+                         'Name: %s\n%s' % (dist, metadata))
+
+
+class ParallelInstallTest(AirshipTestCase):
+
+    def setUp(self):
+        from subprocess import CalledProcessError
+        self.subprocess = self.patch('airship.contrib.python.subprocess')
+        self.subprocess.CalledProcessError = CalledProcessError
+        self.subprocess.Popen.side_effect = self.fake_popen
+        self.failing = []
+        self.installed = []
+        self.build_dirs = []
+        (self.tmp / 'dist').mkdir()
+        for name, files in [
+                ('Flask-0.9-py27-none-any.whl', ['flask/__init__.py']),
+                ('Jinja2-2.6-py27-none-any.whl', ['jinja2/__init__.py']),
+                ('Jinja2-2.5-py27-none-any.whl', ['jinja2/__init__.py'])]:
+            make_wheel(self.tmp / 'dist' / name, files)
+        self.airship = self.create_airship({'python': {
+            'dist': self.tmp / 'dist',
+            'venv_cache_size': 0,
+        }})
+        self.bucket = self.airship.new_bucket()
+        (self.bucket.folder / 'requirements.txt').write_text(
+            "# web stuff\n"
+            "Flask==0.9\n"
+            "jinja2 == 2.6\n"
+            "some-sdist==1.0\n")
+
+    def fake_popen(self, args, **kwargs):
+        self.assertEqual(args[4], '--build')
+        self.assertTrue(path(args[5]).isdir())
+        self.build_dirs.append(args[5])
+        wheels = [path(arg).name for arg in args[6:]]
+        self.installed.append(args[:4] + wheels)
+        p = Mock(returncode=1 if set(wheels) & set(self.failing) else 0)
+        p.communicate.return_value = ('output for %s' % wheels, None)
+        return p
+
+    def set_up(self):
+        from airship.contrib.python import set_up_virtualenv_and_requirements
+        set_up_virtualenv_and_requirements(self.airship, self.bucket)
+
+    def test_wheels_are_installed_without_dependencies(self):
+        self.set_up()
+        pip = self.bucket.folder / '_virtualenv' / 'bin' / 'pip'
+        self.assertItemsEqual(self.installed, [
+            [pip, 'install', '--no-deps', '--no-index',
+             'Flask-0.9-py27-none-any.whl'],
+            [pip, 'install', '--no-deps', '--no-index',
+             'Jinja2-2.6-py27-none-any.whl'],
+        ])
+        last_call = self.subprocess.check_call.mock_calls[-1]
+        self.assertEqual(last_call[1][0][1:3],
+                         ['install', '-r'])
+
+    def test_each_pip_has_its_own_build_folder(self):
+        self.set_up()
+        self.assertEqual(len(set(self.build_dirs)), 2)
+        for build_dir in self.build_dirs:
+            self.assertFalse(path(build_dir).exists())
+
+    def test_failed_wheels_are_reported_together(self):
+        from airship.deployer import DeployError
+        self.failing = ['Flask-0.9-py27-none-any.whl',
+                        'Jinja2-2.6-py27-none-any.whl']
+        with self.assertRaises(DeployError) as e:
+            self.set_up()
+        self.assertEqual(e.exception.message,
+                         "Failed to install requirements: Flask, jinja2.")
+
+    def test_wheels_sharing_a_namespace_are_installed_together(self):
+        from airship.contrib.python import install_wheels
+        dist = self.tmp / 'dist'
+        make_wheel(dist / 'zope.component-4.0-py27-none-any.whl',
+                   ['zope/__init__.py', 'zope/component/__init__.py'],
+                   requires=['zope.interface (>=4.0)', 'zope.event'])
+        make_wheel(dist / 'zope.interface-4.0-py27-none-any.whl',
+                   ['zope/__init__.py', 'zope/interface/__init__.py',
+                    'zope.interface-4.0.data/purelib/zope/interface/x.so'])
+        wheels = {
+            'zope.component': dist / 'zope.component-4.0-py27-none-any.whl',
+            'zope.interface': dist / 'zope.interface-4.0-py27-none-any.whl',
+            'Flask': dist / 'Flask-0.9-py27-none-any.whl',
+        }
+        install_wheels('pip', wheels, 4)
+        self.assertItemsEqual(self.installed, [
+            ['pip', 'install', '--no-deps', '--no-index',
+             'Flask-0.9-py27-none-any.whl'],
+            ['pip', 'install', '--no-deps', '--no-index',
+             'zope.interface-4.0-py27-none-any.whl',
+             'zope.component-4.0-py27-none-any.whl'],
+        ])
+
+
+    def test_wheels_installing_the_same_script_are_installed_together(self):
+        from airship.contrib.python import group_wheels
+        dist = self.tmp / 'dist'
+        make_wheel(dist / 'a-1.0-py27-none-any.whl',
+                   ['a.py', 'a-1.0.data/scripts/tool'])
+        make_wheel(dist / 'b-1.0-py27-none-any.whl', ['b.py'],
+                   entry_points='[console_scripts]\ntool = b:main\n')
+        make_wheel(dist / 'c-1.0-py27-none-any.whl', ['c.py'],
+                   entry_points='[c.plugins]\ntool = c:main\n')
+        wheels = dict((name, dist / ('%s-1.0-py27-none-any.whl' % name))
+                      for name in ['a', 'b', 'c'])
+        self.assertEqual(group_wheels(wheels), [['a', 'b'], ['c']])
+
+
+class PrecompileTest(AirshipTestCase):
+
+    def setUp(self):
+        self.airship = self.create_airship({'python': {
+            'interpreter': sys.executable,
+            'compile_jobs': 2,
+        }})
+        self.venv = self.tmp / 'var' / 'venv-cache' / 'abc'
+        (self.venv / 'bin').makedirs()
+        path(sys.executable).symlink(self.venv / 'bin' / 'python')
+        (self.venv / 'lib.py').write_text('x = 1\n')
+
+    def new_bucket(self):
+        bucket = self.airship.new_bucket()
+        (bucket.folder / 'pkg').mkdir()
+        (bucket.folder / 'app.py').write_text('import pkg\n')
+        (bucket.folder / 'pkg' / '__init__.py').write_text('')
+        (bucket.folder / 'broken.py').write_text('def (\n')
+        self.venv.symlink(bucket.folder / '_virtualenv')
+        return bucket
+
+    def test_application_and_virtualenv_are_compiled(self):
+        from airship.contrib.python import precompile_bucket
+        bucket = self.new_bucket()
+        precompile_bucket(self.airship, bucket)
+        self.assertTrue((bucket.folder / 'app.pyc').isfile())
+        self.assertTrue((bucket.folder / 'pkg' / '__init__.pyc').isfile())
+        self.assertFalse((bucket.folder / 'broken.pyc').isfile())
+        self.assertTrue((self.venv / 'lib.pyc').isfile())
+        self.assertEqual([name for name, duration in bucket.timings],
+                         ['python.compile'])
+
+    def test_cached_virtualenv_is_compiled_once(self):
+        from airship.contrib.python import precompile_bucket
+        precompile_bucket(self.airship, self.new_bucket())
+        self.assertTrue((self.venv / '.airship-venv-compiled').isfile())
+        (self.venv / 'lib.pyc').unlink()
+        bucket = self.new_bucket()
+        precompile_bucket(self.airship, bucket)
+        self.assertFalse((self.venv / 'lib.pyc').isfile())
+        self.assertTrue((bucket.folder / 'app.pyc').isfile())
+
+
 class RunTest(AirshipTestCase):
 
     def test_run_activates_virtualenv(self):
@@ -63,3 +291,18 @@ class RunTest(AirshipTestCase):
             bucket.run('hello world')
         path_0 = calls[0].environ['PATH'].split(':')[0]
         self.assertEqual(path_0, venv / 'bin')
+
+    def test_launch_plan_activates_virtualenv_once(self):
+        from run_test import mock_exec
+        from airship.core import exec_launch_plan
+        from airship.contrib import python
+        airship = self.create_airship({'env': {'PATH': '/cfg'}})
+        python.load(airship)
+        bucket = airship.new_bucket()
+        bucket.process_types = {'web': 'run'}
+        venv = bucket.folder / '_virtualenv'
+        venv.mkdir()
+        bucket.write_launch_plan()
+        with mock_exec() as calls:
+            exec_launch_plan([str(self.tmp), 'run', '-d', bucket.id_, 'web'])
+        self.assertEqual(calls[0].environ['PATH'], (venv / 'bin') + ':/cfg')
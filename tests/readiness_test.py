@@ -0,0 +1,164 @@
+import os
+import socket
+import threading
+import BaseHTTPServer
+from common import AirshipTestCase
+from deploy_test import make_tarball
+
+
+class HealthHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200 if self.path == '/health' else 500)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ChecksTest(AirshipTestCase):
+
+    def test_tcp_check_connects_to_port(self):
+        from airship.readiness import check_tcp, NotReady
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        with self.assertRaises(NotReady):
+            check_tcp(port)
+        server.listen(1)
+        check_tcp(port)
+        server.close()
+
+    def test_http_check_requires_success_status(self):
+        from airship.readiness import check_http, NotReady
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), HealthHandler)
+        self.addCleanup(server.server_close)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        check_http(port, '/health')
+        thread.join()
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        with self.assertRaises(NotReady) as ctx:
+            check_http(port, '/missing')
+        thread.join()
+        self.assertIn('returned 500', str(ctx.exception))
+
+    def test_command_check_uses_exit_status(self):
+        from airship.readiness import check_command, NotReady
+        environ = dict(os.environ, PORT='8000')
+        check_command('test "$PORT" = 8000', self.tmp, environ)
+        with self.assertRaises(NotReady) as ctx:
+            check_command('echo starting; exit 3', self.tmp, environ)
+        self.assertIn('exited with 3: starting', str(ctx.exception))
+
+    def test_command_check_is_killed_at_deadline(self):
+        import time
+        from airship.readiness import check_command, NotReady
+        t0 = time.time()
+        with self.assertRaises(NotReady) as ctx:
+            check_command('sleep 10 & wait', self.tmp, os.environ, t0 + 0.2)
+        self.assertLess(time.time() - t0, 3)
+        self.assertIn('still running', str(ctx.exception))
+
+
+class WaitUntilReadyTest(AirshipTestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.sleeps = []
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+    def wait(self, checks, deadline):
+        from airship.readiness import wait_until_ready
+        wait_until_ready(checks, deadline, self.sleep, lambda: self.now)
+
+    def test_checks_are_retried_with_backoff(self):
+        from airship.readiness import NotReady
+        attempts = []
+
+        def check(deadline):
+            attempts.append(self.now)
+            if len(attempts) < 5:
+                raise NotReady("not yet")
+
+        self.wait([check], 10)
+        self.assertEqual(self.sleeps, [0.05, 0.1, 0.2, 0.4])
+
+    def test_last_failure_is_raised_at_deadline(self):
+        from airship.readiness import NotReady
+
+        def check(deadline):
+            raise NotReady("still down at %g" % self.now)
+
+        with self.assertRaises(NotReady) as ctx:
+            self.wait([check], 3)
+        self.assertEqual(str(ctx.exception), "still down at 3")
+        self.assertEqual(self.sleeps[-2], 1)
+        self.assertAlmostEqual(sum(self.sleeps), 3)
+
+
+class DeployReadinessTest(AirshipTestCase):
+
+    def setUp(self):
+        self.patch('airship.daemons.Supervisor.ctl')
+        self.patch('airship.deployer.start_reaper')
+        self.artifact = self.tmp / 'app.tar'
+        self.artifact.write_bytes(make_tarball({
+            'Procfile': 'web: run\nworker: work\n',
+        }))
+
+    def deploy(self, readiness):
+        from airship.deployer import deploy
+        airship = self.create_airship({'port_map': {'web': 8000},
+                                       'readiness': readiness})
+        return deploy(airship, self.artifact)
+
+    def test_deploy_waits_for_readiness(self):
+        bucket = self.deploy({'worker': {'command': 'touch ready'}})
+        self.assertTrue((bucket.folder / 'ready').isfile())
+        self.assertIn('ready', [name for name, _ in bucket.timings])
+
+    def test_deploy_fails_with_cause_on_timeout(self):
+        from airship.deployer import DeployError
+        with self.assertRaises(DeployError) as ctx:
+            self.deploy({'web': {'command': 'echo "no $PORT"; false',
+                                 'timeout': 0}})
+        self.assertEqual(ctx.exception.message,
+                         "Process 'web' is not ready after 0s: 'echo \"no "
+                         "$PORT\"; false' exited with 1: no 8000")
+
+    def test_old_bucket_is_restarted_if_new_one_is_not_ready(self):
+        from airship.deployer import deploy, DeployError
+        old_bucket = self.deploy({'web': {'command': 'true'}})
+        airship = old_bucket.airship
+        airship.config['readiness'] = {'web': {'command': 'false',
+                                               'timeout': 0}}
+        with self.assertRaises(DeployError):
+            deploy(airship, self.artifact)
+        states = dict((info['id'], info['state'])
+                      for info in airship.list_buckets()['buckets'])
+        self.assertEqual(states.pop(old_bucket.id_), 'running')
+        self.assertEqual(states.values(), ['stopped'])
+        self.assertEqual(airship.active_bucket_id(), old_bucket.id_)
+
+    def test_tcp_check_is_refused_with_socket_activation(self):
+        from airship.deployer import deploy, DeployError
+        airship = self.create_airship({'port_map': {'web': 8000},
+                                       'socket_activation': True,
+                                       'readiness': {'web': {'tcp': True}}})
+        with self.assertRaises(DeployError) as ctx:
+            deploy(airship, self.artifact)
+        self.assertIn('socket_activation', ctx.exception.message)
+
+    def test_process_types_with_readiness_check_have_no_startsecs(self):
+        from supervisor_test import config_file_checker
+        bucket = self.deploy({'worker': {'command': 'true'}})
+        eq_config = config_file_checker(self.tmp / 'etc' / 'supervisor.d' /
+                                        bucket.id_)
+        eq_config('program:%s-web' % bucket.id_, 'startsecs', '2')
+        eq_config('program:%s-worker' % bucket.id_, 'startsecs', '0')
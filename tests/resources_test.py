@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import subprocess
+from mock import patch
+from common import AirshipTestCase
+from deploy_test import make_tarball
+
+REPORT = ('ulimit -n; nice; ionice; cat /proc/self/oom_score_adj; '
+          'grep Cpus_allowed_list /proc/self/status')
+
+
+class CheckSettingsTest(AirshipTestCase):
+
+    def check(self, settings):
+        from airship.resources import check_settings
+        with self.assertRaises(ValueError) as ctx:
+            check_settings(settings)
+        return str(ctx.exception)
+
+    def test_valid_settings_pass(self):
+        from airship.resources import check_settings
+        check_settings({'cpu_affinity': [0], 'nice': 10,
+                        'ionice': 'best-effort 7', 'nofile': 1024,
+                        'oom_score_adj': 500})
+        check_settings({'cpu_affinity': 0, 'ionice': 'idle'})
+
+    def test_invalid_settings_are_reported(self):
+        self.assertEqual(self.check({'nofiles': 10}),
+                         "unknown settings: nofiles")
+        self.assertIn("cpu_affinity must be CPU numbers",
+                      self.check({'cpu_affinity': [4096]}))
+        self.assertEqual(self.check({'nice': 20}),
+                         "nice must be -20 to 19, not 20")
+        self.assertIn("ionice must be one of best-effort, idle, realtime",
+                      self.check({'ionice': 'slow'}))
+        self.assertEqual(self.check({'ionice': 'best-effort 9'}),
+                         "ionice level must be 0 to 7, not '9'")
+        self.assertEqual(self.check({'nofile': '1024'}),
+                         "nofile must be a positive number, not '1024'")
+        self.assertEqual(self.check({'oom_score_adj': 2000}),
+                         "oom_score_adj must be -1000 to 1000, not 2000")
+
+    def test_ionice_needs_ionice_command(self):
+        with patch('airship.resources.find_executable', return_value=None):
+            self.assertEqual(self.check({'ionice': 'idle'}),
+                             "ionice needs the ionice command, which is not "
+                             "in PATH")
+
+    def test_privileged_settings_need_root(self):
+        import resource
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        with patch('os.geteuid', return_value=1000):
+            self.assertEqual(self.check({'oom_score_adj': -100}),
+                             "only root can set a negative oom_score_adj")
+            self.assertEqual(self.check({'ionice': 'realtime'}),
+                             "only root can use the realtime ionice class")
+            if hard != resource.RLIM_INFINITY:
+                self.assertEqual(self.check({'nofile': hard + 1}),
+                                 "nofile %d is above the hard limit (%d)"
+                                 % (hard + 1, hard))
+
+
+class ApplySettingsTest(AirshipTestCase):
+
+    settings = {'nofile': 1000, 'nice': 5, 'ionice': 'idle',
+                'oom_score_adj': 300, 'cpu_affinity': [0]}
+
+    def setUp(self):
+        (self.tmp / 'etc' / 'airship.yaml').write_text(json.dumps(
+            {'resources': {'report': self.settings}}))
+        self.bucket = self.create_airship().new_bucket()
+        self.bucket.process_types = {'report': REPORT}
+        self.bucket.save_metadata()
+
+    def airship_run(self):
+        import airship
+        package_root = os.path.dirname(os.path.dirname(
+            os.path.abspath(airship.__file__)))
+        environ = dict(os.environ, PYTHONPATH=package_root)
+        return subprocess.check_output(
+            [sys.executable, '-c', 'from airship.core import main; main()',
+             self.tmp, 'run', '-d', self.bucket.id_, 'report'],
+            env=environ).splitlines()
+
+    def test_settings_are_applied_before_exec(self):
+        self.assertEqual(self.airship_run(),
+                         ['1000', '5', 'idle', '300',
+                          'Cpus_allowed_list:\t0'])
+
+    def test_launch_plan_applies_settings(self):
+        self.bucket.write_launch_plan()
+        # the slow path would run this instead
+        self.bucket.save_config(process_types={'report': 'echo slow'})
+        self.assertEqual(self.airship_run()[:2], ['1000', '5'])
+
+
+class DeployValidationTest(AirshipTestCase):
+
+    def setUp(self):
+        self.patch('airship.daemons.Supervisor.ctl')
+        self.patch('airship.deployer.start_reaper')
+        self.artifact = self.tmp / 'app.tar'
+        self.artifact.write_bytes(make_tarball({'Procfile': 'web: run\n'}))
+
+    def test_deploy_fails_on_invalid_resources(self):
+        from airship.deployer import deploy, DeployError
+        airship = self.create_airship({'resources': {'web': {'nice': 99},
+                                                     'other': {'nice': 99}}})
+        with self.assertRaises(DeployError) as ctx:
+            deploy(airship, self.artifact)
+        self.assertEqual(ctx.exception.message,
+                         "Invalid resources for process 'web': "
+                         "nice must be -20 to 19, not 99")
@@ -1,7 +1,7 @@
 import os
 from contextlib import contextmanager
 from collections import namedtuple
-from mock import patch
+from mock import patch, call
 from common import AirshipTestCase
 
 
@@ -37,6 +37,15 @@ class MockProcessTest(AirshipTestCase):
             bucket.run('thing')
         self.assertEqual(calls[0].environ['PORT'], '13')
 
+    def test_run_instance_gets_port_from_range(self):
+        airship = self.create_airship({'port_map': {'thing': 8000}})
+        bucket = airship.new_bucket()
+        bucket.process_types = {'thing': "run the 'thing' process"}
+        with mock_exec() as calls:
+            bucket.run('thing', instance=2)
+        self.assertEqual(calls[0].environ['PORT'], '8002')
+        self.assertEqual(calls[0].environ['AIRSHIP_INSTANCE'], '2')
+
     def test_run_starts_process_from_list(self):
         THING_PROC = "run the 'thing' process"
         bucket = self.create_airship().new_bucket()
@@ -44,3 +53,82 @@ class MockProcessTest(AirshipTestCase):
         with mock_exec() as calls:
             bucket.run('thing')
         self.assertEqual(calls[0].args[-1], THING_PROC)
+
+    def test_run_inherits_socket_with_socket_activation(self):
+        airship = self.create_airship({'port_map': {'thing': 8000},
+                                       'socket_activation': True})
+        bucket = airship.new_bucket()
+        bucket.process_types = {'thing': "run the 'thing' process"}
+        with patch('airship.sockets.inherit_socket') as inherit_socket:
+            with mock_exec():
+                bucket.run('thing', instance=1)
+        self.assertEqual(inherit_socket.call_args[0][:2],
+                         (self.tmp / 'var' / 'run' / 'sockets.sock', 8001))
+
+
+class LaunchPlanTest(AirshipTestCase):
+
+    def setUp(self):
+        self.airship = self.create_airship({'port_map': {'thing': 13},
+                                            'env': {'GREETING': 'hi'}})
+        self.bucket = self.airship.new_bucket()
+        self.bucket.process_types = {'thing': "run the 'thing' process"}
+        self.bucket.write_launch_plan()
+
+    def run_cmd(self, *args):
+        from airship.core import main
+        with mock_exec() as calls:
+            main([str(self.tmp), 'run'] + list(args))
+        return calls
+
+    def test_run_execs_launch_plan(self):
+        from airship.core import exec_launch_plan
+        with mock_exec() as calls:
+            exec_launch_plan([str(self.tmp), 'run',
+                              '-d', self.bucket.id_, 'thing'])
+        self.assertEqual(calls[0].procname, '/bin/bash')
+        self.assertEqual(calls[0].args[-1], "run the 'thing' process")
+        self.assertEqual(calls[0].environ['PORT'], '13')
+        self.assertEqual(calls[0].environ['GREETING'], 'hi')
+
+    def test_launch_plan_sets_instance_port(self):
+        from airship.core import exec_launch_plan
+        with mock_exec() as calls:
+            exec_launch_plan([str(self.tmp), 'run',
+                              '-d', self.bucket.id_, '-i', '3', 'thing'])
+        self.assertEqual(calls[0].environ['PORT'], '16')
+        self.assertEqual(calls[0].environ['AIRSHIP_INSTANCE'], '3')
+
+    def test_launch_plan_inherits_socket(self):
+        from airship.core import exec_launch_plan
+        self.airship.config['socket_activation'] = True
+        self.bucket.write_launch_plan()
+        with patch('airship.sockets.inherit_socket') as inherit_socket:
+            with mock_exec():
+                exec_launch_plan([str(self.tmp), 'run',
+                                  '-d', self.bucket.id_, 'thing'])
+        self.assertEqual(inherit_socket.call_args[0][1], 13)
+
+    def test_launch_plan_keeps_env_and_handler_changes(self):
+        from airship.core import exec_launch_plan, bucket_run
+
+        def prepend_path(airship, bucket, environ, **extra):
+            environ['PATH'] = '/venv/bin:' + environ['PATH']
+
+        bucket_run.connect(prepend_path)
+        self.addCleanup(bucket_run.disconnect, prepend_path)
+        with patch.dict(os.environ, {'GREETING': 'hi', 'PATH': '/deployer'}):
+            self.bucket.write_launch_plan()
+        with patch.dict(os.environ, {'PATH': '/supervisord'}):
+            os.environ.pop('GREETING', None)
+            with mock_exec() as calls:
+                exec_launch_plan([str(self.tmp), 'run',
+                                  '-d', self.bucket.id_, 'thing'])
+        self.assertEqual(calls[0].environ['GREETING'], 'hi')
+        self.assertEqual(calls[0].environ['PATH'], '/venv/bin:/supervisord')
+
+    def test_launch_plan_is_ignored_after_config_changes(self):
+        (self.tmp / 'etc' / 'airship.yaml').write_text('{}')
+        with patch('airship.core.Bucket.run') as run:
+            self.run_cmd('-d', self.bucket.id_, 'thing')
+        self.assertEqual(run.mock_calls, [call('thing', instance=None)])
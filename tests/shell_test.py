@@ -21,19 +21,20 @@ class ShellTest(AirshipTestCase):
     def test_run_bucket_calls_api_method_with_args(self, run):
         bucket = self.create_airship().new_bucket()
         imp('airship.core').main([str(self.tmp), 'run', '-d', bucket.id_, 'a'])
-        self.assertEqual(run.mock_calls, [call('a')])
+        self.assertEqual(run.mock_calls, [call('a', instance=None)])
 
     @patch('airship.core.Bucket.run')
     def test_run_bucket_does_not_require_bucket_id(self, run):
         bucket = self.create_airship().new_bucket()
         imp('airship.core').main([str(self.tmp), 'run', 'a'])
-        self.assertEqual(run.mock_calls, [call('a')])
+        self.assertEqual(run.mock_calls, [call('a', instance=None)])
 
     @patch('airship.core.Bucket.run')
     def test_run_bucket_quotes_its_arguments(self, run):
         bucket = self.create_airship().new_bucket()
         imp('airship.core').main([str(self.tmp), 'run', 'some', 'other thing'])
-        self.assertEqual(run.mock_calls, [call("some 'other thing'")])
+        self.assertEqual(run.mock_calls,
+                         [call("some 'other thing'", instance=None)])
 
     @patch('airship.core.Airship.list_buckets')
     def test_destroy_bucket_calls_api_method(self, list_buckets):
@@ -42,7 +43,7 @@ class ShellTest(AirshipTestCase):
         with patch('sys.stdout', StringIO()) as stdout:
             config = json.dumps({'hello': "world"})
             imp('airship.core').main([str(self.tmp), 'list'])
-        self.assertEqual(list_buckets.mock_calls, [call()])
+        self.assertEqual(list_buckets.mock_calls, [call(None, None)])
         self.assertEqual(json.loads(stdout.getvalue()), data)
 
     def test_init_creates_configuration_and_bin_scripts(self):
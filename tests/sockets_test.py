@@ -0,0 +1,82 @@
+import os
+import socket
+import threading
+from common import AirshipTestCase
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class SocketHolderTest(AirshipTestCase):
+
+    def setUp(self):
+        from airship.sockets import SocketHolder
+        self.holder = SocketHolder(self.tmp / 'sockets.sock', '127.0.0.1')
+        self.holder.listen()
+        self.addCleanup(self.holder.server.close)
+
+    def request(self, port):
+        from airship.sockets import receive_socket
+        thread = threading.Thread(target=self.holder.handle_request)
+        thread.start()
+        try:
+            return receive_socket(self.tmp / 'sockets.sock', port, wait=1)
+        finally:
+            thread.join()
+
+    def test_client_receives_listening_socket(self):
+        port = free_port()
+        fd = self.request(port)
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        self.assertEqual(sock.getsockname()[1], port)
+        client = socket.create_connection(('127.0.0.1', port), 1)
+        conn, _ = sock.accept()
+        conn.close()
+        client.close()
+        sock.close()
+
+    def test_port_is_bound_once(self):
+        port = free_port()
+        os.close(self.request(port))
+        os.close(self.request(port))
+        self.assertEqual(self.holder.sockets.keys(), [port])
+
+    def test_busy_port_is_reported(self):
+        busy = socket.socket()
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        self.addCleanup(busy.close)
+        with self.assertRaises(socket.error) as ctx:
+            self.request(busy.getsockname()[1])
+        self.assertIn('error: port', str(ctx.exception))
+
+    def test_missing_holder_is_reported(self):
+        from airship.sockets import receive_socket
+        with self.assertRaises(socket.error):
+            receive_socket(self.tmp / 'nothing.sock', 8000, wait=0)
+
+
+class ActivationConfigTest(AirshipTestCase):
+
+    def test_ports_cover_instances_and_slots(self):
+        from airship.sockets import activation_ports
+        ports = activation_ports({
+            'port_map': {'web': 8000, 'admin': 9000},
+            'instances': {'web': 2},
+            'blue_green': {'ports': {'web': [8100, 8200]}},
+        })
+        self.assertEqual(ports, [8000, 8001, 8100, 8101, 8200, 8201, 9000])
+
+    def test_settings_have_defaults(self):
+        from airship.sockets import activation_config
+        self.assertIsNone(activation_config({}))
+        self.assertEqual(activation_config({'socket_activation': True}),
+                         {'host': '0.0.0.0', 'backlog': 1024})
+        self.assertEqual(activation_config({'socket_activation':
+                                            {'backlog': 10}})['backlog'], 10)
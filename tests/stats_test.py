@@ -0,0 +1,79 @@
+import json
+from StringIO import StringIO
+from mock import patch
+from common import AirshipTestCase, imp
+from deploy_test import make_tarball
+
+
+class DeployTimingTest(AirshipTestCase):
+
+    def setUp(self):
+        self.patch('airship.deployer.start_reaper')
+        self.airship = self.create_airship()
+        self.artifact = self.tmp / 'app.tar'
+        self.artifact.write_bytes(make_tarball({'Procfile': 'web: run\n'}))
+
+    def deploy(self):
+        from airship.deployer import deploy
+        deploy(self.airship, self.artifact)
+        return self.airship.get_bucket()
+
+    def test_deploy_records_stage_timings(self):
+        bucket = self.deploy()
+        stages = [name for name, seconds in bucket.config['timings']]
+        self.assertEqual(stages, ['extract', 'bucket_setup',
+                                  'stop_old_buckets', 'start',
+                                  'remove_old_buckets'])
+        [entry] = self.airship.meta_db['deploy_history']
+        self.assertEqual(entry['bucket'], bucket.id_)
+        self.assertTrue(entry['ok'])
+
+    def test_plugins_can_time_sub_stages(self):
+        from airship.deployer import bucket_setup
+        from airship.stats import timed_stage
+
+        def handler(airship, bucket):
+            with timed_stage(bucket, 'myplugin.assets'):
+                pass
+
+        with bucket_setup.connected_to(handler):
+            bucket = self.deploy()
+        stages = [name for name, seconds in bucket.config['timings']]
+        self.assertIn('myplugin.assets', stages)
+
+    def test_history_is_bounded(self):
+        with patch('airship.stats.DEPLOY_HISTORY_SIZE', 3):
+            for c in range(5):
+                self.deploy()
+        history = self.airship.meta_db['deploy_history']
+        self.assertEqual([e['bucket'] for e in history], ['d3', 'd4', 'd5'])
+
+    def test_failed_deploy_is_recorded(self):
+        from airship.deployer import deploy, DeployError
+        self.artifact.write_bytes('not a tarball')
+        with self.assertRaises(DeployError):
+            deploy(self.airship, self.artifact)
+        [entry] = self.airship.meta_db['deploy_history']
+        self.assertFalse(entry['ok'])
+
+
+class StatsTest(AirshipTestCase):
+
+    def test_percentiles_per_stage(self):
+        from airship.stats import deploy_stats
+        history = [{'total': float(n), 'timings': [['extract', n / 10.0]]}
+                   for n in range(1, 11)]
+        stats = deploy_stats(history)
+        self.assertEqual(stats['total']['p50'], 5.0)
+        self.assertEqual(stats['total']['p90'], 9.0)
+        self.assertEqual(stats['extract']['max'], 1.0)
+        self.assertEqual(stats['extract']['count'], 10)
+
+    def test_stats_command_prints_json(self):
+        airship = self.create_airship()
+        airship.meta_db['deploy_history'] = [
+            {'total': 2.0, 'timings': [['start', 0.5]]}]
+        with patch('sys.stdout', StringIO()) as stdout:
+            imp('airship.core').main([str(self.tmp), 'stats'])
+        stats = json.loads(stdout.getvalue())
+        self.assertEqual(stats['start']['p50'], 0.5)
@@ -0,0 +1,62 @@
+import json
+import sqlite3
+from common import AirshipTestCase
+
+
+class StoreTest(AirshipTestCase):
+
+    def open_store(self, read_only=False):
+        from airship.store import open_store
+        return open_store(self.tmp / 'etc' / 'buckets.db', read_only)
+
+    def test_database_uses_wal(self):
+        store = self.open_store()
+        self.assertEqual(store.execute('PRAGMA journal_mode'), [('wal',)])
+
+    def test_connection_is_shared_in_process(self):
+        airship = self.create_airship()
+        self.assertIs(self.create_airship().store, airship.store)
+
+    def test_read_only_store_refuses_writes(self):
+        store = self.open_store(read_only=True)
+        with self.assertRaises(sqlite3.OperationalError):
+            store.table('meta')['a'] = 1
+        self.open_store()
+        store.table('meta')['a'] = 1
+        self.assertFalse(store.read_only)
+
+    def test_failed_transaction_writes_nothing(self):
+        meta = self.open_store().table('meta')
+        with self.assertRaises(ValueError):
+            with meta.lock():
+                meta['a'] = 1
+                with meta.lock():
+                    meta['b'] = 2
+                raise ValueError
+        self.assertEqual(dict(meta), {})
+
+    def test_kv_database_is_upgraded(self):
+        db = sqlite3.connect(self.tmp / 'etc' / 'buckets.db')
+        db.execute('CREATE TABLE bucket (key PRIMARY KEY, value)')
+        db.execute('INSERT INTO bucket VALUES (?, ?)',
+                   ('d1', json.dumps({'state': 'running'})))
+        db.commit()
+        db.close()
+        airship = self.create_airship()
+        self.assertEqual(airship.get_bucket().id_, 'd1')
+        self.assertEqual(airship.store.execute('PRAGMA journal_mode'),
+                         [('wal',)])
+
+
+class ReadOnlyAirshipTest(AirshipTestCase):
+
+    def test_read_only_airship_finds_buckets(self):
+        from airship.core import Airship
+        from airship.store import close_stores
+        airship = self.create_airship()
+        airship.new_bucket()
+        bucket = airship.new_bucket()
+        close_stores()
+        reader = Airship({'home': self.tmp}, read_only=True)
+        self.assertEqual(reader.get_bucket().id_, bucket.id_)
+        self.assertTrue(reader.store.read_only)
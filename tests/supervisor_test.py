@@ -1,7 +1,12 @@
+import os
 import sys
 import ConfigParser
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
 from path import path
-from mock import call, ANY
+from mock import Mock, call, ANY
 from common import AirshipTestCase
 
 
@@ -32,7 +37,8 @@ def config_file_checker(cfg_path):
 class SupervisorConfigurationTest(AirshipTestCase):
 
     def setUp(self):
-        self.mock_supervisorctl = self.patch('airship.daemons.Supervisor.ctl')
+        self.patch('airship.daemons.Supervisor.ctl')
+        self.mock_update = self.patch('airship.daemons.Supervisor.update')
 
     def test_generate_supervisord_cfg_with_no_deployments(self):
         self.create_airship().generate_supervisord_configuration()
@@ -52,6 +58,30 @@ class SupervisorConfigurationTest(AirshipTestCase):
         eq_config('supervisorctl', 'serverurl',
                   'unix://' + self.tmp / 'var' / 'run' / 'supervisor.sock')
         eq_config('include', 'files', self.tmp / 'etc/supervisor.d/*')
+        config = read_config(config_path)
+        self.assertFalse(config.has_section('program:airship-sockets'))
+
+    def test_socket_activation_adds_socket_holder_program(self):
+        airship = self.create_airship({'socket_activation': True})
+        airship.generate_supervisord_configuration()
+        eq_config = config_file_checker(self.tmp / 'etc' / 'supervisor.conf')
+        eq_config('program:airship-sockets', 'command',
+                  self.tmp / 'bin' / 'airship' + ' sockets')
+        eq_config('program:airship-sockets', 'priority', '1')
+
+    def test_event_listener_is_configured(self):
+        self.create_airship().generate_supervisord_configuration()
+        eq_config = config_file_checker(self.tmp / 'etc' / 'supervisor.conf')
+        eq_config('eventlistener:airship-events', 'command',
+                  self.tmp / 'bin' / 'airship' + ' event-listener')
+        eq_config('eventlistener:airship-events', 'events', 'PROCESS_STATE')
+
+    def test_agent_adds_agent_program(self):
+        airship = self.create_airship({'agent': True})
+        airship.generate_supervisord_configuration()
+        eq_config = config_file_checker(self.tmp / 'etc' / 'supervisor.conf')
+        eq_config('program:airship-agent', 'command',
+                  self.tmp / 'bin' / 'airship' + ' agent')
 
     def bucket_cfg(self, bucket):
         return self.tmp / 'etc' / 'supervisor.d' / bucket.id_
@@ -72,7 +102,9 @@ class SupervisorConfigurationTest(AirshipTestCase):
                   'bin/airship run -d {0} one'.format(bucket.id_))
         eq_config(section, 'redirect_stderr', 'true')
         eq_config(section, 'stdout_logfile',
-                  self.tmp / 'var' / 'log' / 'one.log')
+                  self.tmp / 'var' / 'log' / (bucket.id_ + '-one.log'))
+        eq_config(section, 'stdout_logfile_maxbytes', '50MB')
+        eq_config(section, 'stdout_logfile_backups', '10')
         eq_config(section, 'startretries', '1')
 
     def test_bucket_start_changes_autostart_to_true(self):
@@ -85,6 +117,16 @@ class SupervisorConfigurationTest(AirshipTestCase):
         eq_config = config_file_checker(self.bucket_cfg(bucket))
         eq_config(section, 'autostart', 'true')
         eq_config(section, 'startsecs', '2')
+        eq_config(section, 'autorestart', 'unexpected')
+
+    def test_restart_backoff_leaves_restarts_to_event_listener(self):
+        airship = self.create_airship({'restart_backoff': True})
+        bucket = airship.new_bucket()
+        (bucket.folder / 'Procfile').write_text('web: ./runweb $PORT\n')
+        bucket._read_procfile()
+        bucket.start()
+        eq_config = config_file_checker(self.bucket_cfg(bucket))
+        eq_config('program:%s-web' % bucket.id_, 'autorestart', 'false')
 
     def test_bucket_stop_changes_autostart_to_false(self):
         bucket = self.create_airship().new_bucket()
@@ -98,29 +140,54 @@ class SupervisorConfigurationTest(AirshipTestCase):
         eq_config(section, 'autostart', 'false')
         eq_config(section, 'startsecs', '0')
 
-    def test_bucket_start_triggers_supervisord_update(self):
+    def new_bucket_with_web(self):
         bucket = self.create_airship().new_bucket()
-        self.mock_supervisorctl.reset_mock()
+        (bucket.folder / 'Procfile').write_text('web: ./runweb $PORT\n')
+        bucket._read_procfile()
+        return bucket
+
+    def test_bucket_start_triggers_supervisord_update(self):
+        bucket = self.new_bucket_with_web()
+        self.mock_update.reset_mock()
         bucket.start()
-        self.assertEqual(self.mock_supervisorctl.mock_calls,
-                         [call(['update'])])
+        self.assertEqual(self.mock_update.mock_calls,
+                         [call([bucket.id_ + '-web'])])
 
     def test_bucket_stop_triggers_supervisord_update(self):
-        bucket = self.create_airship().new_bucket()
+        bucket = self.new_bucket_with_web()
         bucket.start()
-        self.mock_supervisorctl.reset_mock()
+        self.mock_update.reset_mock()
         bucket.stop()
-        self.assertEqual(self.mock_supervisorctl.mock_calls,
-                         [call(['update'])])
+        self.assertEqual(self.mock_update.mock_calls,
+                         [call([bucket.id_ + '-web'])])
+
+    def test_unchanged_bucket_configuration_does_not_trigger_update(self):
+        bucket = self.new_bucket_with_web()
+        bucket.start()
+        self.mock_update.reset_mock()
+        bucket.start()
+        self.assertEqual(self.mock_update.mock_calls, [])
+
+    def test_removed_process_type_is_updated(self):
+        bucket = self.new_bucket_with_web()
+        bucket.start()
+        (bucket.folder / 'Procfile').write_text('worker: ./work\n')
+        bucket.process_types = {}
+        bucket._read_procfile()
+        self.mock_update.reset_mock()
+        bucket.start()
+        self.assertEqual(self.mock_update.mock_calls,
+                         [call([bucket.id_ + '-worker',
+                                bucket.id_ + '-web'])])
 
     def test_bucket_destroy_triggers_supervisord_update(self):
-        bucket = self.create_airship().new_bucket()
+        bucket = self.new_bucket_with_web()
         bucket.start()
         bucket.stop()
-        self.mock_supervisorctl.reset_mock()
+        self.mock_update.reset_mock()
         bucket.destroy()
-        self.assertEqual(self.mock_supervisorctl.mock_calls,
-                         [call(['update'])])
+        self.assertEqual(self.mock_update.mock_calls,
+                         [call([bucket.id_ + '-web'])])
 
     def test_destroy_bucket_removes_its_supervisor_configuration(self):
         bucket = self.create_airship().new_bucket()
@@ -131,6 +198,44 @@ class SupervisorConfigurationTest(AirshipTestCase):
         self.assertFalse(cfg_path.isfile())
 
 
+class MultipleInstancesTest(AirshipTestCase):
+
+    def setUp(self):
+        self.patch('airship.daemons.Supervisor.ctl')
+
+    def test_instances_become_numprocs(self):
+        bucket = self.create_airship({'instances': {'web': 3}}).new_bucket()
+        bucket.process_types = {'web': './runweb $PORT', 'worker': './work'}
+        bucket.start()
+        eq_config = config_file_checker(self.tmp / 'etc' / 'supervisor.d' /
+                                        bucket.id_)
+        section = 'program:%s-web' % bucket.id_
+        eq_config(section, 'numprocs', '3')
+        eq_config(section, 'process_name',
+                  '%(program_name)s_%(process_num)02d')
+        eq_config(section, 'command',
+                  'bin/airship run -d %s -i %%(process_num)s web' % bucket.id_)
+        eq_config(section, 'stdout_logfile',
+                  self.tmp / 'var' / 'log' /
+                  (bucket.id_ + '-web_%(process_num)02d.log'))
+        eq_config('program:%s-worker' % bucket.id_, 'numprocs', MISSING)
+
+    def test_invalid_instances_fail_deployment(self):
+        from airship.deployer import check_instances, DeployError
+        airship = self.create_airship()
+        bucket = airship.new_bucket()
+        bucket.process_types = {'web': './runweb $PORT'}
+        for value in [0, '2', True]:
+            airship.config['instances'] = {'web': value, 'other': 0}
+            with self.assertRaises(DeployError) as ctx:
+                check_instances(bucket)
+            self.assertEqual(ctx.exception.message,
+                             "Invalid instances for process 'web': must be "
+                             "a positive integer, not %r" % (value,))
+        airship.config['instances'] = {'web': 2, 'other': 0}
+        check_instances(bucket)
+
+
 class SupervisorInvocationTest(AirshipTestCase):
 
     def test_invoke_supervisorctl(self):
@@ -143,3 +248,117 @@ class SupervisorInvocationTest(AirshipTestCase):
                          [call([supervisorctl_path,
                                 '-c', cfg_path,
                                 'hello', 'world!'], stdout=ANY)])
+
+
+class SupervisorRPCTest(AirshipTestCase):
+
+    def setUp(self):
+        self.daemons = self.create_airship().daemons
+        self.mock_supervisorctl = self.patch('airship.daemons.Supervisor.ctl')
+        self.proxy = Mock()
+        self.daemons.rpc._proxy = self.proxy
+        (self.tmp / 'var' / 'run').makedirs_p()
+
+    def test_update_reports_faults_as_supervisor_error(self):
+        import xmlrpclib
+        from airship.daemons import SupervisorError
+        self.daemons.socket_path.write_text('')
+        self.proxy.supervisor.reloadConfig.return_value = [
+            [[], [], ['d1-web']]]
+        self.proxy.supervisor.stopProcessGroup.return_value = []
+        self.proxy.supervisor.removeProcessGroup.side_effect = \
+            xmlrpclib.Fault(91, 'STILL_RUNNING')
+        with self.assertRaises(SupervisorError):
+            self.daemons.update()
+
+    def test_update_falls_back_to_supervisorctl_without_socket(self):
+        self.daemons.update(['d1-web'])
+        self.assertEqual(self.proxy.mock_calls, [])
+        self.assertEqual(self.mock_supervisorctl.mock_calls,
+                         [call(['update'])])
+
+
+# stops a moment after SIGTERM, so that removing its group too early fails
+SLOW_STOPPING = "bash -c \"trap 'sleep 0.3; exit' TERM; sleep %d & wait\""
+
+REAL_SUPERVISORD_CFG = """\
+[unix_http_server]
+file = %(home)s/var/run/supervisor.sock
+
+[rpcinterface:supervisor]
+supervisor.rpcinterface_factory = \
+supervisor.rpcinterface:make_main_rpcinterface
+
+[supervisord]
+logfile = %(home)s/var/log/supervisor.log
+pidfile = %(home)s/var/run/supervisor.pid
+
+[include]
+files = %(home)s/etc/supervisor.d/*
+"""
+
+
+class RealSupervisordTest(AirshipTestCase):
+
+    def setUp(self):
+        import time
+        import subprocess
+        try:
+            import supervisor
+        except ImportError:
+            raise unittest.SkipTest("supervisor is not installed")
+        self.daemons = self.create_airship().daemons
+        (self.tmp / 'var' / 'run').makedirs_p()
+        (self.tmp / 'var' / 'log').makedirs_p()
+        config_path = self.tmp / 'etc' / 'supervisord-test.conf'
+        config_path.write_text(REAL_SUPERVISORD_CFG % {'home': self.tmp})
+        self.write_programs('d1', {'web': 100, 'worker': 100})
+        with open(os.devnull, 'wb') as devnull:
+            supervisord = subprocess.Popen([sys.executable, '-m',
+                                            'supervisor.supervisord', '-n',
+                                            '-c', config_path],
+                                           stdout=devnull, stderr=devnull)
+        self.addCleanup(supervisord.wait)
+        self.addCleanup(supervisord.terminate)
+        for c in range(100):
+            if self.daemons.socket_path.exists():
+                break
+            time.sleep(0.05)
+        self.wait_until_running(['d1-web', 'd1-worker'])
+
+    def write_programs(self, bucket_id, programs):
+        cfg_path = self.tmp / 'etc' / 'supervisor.d' / bucket_id
+        cfg_path.write_text(''.join(
+            '[program:%s-%s]\ncommand = %s\nstartsecs = 0\n\n'
+            % (bucket_id, procname, SLOW_STOPPING % seconds)
+            for procname, seconds in sorted(programs.items())))
+
+    def process_states(self):
+        return dict((info['group'], info['statename'])
+                    for info in self.daemons.rpc.get_all_process_info())
+
+    def wait_until_running(self, groups):
+        import time
+        for c in range(100):
+            states = self.process_states()
+            if all(states.get(group) == 'RUNNING' for group in groups):
+                return states
+            time.sleep(0.05)
+        self.fail("Not running: %r" % states)
+
+    def test_changed_and_removed_groups_are_updated(self):
+        web_pid = self.daemons.rpc.get_process_info('d1-web:d1-web')['pid']
+        self.write_programs('d1', {'web': 200})
+        self.daemons.rpc.update()
+        states = self.wait_until_running(['d1-web'])
+        self.assertEqual(states.keys(), ['d1-web'])
+        self.assertNotEqual(
+            self.daemons.rpc.get_process_info('d1-web:d1-web')['pid'],
+            web_pid)
+
+    def test_update_leaves_other_groups_alone(self):
+        self.write_programs('d1', {'web': 200})
+        self.write_programs('d2', {'web': 100})
+        self.daemons.rpc.update(['d2-web'])
+        states = self.wait_until_running(['d1-web', 'd1-worker', 'd2-web'])
+        self.assertEqual(sorted(states), ['d1-web', 'd1-worker', 'd2-web'])